@@ -1,22 +1,76 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, render_template_string
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, render_template_string, Response, stream_with_context, send_file, make_response, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import os
+import math
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 import redis
+import click
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+import database
+from database import configure_database, configure_engine, read_only, run_write, REPLICA, RoutingSession
+import counters
+import metrics
+import profiling
+import ratelimit
+import compression
+import serialization
+import cardinality
+from cache import cached, invalidate, get_user, invalidate_user, get_medicine_catalog, invalidate_medicines
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////app/medical_cooperative.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))
+app.config['AUTH_CACHE_TTL'] = int(os.environ.get('AUTH_CACHE_TTL', 30))
+app.config['MEDICINE_CACHE_TTL'] = int(os.environ.get('MEDICINE_CACHE_TTL', 300))
 
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
 redis_port = os.environ.get('REDIS_PORT', 6379)
-redis_client = redis.Redis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+redis_pool = redis.ConnectionPool(
+    host=redis_host,
+    port=redis_port,
+    db=0,
+    decode_responses=True,
+    max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+    socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', 0.5)),
+    socket_connect_timeout=float(os.environ.get('REDIS_CONNECT_TIMEOUT', 0.5)),
+    health_check_interval=30,
+    connection_class=metrics.CountingConnection
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+app.config['COUNTER_FLUSH_INTERVAL'] = float(os.environ.get('COUNTER_FLUSH_INTERVAL', 1))
+app.config['DISTINCT_PATIENTS'] = os.environ.get('DISTINCT_PATIENTS', 'hll')
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('JOB_RESULT_TTL', 86400))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+app.config['JOB_RETRY_DELAY'] = float(os.environ.get('JOB_RETRY_DELAY', 10))
+app.config['JOB_STALE_AFTER'] = float(os.environ.get('JOB_STALE_AFTER', 60))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))
+app.config['CHANGE_LOG_PRUNE_INTERVAL'] = float(os.environ.get('CHANGE_LOG_PRUNE_INTERVAL', 600))
+app.config['LOGIN_RATE_LIMIT'] = os.environ.get('LOGIN_RATE_LIMIT', '1') == '1'
+app.config['LOGIN_RATE_WINDOW'] = float(os.environ.get('LOGIN_RATE_WINDOW', 900))
+app.config['LOGIN_MAX_FAILURES_PER_USER'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_USER', 5))
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+app.config['LOGIN_BACKOFF_BASE'] = float(os.environ.get('LOGIN_BACKOFF_BASE', 5))
+app.config['LOGIN_BACKOFF_MAX'] = float(os.environ.get('LOGIN_BACKOFF_MAX', 900))
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 0))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles'))
+app.config['PROFILE_MAX_COUNT'] = int(os.environ.get('PROFILE_MAX_COUNT', 50))
+app.config['PROFILE_RETENTION_HOURS'] = float(os.environ.get('PROFILE_RETENTION_HOURS', 168))
 
-db = SQLAlchemy(app)
+app.config['JSON_SERIALIZER'] = os.environ.get('JSON_SERIALIZER', 'orjson')
+app.config['COMPRESS'] = os.environ.get('COMPRESS', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['GZIP_LEVEL'] = int(os.environ.get('GZIP_LEVEL', 6))
+app.config['BROTLI_QUALITY'] = int(os.environ.get('BROTLI_QUALITY', 4))
+serialization.init_app(app)
+
+configure_database(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 CORS(app)
 
 # Модели данных
@@ -60,11 +114,77 @@ class Visit(db.Model):
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
     prescriptions = db.relationship('Prescription', backref='visit', lazy=True)
 
+    # Индексы дублируются в migrations.py для уже существующих баз
+    __table_args__ = (
+        db.Index('ix_visit_date', 'date'),
+        db.Index('ix_visit_patient_date', 'patient_id', 'date'),
+        db.Index('ix_visit_doctor_date', 'doctor_id', 'date'),
+        db.Index('ix_visit_diagnosis_date', 'diagnosis', 'date'),
+    )
+
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     visit_id = db.Column(db.Integer, db.ForeignKey('visit.id'), nullable=False)
     medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_prescription_visit', 'visit_id'),
+        db.Index('ix_prescription_medicine', 'medicine_id'),
+    )
+
+class VisitCounter(db.Model):
+    """Счетчики визитов по дате и по диагнозу, ведутся вместе с визитами"""
+    dimension = db.Column(db.String(20), primary_key=True)  # 'date' или 'diagnosis'
+    value = db.Column(db.String(200), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class VisitDaily(db.Model):
+    """Суточная сводка визитов: день x врач x диагноз x место"""
+    day = db.Column(db.Date, primary_key=True)
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    diagnosis = db.Column(db.String(200), primary_key=True)
+    location = db.Column(db.String(200), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class ChangeLog(db.Model):
+    """Журнал добавленных и измененных строк для выдачи изменений по ?since="""
+    id = db.Column(db.Integer, primary_key=True)  # курсор изменений
+    entity = db.Column(db.String(20), nullable=False)  # 'patient', 'doctor', 'medicine' или 'visit'
+    row_id = db.Column(db.Integer)  # None - таблица изменена целиком
+
+    __table_args__ = (
+        db.Index('ix_change_log_entity_id', 'entity', 'id'),
+    )
+
+@event.listens_for(Visit, 'after_insert')
+def count_inserted_visit(mapper, connection, visit):
+    """Обновление счетчиков и сводок в той же транзакции, что и вставка визита"""
+    from utils import increment_visit_counters
+    increment_visit_counters(connection, [{
+        'date': visit.date,
+        'diagnosis': visit.diagnosis,
+        'doctor_id': visit.doctor_id,
+        'location': visit.location
+    }])
+    # Пациент визита учитывается в HyperLogLog после коммита
+    cardinality.track(object_session(visit), [{
+        'date': visit.date,
+        'diagnosis': visit.diagnosis,
+        'doctor_id': visit.doctor_id,
+        'patient_id': visit.patient_id
+    }])
+
+def log_change(mapper, connection, target):
+    """Запись строки в журнал изменений в той же транзакции"""
+    from utils import log_changes
+    log_changes(connection, mapper.local_table.name, [target.id])
+
+for model in (Patient, Doctor, Medicine, Visit):
+    event.listen(model, 'after_insert', log_change)
+    event.listen(model, 'after_update', log_change)
+
+cardinality.init_app(RoutingSession)
+
 # Декораторы для аутентификации
 def login_required(f):
     @wraps(f)
@@ -74,13 +194,17 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def is_admin():
+    """Текущая сессия принадлежит активному администратору"""
+    user = get_user(session['user_id']) if 'user_id' in session else None
+    return user is not None and user.role == 'admin'
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'admin':
+        if not is_admin():
             flash('Доступ запрещен. Требуются права администратора.', 'error')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -91,16 +215,26 @@ def doctor_or_admin_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
+        user = get_user(session['user_id'])
         if not user or user.role not in ['admin', 'doctor']:
             flash('Доступ запрещен.', 'error')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
-# Создание таблиц
+# Создание таблиц и применение миграций схемы
 with app.app_context():
-    db.create_all()
+    for engine in db.engines.values():
+        configure_engine(app, engine)
+    database.init_app(app)
+    metrics.init_app(app, db.engine)
+    if REPLICA in db.engines:
+        metrics.instrument_engine(db.engines[REPLICA])
+    profiling.init_app(app, db.engine, is_admin)
+    # Регистрируется последним, чтобы метрики и профили видели сжатый размер
+    compression.init_app(app)
+    from migrations import migrate
+    migrate(db.engine, db.metadata)
   
 # Маршруты аутентификации
 @app.route('/login', methods=['GET', 'POST'])
@@ -109,10 +243,20 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
+        # Лимит проверяется до поиска пользователя и вычисления хэша
+        retry_after, attempt = ratelimit.check_login(username, request.remote_addr)
+        if retry_after:
+            counters.incr('rejected_logins')
+            flash(f'Слишком много попыток входа. Повторите через {math.ceil(retry_after)} с', 'error')
+            response = make_response(render_template('login.html'), 429)
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response
+        
         user = User.query.filter_by(username=username, is_active=True).first()
         
         if user and check_password_hash(user.password_hash, password):
-            redis_client.incr('successful_logins')
+            counters.incr('successful_logins')
+            ratelimit.login_succeeded(username, request.remote_addr, attempt)
             
             session['user_id'] = user.id
             session['username'] = user.username
@@ -121,7 +265,7 @@ def login():
             flash(f'Добро пожаловать, {user.name}!', 'success')
             return redirect(url_for('dashboard'))
         else:
-            redis_client.incr('failed_logins')
+            counters.incr('failed_logins')
             flash('Неверное имя пользователя или пароль', 'error')
     
     return render_template('login.html')
@@ -135,7 +279,7 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    user = User.query.get(session['user_id'])
+    user = get_user(session['user_id'])
     return render_template('index.html', user=user)
 
 # Главная страница со счетчиком посещений
@@ -145,7 +289,8 @@ def index():
         return redirect(url_for('dashboard'))
     
     # Увеличиваем счетчик посещений
-    visit_count = redis_client.incr('page_visits')
+    counters.incr('page_visits')
+    visit_count = counters.value('page_visits')
     
     # Простая HTML страница для неавторизованных пользователей
     html_template = f"""
@@ -201,30 +346,49 @@ def index():
     """
     
     return render_template_string(html_template)
+# API для пользователей: смена роли и деактивация
+@app.route('/api/users/<int:user_id>', methods=['PATCH'])
+@admin_required
+def update_user(user_id):
+    user = User.query.get_or_404(user_id)
+    data = request.json
+    if 'role' in data:
+        if data['role'] not in ['admin', 'doctor']:
+            return jsonify({'error': 'Роль должна быть admin или doctor'}), 400
+        user.role = data['role']
+    if 'is_active' in data:
+        user.is_active = bool(data['is_active'])
+    db.session.commit()
+    invalidate_user(user.id)
+    return jsonify({'message': 'User updated successfully'})
+
 # API для пациентов
 @app.route('/api/patients', methods=['GET', 'POST'])
 @doctor_or_admin_required
 def patients():
     if request.method == 'GET':
-        patients = Patient.query.all()
-        return jsonify([{
-            'id': p.id,
-            'name': p.name,
-            'gender': p.gender,
-            'birth_date': p.birth_date.isoformat(),
-            'address': p.address
-        } for p in patients])
+        from utils import (PATIENT_FIELDS, list_response, parse_fields, projected_query,
+                           serialize_fields, serialize_patient)
+        try:
+            fields = parse_fields(PATIENT_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if fields:
+            return list_response(projected_query(Patient, PATIENT_FIELDS, fields, [Patient.id]),
+                                 [Patient.id], serialize_fields(fields), entity='patient')
+        return list_response(Patient.query, [Patient.id], serialize_patient, entity='patient')
     
     elif request.method == 'POST':
         data = request.json
-        patient = Patient(
-            name=data['name'],
-            gender=data['gender'],
-            birth_date=datetime.strptime(data['birth_date'], '%Y-%m-%d').date(),
-            address=data['address']
-        )
-        db.session.add(patient)
-        db.session.commit()
+        def add_patient(session):
+            session.add(Patient(
+                name=data['name'],
+                gender=data['gender'],
+                birth_date=datetime.strptime(data['birth_date'], '%Y-%m-%d').date(),
+                address=data['address']
+            ))
+        run_write(add_patient)
+        invalidate('patient')
         return jsonify({'message': 'Patient added successfully'})
 
 # API для врачей
@@ -232,43 +396,67 @@ def patients():
 @admin_required
 def doctors():
     if request.method == 'GET':
-        doctors = Doctor.query.all()
-        return jsonify([{
-            'id': d.id,
-            'name': d.name
-        } for d in doctors])
+        from utils import list_response, serialize_doctor
+        return list_response(Doctor.query, [Doctor.id], serialize_doctor, entity='doctor')
     
     elif request.method == 'POST':
         data = request.json
-        doctor = Doctor(name=data['name'])
-        db.session.add(doctor)
-        db.session.commit()
+        def add_doctor(session):
+            session.add(Doctor(name=data['name']))
+        run_write(add_doctor)
+        invalidate('doctor')
         return jsonify({'message': 'Doctor added successfully'})
 
+# Расписание врача за период (?from=&to=, по умолчанию неделя с сегодняшнего дня)
+@app.route('/api/doctors/<int:doctor_id>/schedule')
+@doctor_or_admin_required
+def doctor_schedule(doctor_id):
+    from utils import get_doctor_schedule_cached, SCHEDULE_MAX_DAYS
+    try:
+        start_date = datetime.strptime(request.args.get('from', date.today().isoformat()), '%Y-%m-%d').date()
+        end_date = (datetime.strptime(request.args['to'], '%Y-%m-%d').date()
+                    if 'to' in request.args else start_date + timedelta(days=6))
+    except ValueError:
+        return jsonify({'error': 'Даты from и to в формате YYYY-MM-DD'}), 400
+    if end_date < start_date or (end_date - start_date).days > SCHEDULE_MAX_DAYS:
+        return jsonify({'error': f'Период должен быть не длиннее {SCHEDULE_MAX_DAYS} дней'}), 400
+    
+    return jsonify({
+        'doctor_id': doctor_id,
+        'from': start_date.isoformat(),
+        'to': end_date.isoformat(),
+        'visits': get_doctor_schedule_cached(doctor_id, start_date, end_date)
+    })
+
 # API для лекарств
 @app.route('/api/medicines', methods=['GET', 'POST'])
 @doctor_or_admin_required
 def medicines():
     if request.method == 'GET':
-        medicines = Medicine.query.all()
-        return jsonify([{
-            'id': m.id,
-            'name': m.name,
-            'usage_method': m.usage_method,
-            'description': m.description,
-            'side_effects': m.side_effects
-        } for m in medicines])
+        from utils import MEDICINE_FIELDS, list_items_response, list_response, parse_fields, serialize_medicine
+        try:
+            fields = parse_fields(MEDICINE_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if 'since' in request.args:
+            # Изменения читаются из БД: справочник процесса может еще не получить сброс
+            serialize = (lambda m: {name: getattr(m, name) for name in fields}) if fields else serialize_medicine
+            return list_response(Medicine.query, [Medicine.id], serialize, entity='medicine')
+        items, _, cursor = get_medicine_catalog()
+        return list_items_response(items, fields=fields, cursor=cursor)
     
     elif request.method == 'POST':
         data = request.json
-        medicine = Medicine(
-            name=data['name'],
-            usage_method=data['usage_method'],
-            description=data['description'],
-            side_effects=data['side_effects']
-        )
-        db.session.add(medicine)
-        db.session.commit()
+        def add_medicine(session):
+            session.add(Medicine(
+                name=data['name'],
+                usage_method=data['usage_method'],
+                description=data['description'],
+                side_effects=data['side_effects']
+            ))
+        run_write(add_medicine)
+        invalidate('medicine')
+        invalidate_medicines()
         return jsonify({'message': 'Medicine added successfully'})
 
 # API для визитов
@@ -276,144 +464,380 @@ def medicines():
 @doctor_or_admin_required
 def visits():
     if request.method == 'GET':
-        visits = Visit.query.all()
-        return jsonify([{
-            'id': v.id,
-            'date': v.date.isoformat(),
-            'location': v.location,
-            'symptoms': v.symptoms,
-            'diagnosis': v.diagnosis,
-            'prescriptions_text': v.prescriptions_text,
-            'patient_name': v.patient.name,
-            'doctor_name': v.doctor.name,
-            'medicines': [p.medicine.name for p in v.prescriptions]
-        } for v in visits])
+        from utils import (VISIT_FIELDS, attach_visit_medicines, list_response, parse_fields,
+                           projected_query, serialize_fields, serialize_visit, visits_with_names)
+        keys = [Visit.date, Visit.id]
+        try:
+            fields = parse_fields(VISIT_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if fields:
+            return list_response(projected_query(Visit, VISIT_FIELDS, fields, keys), keys,
+                                 serialize_fields(fields),
+                                 attach_visit_medicines if 'medicines' in fields else None,
+                                 entity='visit')
+        return list_response(visits_with_names(), keys, serialize_visit, entity='visit')
     
     elif request.method == 'POST':
+        from utils import schedule_cache_name
         data = request.json
-        visit = Visit(
-            date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
-            location=data['location'],
-            symptoms=data['symptoms'],
-            diagnosis=data['diagnosis'],
-            prescriptions_text=data['prescriptions_text'],
-            patient_id=data['patient_id'],
-            doctor_id=data['doctor_id']
-        )
-        db.session.add(visit)
-        db.session.flush()  # Получаем ID визита
-        
-        # Добавляем рецепты
-        for medicine_id in data.get('medicine_ids', []):
-            prescription = Prescription(
-                visit_id=visit.id,
-                medicine_id=medicine_id
+        visit_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
+        def add_visit(session):
+            visit = Visit(
+                date=visit_date,
+                location=data['location'],
+                symptoms=data['symptoms'],
+                diagnosis=data['diagnosis'],
+                prescriptions_text=data['prescriptions_text'],
+                patient_id=data['patient_id'],
+                doctor_id=data['doctor_id']
             )
-            db.session.add(prescription)
-        
-        db.session.commit()
+            session.add(visit)
+            session.flush()  # Получаем ID визита
+            
+            # Добавляем рецепты
+            for medicine_id in data.get('medicine_ids', []):
+                prescription = Prescription(
+                    visit_id=visit.id,
+                    medicine_id=medicine_id
+                )
+                session.add(prescription)
+        run_write(add_visit)
+        invalidate('visit', schedule_cache_name(data['doctor_id'], visit_date))
         return jsonify({'message': 'Visit added successfully'})
 
+# Экспорт визитов за период в CSV (потоком, ?gzip=1 - сжатый файл)
+@app.route('/api/visits/export')
+@doctor_or_admin_required
+def export_visits():
+    from utils import gzip_stream, iter_visits_csv
+    try:
+        start_date = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['to'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Укажите период: from и to в формате YYYY-MM-DD'}), 400
+    
+    filename = f'visits_{start_date.isoformat()}_{end_date.isoformat()}.csv'
+    chunks = iter_visits_csv(start_date, end_date)
+    if request.args.get('gzip') in ('1', 'true'):
+        return Response(stream_with_context(gzip_stream(chunks)), mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.gz'})
+    return Response(stream_with_context(chunks), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# Массовая загрузка визитов (NDJSON, либо CSV при ?format=csv или Content-Type: text/csv)
+@app.route('/api/visits/bulk', methods=['POST'])
+@doctor_or_admin_required
+def bulk_import_visits():
+    """Загрузка визитов с рецептами пачками"""
+    import codecs
+    from importer import import_visits, read_csv, read_ndjson
+    lines = codecs.getreader('utf-8')(request.stream)
+    if request.args.get('format') == 'csv' or request.mimetype == 'text/csv':
+        return jsonify(import_visits(read_csv(lines)))
+    return jsonify(import_visits(read_ndjson(lines)))
+
+# Динамика визитов за период из суточной сводки
+@app.route('/api/analytics/visits')
+@doctor_or_admin_required
+def visits_analytics():
+    """?from=&to=&granularity=day|week|month&group_by=doctor,diagnosis,location"""
+    from utils import get_visit_series, ANALYTICS_GROUPS
+    try:
+        start_date = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['to'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Укажите период: from и to в формате YYYY-MM-DD'}), 400
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ('day', 'week', 'month'):
+        return jsonify({'error': 'granularity: day, week или month'}), 400
+    group_by = [g for g in request.args.get('group_by', '').split(',') if g]
+    if any(g not in ANALYTICS_GROUPS for g in group_by):
+        return jsonify({'error': f"group_by: {', '.join(ANALYTICS_GROUPS)}"}), 400
+    
+    return jsonify({
+        'from': start_date.isoformat(),
+        'to': end_date.isoformat(),
+        'granularity': granularity,
+        'group_by': group_by,
+        'series': get_visit_series(start_date, end_date, granularity, group_by)
+    })
+
 # Функционал 1: Количество вызовов по дате
 @app.route('/api/visits/count-by-date', methods=['POST'])
 @doctor_or_admin_required
+@read_only
 def count_visits_by_date():
     data = request.json
     target_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-    count = Visit.query.filter_by(date=target_date).count()
+    counter = db.session.get(VisitCounter, ('date', target_date.isoformat()))
+    count = counter.count if counter else 0
     return jsonify({'date': target_date.isoformat(), 'count': count})
 
 # Функционал 2: Количество больных по болезни
 @app.route('/api/patients/count-by-diagnosis', methods=['POST'])
 @doctor_or_admin_required
+@read_only
 def count_patients_by_diagnosis():
+    """Число разных пациентов с диагнозом (не визитов); from, to, exact - необязательны"""
     data = request.json
     diagnosis = data['diagnosis']
-    count = Visit.query.filter_by(diagnosis=diagnosis).count()
-    return jsonify({'diagnosis': diagnosis, 'count': count})
+    try:
+        start_date, end_date = parse_period(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    count, approximate = cardinality.distinct_patients(start_date, end_date, diagnosis=diagnosis,
+                                                       exact=bool(data.get('exact')))
+    return jsonify({'diagnosis': diagnosis, 'count': count, 'approximate': approximate})
+
+def parse_period(params):
+    """Необязательный период from/to: (начало, конец) или (None, None)"""
+    if not params.get('from') and not params.get('to'):
+        return None, None
+    try:
+        start_date = datetime.strptime(params['from'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(params['to'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Укажите период: from и to в формате YYYY-MM-DD')
+    if start_date > end_date:
+        raise ValueError('Начало периода позже конца')
+    return start_date, end_date
+
+# Число разных пациентов за период, по диагнозу или врачу
+@app.route('/api/analytics/patients')
+@doctor_or_admin_required
+def patients_analytics():
+    """?from=&to=&diagnosis=&doctor_id=&exact=1"""
+    try:
+        start_date, end_date = parse_period(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    doctor_id = request.args.get('doctor_id', type=int)
+    diagnosis = request.args.get('diagnosis')
+    count, approximate = cardinality.distinct_patients(start_date, end_date, diagnosis, doctor_id,
+                                                       exact=request.args.get('exact') == '1')
+    return jsonify({
+        'from': start_date and start_date.isoformat(),
+        'to': end_date and end_date.isoformat(),
+        'diagnosis': diagnosis,
+        'doctor_id': doctor_id,
+        'count': count,
+        'approximate': approximate
+    })
 
 # Функционал 3: Побочные эффекты лекарства
 @app.route('/api/medicines/<int:medicine_id>/side-effects')
 @doctor_or_admin_required
 def get_medicine_side_effects(medicine_id):
-    medicine = Medicine.query.get_or_404(medicine_id)
+    medicine = get_medicine_catalog()[1].get(medicine_id)
+    if medicine is None:
+        abort(404)
     return jsonify({
-        'name': medicine.name,
-        'side_effects': medicine.side_effects
+        'name': medicine['name'],
+        'side_effects': medicine['side_effects']
     })
 
 # Функционал 4: Добавление нового лекарства (уже реализовано в /api/medicines POST)
 
 # Дополнительные API endpoints
+@app.route('/api/dashboard')
+@doctor_or_admin_required
+def get_dashboard():
+    """Данные главной страницы одним запросом (?sections=patients,visits,...&limit=)"""
+    from utils import get_dashboard, DASHBOARD_SECTIONS
+    requested = request.args.get('sections')
+    sections = requested.split(',') if requested else list(DASHBOARD_SECTIONS)
+    unknown = set(sections) - set(DASHBOARD_SECTIONS)
+    if unknown:
+        return jsonify({'error': f"Неизвестные разделы: {', '.join(sorted(unknown))}"}), 400
+    
+    # Список врачей доступен только администраторам
+    if get_user(session['user_id']).role != 'admin' and 'doctors' in sections:
+        sections.remove('doctors')
+    return jsonify(get_dashboard(sections, request.args.get('limit', type=int)))
+
 @app.route('/api/statistics')
 @doctor_or_admin_required
 def get_statistics():
     """Получение общей статистики системы"""
     from utils import get_statistics
-    return jsonify(get_statistics())
+    return jsonify(cached('statistics', get_statistics))
 
 @app.route('/api/popular-diagnoses')
 @doctor_or_admin_required
 def get_popular_diagnoses():
     """Получение популярных диагнозов"""
     from utils import get_popular_diagnoses
-    return jsonify(get_popular_diagnoses())
+    return jsonify(cached('popular-diagnoses', get_popular_diagnoses))
 
 @app.route('/api/popular-medicines')
 @doctor_or_admin_required
 def get_popular_medicines():
     """Получение популярных лекарств"""
     from utils import get_popular_medicines
-    return jsonify(get_popular_medicines())
+    return jsonify(cached('popular-medicines', get_popular_medicines))
+
+@app.route('/api/cache-stats')
+@doctor_or_admin_required
+def get_cache_stats():
+    """Попадания и промахи кэша агрегатных выборок"""
+    from cache import get_cache_stats
+    return jsonify(get_cache_stats())
+
+@app.route('/metrics')
+def get_metrics():
+    """Метрики процесса в формате Prometheus; при заданном METRICS_TOKEN нужен Bearer-токен"""
+    from hmac import compare_digest
+    token = app.config['METRICS_TOKEN']
+    if token and not compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Требуется токен доступа к метрикам'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiles')
+@admin_required
+def get_profiles():
+    """Сохраненные профили запросов (запрос с ?profile=1 или X-Profile: 1)"""
+    return jsonify(profiling.list_profiles(app))
+
+@app.route('/api/profiles/<profile_id>')
+@admin_required
+def get_profile(profile_id):
+    """Отчет профиля: SQL-запросы с планами и сводка cProfile; ?format=pstats - дамп статистики"""
+    suffix = '.prof' if request.args.get('format') == 'pstats' else '.json'
+    path = profiling.profile_path(app, profile_id, suffix)
+    if not path:
+        return jsonify({'error': 'Профиль не найден'}), 404
+    return send_file(path, as_attachment=True, download_name=profile_id + suffix)
 
 @app.route('/api/search-patients')
 @doctor_or_admin_required
 def search_patients():
     """Поиск пациентов"""
     from utils import search_patients
-    query = request.args.get('q', '')
+    query = request.args.get('q', '').strip()
     if not query:
         return jsonify([])
     
-    patients = search_patients(query)
-    return jsonify([{
-        'id': p.id,
-        'name': p.name,
-        'gender': p.gender,
-        'birth_date': p.birth_date.isoformat(),
-        'address': p.address
-    } for p in patients])
+    from utils import serialize_patient, SEARCH_LIMIT
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    if request.args.get('mode') == 'prefix':
+        # Подсказки при вводе: только id и имя
+        patients = search_patients(query, limit, prefix=True)
+        return jsonify([{'id': p.id, 'name': p.name} for p in patients])
+    
+    patients = search_patients(query, limit)
+    return jsonify([serialize_patient(p) for p in patients])
 
 @app.route('/api/patient/<int:patient_id>/history')
 @doctor_or_admin_required
 def get_patient_history(patient_id):
     """История визитов пациента"""
-    from utils import get_patient_history
+    from utils import get_patient_history, serialize_visit
     visits = get_patient_history(patient_id)
-    return jsonify([{
-        'id': v.id,
-        'date': v.date.isoformat(),
-        'location': v.location,
-        'symptoms': v.symptoms,
-        'diagnosis': v.diagnosis,
-        'prescriptions_text': v.prescriptions_text,
-        'doctor_name': v.doctor.name,
-        'medicines': [p.medicine.name for p in v.prescriptions]
-    } for v in visits])
+    return jsonify([serialize_visit(v) for v in visits])
 
 # API для получения статистики посещений
 @app.route('/api/visit-stats')
 @login_required
 def get_visit_stats():
     """Получение статистики посещений страницы"""
+    return jsonify({
+        'total_visits': counters.value('page_visits'),
+        'message': 'Статистика посещений главной страницы'
+    })
+
+# Фоновые задачи: выполняются процессом worker.py
+@app.route('/api/jobs', methods=['POST'])
+@doctor_or_admin_required
+def create_job():
+    """{"type": "visits_export" | "visit_series" | "rebuild_counters", "params": {...}}"""
+    from jobs import JOB_TYPES, enqueue
+    data = request.get_json(silent=True) or {}
+    job_type = data.get('type')
+    if job_type not in JOB_TYPES:
+        return jsonify({'error': f"type: {', '.join(JOB_TYPES)}"}), 400
+    if JOB_TYPES[job_type][2] and not is_admin():
+        return jsonify({'error': 'Требуются права администратора'}), 403
+    if not isinstance(data.get('params', {}), dict):
+        return jsonify({'error': 'params должен быть объектом'}), 400
     try:
-        total_visits = redis_client.get('page_visits') or 0
-        return jsonify({
-            'total_visits': int(total_visits),
-            'message': 'Статистика посещений главной страницы'
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-        
+        job = enqueue(job_type, data.get('params'), session['user_id'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except redis.RedisError:
+        return jsonify({'error': 'Очередь задач недоступна'}), 503
+    return jsonify(job), 202, {'Location': f"/api/jobs/{job['id']}"}
+
+def own_job(job_id):
+    """Задача текущего пользователя (администратору - любая) или None"""
+    from jobs import get_job
+    job = get_job(job_id)
+    if job and (job.get('user_id') == str(session['user_id']) or is_admin()):
+        return job
+    return None
+
+@app.route('/api/jobs/<job_id>')
+@doctor_or_admin_required
+def get_job_status(job_id):
+    """Статус, прогресс и ошибка задачи"""
+    from jobs import describe
+    job = own_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(describe(job))
+
+@app.route('/api/jobs/<job_id>/result')
+@doctor_or_admin_required
+def get_job_result(job_id):
+    """Результат готовой задачи (хранится JOB_RESULT_TTL секунд)"""
+    from jobs import get_result
+    job = own_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'Задача еще не выполнена', 'status': job['status']}), 409
+    result = get_result(job_id)
+    if result is None:
+        return jsonify({'error': 'Результат задачи истек'}), 410
+    headers = {'Content-Disposition': f"attachment; filename={job['filename']}"} if job.get('filename') else {}
+    return Response(stream_with_context(result), mimetype=job['result_type'], headers=headers)
+
+# Служебные команды: flask --app app <команда>
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Пересчет счетчиков, суточных сводок визитов и множеств пациентов по таблице visit"""
+    from utils import rebuild_visit_counters
+    rebuild_visit_counters()
+    print('Счетчики визитов пересчитаны')
+    cardinality.rebuild()
+    print('Множества пациентов пересчитаны')
+
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """Копирование основной базы SQLite в реплику (для проверки чтения с реплики локально)"""
+    from database import copy_sqlite
+    if REPLICA not in db.engines:
+        raise click.ClickException('DATABASE_READ_URL не задан')
+    if db.engine.dialect.name != 'sqlite' or db.engines[REPLICA].dialect.name != 'sqlite':
+        raise click.ClickException('Копирование поддерживается только между базами SQLite')
+    copy_sqlite(app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLALCHEMY_BINDS'][REPLICA]['url'])
+    print('Реплика обновлена')
+
+@app.cli.command('import-visits')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+              default=None, help='Формат файла (по умолчанию по расширению)')
+def import_visits_command(path, file_format):
+    """Массовая загрузка визитов из NDJSON или CSV файла"""
+    from importer import import_visits, read_csv, read_ndjson
+    if file_format is None:
+        file_format = 'csv' if path.endswith('.csv') else 'ndjson'
+    with open(path, encoding='utf-8', newline='') as f:
+        records = read_csv(f) if file_format == 'csv' else read_ndjson(f)
+        report = import_visits(records)
+    print(f"Загружено визитов: {report['inserted']}, с ошибками: {report['failed']}")
+    for error in report['errors']:
+        print(f"  строка {error['line']}: {error['error']}")
+
 if __name__ == '__main__':
     app.run(debug=True)
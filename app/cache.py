@@ -0,0 +1,247 @@
+"""
+Кэширование: агрегатные выборки в Redis и локальные кэши процесса
+
+Агрегаты (статистика, популярные диагнозы и лекарства) читаются через
+кэш: при попадании - один GET, при промахе значение вычисляется и
+записывается с TTL. POST-обработчики сбрасывают выборки, которые зависят
+от добавленной сущности. Если Redis недоступен, значение просто
+вычисляется заново.
+
+Локальные кэши процесса (пользователи, справочник лекарств) живут
+ограниченный TTL и сбрасываются во всех воркерах через pub/sub каналы
+invalidate:*.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+from threading import Lock
+import redis
+
+KEY_PREFIX = 'cache:'
+
+# Какие закэшированные выборки устаревают при добавлении сущности
+INVALIDATES = {
+    'patient': ['statistics'],
+    'doctor': ['statistics'],
+    'medicine': ['statistics', 'popular-medicines'],
+    'visit': ['statistics', 'popular-diagnoses', 'popular-medicines'],
+}
+
+# Счетчики попаданий и промахов текущего процесса
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'errors': 0})
+_stats_lock = Lock()
+
+def _count(name, kind):
+    with _stats_lock:
+        _stats[name][kind] += 1
+
+def cached(name, compute, ttl=None):
+    """Значение выборки из кэша либо вычисление и запись с TTL"""
+    from app import app, redis_client
+
+    key = KEY_PREFIX + name
+    try:
+        raw = redis_client.get(key)
+    except redis.RedisError:
+        _count(name, 'errors')
+        return compute()
+
+    if raw is not None:
+        _count(name, 'hits')
+        return json.loads(raw)
+
+    _count(name, 'misses')
+    value = compute()
+    try:
+        redis_client.set(key, json.dumps(value), ex=ttl or app.config['CACHE_TTL'])
+    except redis.RedisError:
+        _count(name, 'errors')
+    return value
+
+def cached_many(group, names, compute_missing, ttl=None):
+    """Пакетное чтение через кэш: один MGET, недостающее вычисляется разом
+
+    compute_missing(список имен) возвращает {имя: значение}; результат -
+    словарь {имя: значение} для всех names. Попадания и промахи
+    учитываются под общим именем group.
+    """
+    from app import app, redis_client
+
+    try:
+        raws = redis_client.mget([KEY_PREFIX + name for name in names])
+    except redis.RedisError:
+        _count(group, 'errors')
+        return compute_missing(names)
+
+    values = {}
+    missing = []
+    for name, raw in zip(names, raws):
+        if raw is None:
+            missing.append(name)
+        else:
+            values[name] = json.loads(raw)
+    with _stats_lock:
+        _stats[group]['hits'] += len(values)
+        _stats[group]['misses'] += len(missing)
+    if not missing:
+        return values
+
+    computed = compute_missing(missing)
+    values.update(computed)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for name in missing:
+            pipe.set(KEY_PREFIX + name, json.dumps(computed[name]), ex=ttl or app.config['CACHE_TTL'])
+        pipe.execute()
+    except redis.RedisError:
+        _count(group, 'errors')
+    return values
+
+def invalidate(entity, *extra):
+    """Сброс выборок, зависящих от сущности entity, и выборок extra"""
+    from app import redis_client
+
+    names = INVALIDATES.get(entity, []) + list(extra)
+    if not names:
+        return
+    try:
+        redis_client.delete(*[KEY_PREFIX + name for name in names])
+    except redis.RedisError:
+        for name in names:
+            _count(name, 'errors')
+
+def get_cache_stats():
+    """Счетчики попаданий и промахов по выборкам"""
+    with _stats_lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+# Сброс локальных кэшей во всех процессах через Redis pub/sub
+CHANNEL_PREFIX = 'invalidate:'
+LISTENER_RETRY = 5
+
+_handlers = {}
+_listener_pid = None
+_listener_lock = Lock()
+
+def on_invalidate(name, handler):
+    """Регистрация обработчика сообщений канала invalidate:<name>"""
+    _handlers[CHANNEL_PREFIX + name] = handler
+
+def publish_invalidation(name, message):
+    """Рассылка сброса всем процессам (включая текущий)"""
+    from app import redis_client
+
+    _handlers[CHANNEL_PREFIX + name](message)
+    try:
+        redis_client.publish(CHANNEL_PREFIX + name, message)
+    except redis.RedisError:
+        pass
+
+def _listen():
+    from app import redis_client
+
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(CHANNEL_PREFIX + '*')
+            while True:
+                # get_message с ожиданием не упирается в socket_timeout клиента
+                message = pubsub.get_message(timeout=1.0)
+                handler = message and _handlers.get(message['channel'])
+                if handler:
+                    handler(message['data'])
+        except redis.RedisError:
+            # Пропущенные сообщения покрываются TTL локальных кэшей
+            time.sleep(LISTENER_RETRY)
+
+def ensure_listener():
+    """Запуск слушателя pub/sub в текущем процессе (в т.ч. после fork)"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            threading.Thread(target=_listen, name='cache-invalidation', daemon=True).start()
+            _listener_pid = os.getpid()
+
+# Кэш пользователей для проверки прав без запроса к БД
+CachedUser = namedtuple('CachedUser', ['id', 'username', 'role', 'name'])
+
+_users = {}
+_users_generation = 0
+
+def get_user(user_id):
+    """Активный пользователь из кэша процесса либо из БД (None, если нет)"""
+    from app import app, db, User
+
+    ensure_listener()
+    entry = _users.get(user_id)
+    now = time.monotonic()
+    if entry and entry[0] > now:
+        return entry[1]
+
+    # Сброс, пришедший во время загрузки, отменяет сохранение ее результата
+    generation = _users_generation
+    user = db.session.get(User, user_id)
+    cached_user = None
+    if user and user.is_active:
+        cached_user = CachedUser(user.id, user.username, user.role, user.name)
+    if generation == _users_generation:
+        _users[user_id] = (now + app.config['AUTH_CACHE_TTL'], cached_user)
+    return cached_user
+
+def _drop_user(message):
+    global _users_generation
+    _users_generation += 1
+    _users.pop(int(message), None)
+
+def invalidate_user(user_id):
+    """Сброс пользователя во всех процессах (смена роли, деактивация)"""
+    publish_invalidation('user', str(user_id))
+
+on_invalidate('user', _drop_user)
+
+# Справочник лекарств целиком в памяти процесса
+_medicines = None
+_medicines_generation = 0
+
+def get_medicine_catalog():
+    """Лекарства из памяти процесса: (список по возрастанию id, словарь
+    id -> лекарство, курсор журнала изменений на момент загрузки)
+
+    Справочник загружается одним запросом и живет MEDICINE_CACHE_TTL
+    секунд либо до сброса через invalidate_medicines. Словари общие для
+    всех запросов, изменять их нельзя.
+    """
+    global _medicines
+    from app import app, Medicine
+    from utils import change_cursor, serialize_medicine
+
+    ensure_listener()
+    catalog = _medicines
+    now = time.monotonic()
+    if catalog and catalog[0] > now:
+        return catalog[1:]
+
+    # Сброс, пришедший во время загрузки, отменяет сохранение ее результата
+    generation = _medicines_generation
+    cursor = change_cursor()
+    items = [serialize_medicine(m) for m in Medicine.query.order_by(Medicine.id)]
+    by_id = {item['id']: item for item in items}
+    if generation == _medicines_generation:
+        _medicines = (now + app.config['MEDICINE_CACHE_TTL'], items, by_id, cursor)
+    return items, by_id, cursor
+
+def _drop_medicines(message):
+    global _medicines, _medicines_generation
+    _medicines_generation += 1
+    _medicines = None
+
+def invalidate_medicines():
+    """Сброс справочника лекарств во всех процессах"""
+    publish_invalidation('medicines', '')
+
+on_invalidate('medicines', _drop_medicines)
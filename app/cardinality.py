@@ -0,0 +1,175 @@
+"""
+Число разных пациентов по диагнозу, дате и врачу
+
+Для каждого визита id пациента добавляется (PFADD) в HyperLogLog-и
+Redis за день, месяц и все время - в целом, по диагнозу и по врачу
+визита: ключи hll:patients:<период>[:diagnosis:<диагноз>|:doctor:<id>],
+период - YYYY-MM-DD, YYYY-MM или all. Число разных пациентов за период -
+PFCOUNT по ключам целых месяцев и оставшихся дней (объединение без
+сохранения), стандартная погрешность около 0.81%.
+
+Пациенты учитываются после коммита транзакции с визитами. После
+массовой загрузки множества строятся заново по таблице visit (rebuild):
+дни - через PFADD, месяцы и все время - через PFMERGE дней. Пока
+множества не построены, при недоступном Redis, для диагноза и врача
+одновременно, при DISTINCT_PATIENTS=exact и по запросу exact считается
+точно: COUNT(DISTINCT patient_id) в SQL.
+"""
+
+import calendar
+from collections import defaultdict
+from datetime import timedelta
+import redis
+
+KEY_PREFIX = 'hll:patients:'
+READY_KEY = KEY_PREFIX + 'ready'
+REBUILD_BATCH = 50000
+
+def _scope(diagnosis=None, doctor_id=None):
+    """Суффикс ключа: по диагнозу, по врачу или все пациенты"""
+    if diagnosis is not None:
+        return f':diagnosis:{diagnosis}'
+    if doctor_id is not None:
+        return f':doctor:{doctor_id}'
+    return ''
+
+def _scopes(row):
+    """Суффиксы ключей, в которые попадает пациент визита"""
+    return ['', _scope(diagnosis=row['diagnosis']), _scope(doctor_id=row['doctor_id'])]
+
+def _add(pipe, members):
+    for key, patient_ids in members.items():
+        pipe.pfadd(key, *patient_ids)
+
+def add_visits(rows):
+    """Учет пациентов визитов; rows - словари с date, diagnosis, doctor_id, patient_id"""
+    from app import redis_client
+
+    members = defaultdict(set)
+    for row in rows:
+        day = row['date'].isoformat()
+        for period in (day, day[:7], 'all'):
+            for scope in _scopes(row):
+                members[KEY_PREFIX + period + scope].add(row['patient_id'])
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _add(pipe, members)
+        pipe.execute()
+    except redis.RedisError:
+        # Без этих визитов множества неполны: до rebuild считаем точно
+        try:
+            redis_client.delete(READY_KEY)
+        except redis.RedisError:
+            pass
+
+def track(session, rows):
+    """Учет пациентов визитов после коммита сессии (при откате - не учитываются)"""
+    session.info.setdefault('new_visits', []).extend(rows)
+
+def init_app(session_class):
+    """Подписка на коммит и откат сессий"""
+    from sqlalchemy import event
+
+    @event.listens_for(session_class, 'after_commit')
+    def add_committed_visits(session):
+        rows = session.info.pop('new_visits', None)
+        if rows:
+            add_visits(rows)
+
+    @event.listens_for(session_class, 'after_rollback')
+    def forget_rolled_back_visits(session):
+        session.info.pop('new_visits', None)
+
+def period_keys(start_date, end_date):
+    """Периоды, покрывающие [start_date, end_date]: целые месяцы и остальные дни"""
+    periods = []
+    day = start_date
+    while day <= end_date:
+        month_end = day.replace(day=calendar.monthrange(day.year, day.month)[1])
+        if day.day == 1 and month_end <= end_date:
+            periods.append(day.strftime('%Y-%m'))
+            day = month_end + timedelta(days=1)
+        else:
+            periods.append(day.isoformat())
+            day += timedelta(days=1)
+    return periods
+
+def exact_distinct_patients(start_date=None, end_date=None, diagnosis=None, doctor_id=None):
+    """COUNT(DISTINCT patient_id) по таблице visit"""
+    from sqlalchemy import func
+    from app import db, Visit
+
+    query = db.session.query(func.count(func.distinct(Visit.patient_id)))
+    if start_date is not None:
+        query = query.filter(Visit.date >= start_date, Visit.date <= end_date)
+    if diagnosis is not None:
+        query = query.filter(Visit.diagnosis == diagnosis)
+    if doctor_id is not None:
+        query = query.filter(Visit.doctor_id == doctor_id)
+    return query.scalar()
+
+def distinct_patients(start_date=None, end_date=None, diagnosis=None, doctor_id=None, exact=False):
+    """Число разных пациентов с визитами за период (без периода - за все
+    время), с диагнозом diagnosis и/или у врача doctor_id.
+
+    Возвращает (число, приближенное ли оно).
+    """
+    from app import app, redis_client
+
+    if not exact and app.config['DISTINCT_PATIENTS'] == 'hll' and (diagnosis is None or doctor_id is None):
+        scope = _scope(diagnosis, doctor_id)
+        periods = period_keys(start_date, end_date) if start_date is not None else ['all']
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.exists(READY_KEY)
+            pipe.pfcount(*[KEY_PREFIX + period + scope for period in periods])
+            ready, count = pipe.execute()
+            if ready:
+                return count, True
+        except redis.RedisError:
+            pass
+    return exact_distinct_patients(start_date, end_date, diagnosis, doctor_id), False
+
+def rebuild(batch_size=REBUILD_BATCH):
+    """Множества пациентов заново по таблице visit"""
+    from sqlalchemy import select
+    from app import db, redis_client, Visit
+
+    redis_client.delete(READY_KEY)
+    keys = []
+    for key in redis_client.scan_iter(match=KEY_PREFIX + '*', count=1000):
+        keys.append(key)
+        if len(keys) >= 1000:
+            redis_client.delete(*keys)
+            keys = []
+    if keys:
+        redis_client.delete(*keys)
+
+    # Суточные множества пачками; порядок строк не важен, PFADD дописывает
+    month_days = defaultdict(set)
+    members = defaultdict(set)
+    statement = select(Visit.date, Visit.diagnosis, Visit.doctor_id, Visit.patient_id)
+    with db.engine.connect() as connection:
+        for rows in connection.execution_options(stream_results=True).execute(statement).mappings() \
+                .partitions(batch_size):
+            for row in rows:
+                day = row['date'].isoformat()
+                for scope in _scopes(row):
+                    members[KEY_PREFIX + day + scope].add(row['patient_id'])
+                    month_days[(day[:7], scope)].add(KEY_PREFIX + day + scope)
+            pipe = redis_client.pipeline(transaction=False)
+            _add(pipe, members)
+            pipe.execute()
+            members.clear()
+
+    # Месяцы - объединение своих дней, все время - объединение месяцев.
+    # PFMERGE учитывает и то, что успели добавить визиты, вставленные во время пересчета
+    months = defaultdict(list)
+    pipe = redis_client.pipeline(transaction=False)
+    for (month, scope), sources in month_days.items():
+        pipe.pfmerge(KEY_PREFIX + month + scope, *sources)
+        months[scope].append(KEY_PREFIX + month + scope)
+    for scope, sources in months.items():
+        pipe.pfmerge(KEY_PREFIX + 'all' + scope, *sources)
+    pipe.set(READY_KEY, 1)
+    pipe.execute()
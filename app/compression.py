@@ -0,0 +1,74 @@
+"""
+Сжатие ответов по Accept-Encoding
+
+Текстовые ответы (JSON, NDJSON, CSV, HTML, CSS, JS) сжимаются brotli
+или gzip - что клиент предпочитает из доступного. Обычные ответы
+сжимаются, начиная с COMPRESS_MIN_SIZE байт; потоковые сжимаются
+всегда, по мере отдачи, со сбросом буфера после каждой пачки, чтобы
+клиент получал строки без задержки. Уже закодированные ответы и файлы
+не трогаются. Brotli используется, если установлен пакет Brotli.
+"""
+
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {
+    'application/json', 'application/x-ndjson', 'text/csv', 'text/html',
+    'text/plain', 'text/css', 'text/javascript', 'application/javascript'
+}
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+def compressor(encoding, level):
+    """Функции (сжать кусок, завершить поток) для потокового сжатия"""
+    if encoding == 'br':
+        stream = brotli.Compressor(quality=level)
+        return (lambda data: stream.process(data) + stream.flush()), stream.finish
+    stream = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (lambda data: stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)), stream.flush
+
+def compress_body(data, encoding, level):
+    """Сжатие тела обычного ответа целиком"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+def compress_stream(chunks, encoding, level):
+    """Сжатие потокового ответа по кускам"""
+    compress, finish = compressor(encoding, level)
+    for chunk in chunks:
+        data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+def init_app(app):
+    """Сжатие ответов после обработки запроса"""
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if not app.config['COMPRESS'] or response.direct_passthrough \
+                or response.status_code < 200 or response.status_code in (204, 206, 304) \
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if not encoding:
+            return response
+        level = app.config['BROTLI_QUALITY'] if encoding == 'br' else app.config['GZIP_LEVEL']
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress_body(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
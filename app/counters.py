@@ -0,0 +1,103 @@
+"""
+Счетчики в Redis с буферизацией в процессе
+
+Увеличения копятся в памяти и раз в COUNTER_FLUSH_INTERVAL секунд
+отправляются в Redis одним конвейером INCRBY из фонового потока, так
+что запрос не ждет сети. Если Redis недоступен, увеличения остаются в
+буфере до следующей успешной отправки. Текущее значение счетчика - это
+значение из Redis (общее для всех процессов) плюс неотправленный остаток
+процесса. Значения из Redis перечитываются тем же конвейером при каждой
+отправке, а если поток отправки не запущен - при чтении, когда значение
+старше COUNTER_FLUSH_INTERVAL.
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+import redis
+
+_pending = Counter()
+_inflight = Counter()
+_totals = {}
+_read_at = {}
+_lock = threading.Lock()
+_flusher_pid = None
+
+def incr(name, amount=1):
+    """Увеличение счетчика без обращения к Redis"""
+    _ensure_flusher()
+    with _lock:
+        _pending[name] += amount
+
+def flush():
+    """Отправка накопленных увеличений в Redis и чтение текущих значений
+    всех известных счетчиков; False, если Redis недоступен"""
+    from app import redis_client
+
+    global _pending, _inflight
+    with _lock:
+        batch, _pending = _pending, Counter()
+        _inflight = batch
+        names = list(batch) + [name for name in _totals if name not in batch]
+    if not names:
+        return True
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for name in names:
+            if name in batch:
+                pipe.incrby(name, batch[name])
+            else:
+                pipe.get(name)
+        results = pipe.execute()
+    except redis.RedisError:
+        with _lock:
+            _pending.update(batch)
+            _inflight = Counter()
+        return False
+
+    now = time.monotonic()
+    with _lock:
+        for name, result in zip(names, results):
+            _totals[name] = int(result or 0)
+            _read_at[name] = now
+        _inflight = Counter()
+    return True
+
+def value(name):
+    """Значение счетчика: из Redis плюс неотправленное этим процессом"""
+    from app import app, redis_client
+
+    now = time.monotonic()
+    if now - _read_at.get(name, float('-inf')) >= app.config['COUNTER_FLUSH_INTERVAL']:
+        try:
+            stored = redis_client.get(name)
+        except redis.RedisError:
+            pass
+        else:
+            with _lock:
+                _totals[name] = int(stored or 0)
+                _read_at[name] = now
+    with _lock:
+        return _totals.get(name, 0) + _inflight[name] + _pending[name]
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        flush()
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    from app import app
+
+    with _lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=_flush_loop, args=(app.config['COUNTER_FLUSH_INTERVAL'],),
+                             name='counter-flush', daemon=True).start()
+            _flusher_pid = os.getpid()
+
+atexit.register(flush)
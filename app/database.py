@@ -0,0 +1,235 @@
+"""
+Настройка подключения к базе данных и групповой коммит записей
+
+Адрес базы (DATABASE_URL), профиль SQLite (журнал WAL, busy_timeout,
+уровень synchronous) и параметры пула соединений задаются переменными
+окружения. При WRITE_QUEUE=1 все записи POST-обработчиков выполняет
+один поток: параллельные запросы собираются в пачку и фиксируются одним
+коммитом, а каждый вызывающий получает свой результат или свою ошибку.
+
+Если задан DATABASE_READ_URL, чтения GET-запросов (и обработчиков,
+отмеченных read_only) идут на реплику, а записи и все остальное - в
+основную базу. Реплика может отставать от основной базы.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import wraps
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+# База по умолчанию: каталог data рядом с приложением (в Docker - том ./data)
+DEFAULT_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'medical_cooperative.db')
+
+# Ключ движка реплики в SQLALCHEMY_BINDS
+REPLICA = 'replica'
+
+def engine_options(url):
+    """Параметры движка для адреса базы
+
+    Размер пула и ожидание соединения задаются только для пула QueuePool:
+    SQLite в памяти работает через один общий пул соединения (StaticPool),
+    который таких параметров не принимает.
+    """
+    options = {
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    url = make_url(url)
+    in_memory = url.get_backend_name() == 'sqlite' and (
+        url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory')
+    if not in_memory:
+        options.update({
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        })
+    return options
+
+def configure_database(app):
+    """Адрес базы, параметры движка и очереди записи из окружения (до создания db)"""
+    if 'DATABASE_URL' not in os.environ:
+        os.makedirs(os.path.dirname(DEFAULT_DATABASE), exist_ok=True)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + DEFAULT_DATABASE)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    if os.environ.get('DATABASE_READ_URL'):
+        # Параметры SQLALCHEMY_ENGINE_OPTIONS на движки SQLALCHEMY_BINDS не переносятся
+        read_url = os.environ['DATABASE_READ_URL']
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: dict(engine_options(read_url), url=read_url)}
+    app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+    app.config['WRITE_QUEUE'] = os.environ.get('WRITE_QUEUE', '0') == '1'
+    app.config['WRITE_QUEUE_MAX_BATCH'] = int(os.environ.get('WRITE_QUEUE_MAX_BATCH', 100))
+    app.config['WRITE_QUEUE_MAX_DELAY'] = float(os.environ.get('WRITE_QUEUE_MAX_DELAY', 0.002))
+    app.config['WRITE_QUEUE_TIMEOUT'] = float(os.environ.get('WRITE_QUEUE_TIMEOUT', 30))
+
+def configure_engine(app, engine):
+    """PRAGMA профиля для каждого нового соединения SQLite"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = [
+        f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT']}",
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+class RoutingSession(Session):
+    """Сессия, отправляющая чтения запроса на реплику
+
+    На реплику идут только чтения в запросе, отмеченном g.read_replica;
+    flush, INSERT/UPDATE/DELETE и работа вне запроса (CLI, воркеры,
+    поток группового коммита) всегда идут в основную базу.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) \
+                and REPLICA in self._db.engines and has_app_context() and g.get('read_replica'):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def init_app(app):
+    """Чтения GET-запросов - с реплики"""
+
+    @app.before_request
+    def route_reads():
+        g.read_replica = request.method in ('GET', 'HEAD')
+
+def read_only(f):
+    """Обработчик только читает: его чтения идут на реплику и для POST"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+def copy_sqlite(source_url, target_url):
+    """Копия базы SQLite в другой файл (резервное копирование SQLite,
+    читатели цели видят либо старую, либо новую копию целиком)"""
+    source_path, target_path = make_url(source_url).database, make_url(target_url).database
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+class GroupCommitWriter:
+    """Поток записи, объединяющий параллельные записи в один коммит
+
+    Запись - функция от сессии, которая добавляет объекты и не вызывает
+    commit. Если пачка падает, она откатывается и записи повторяются по
+    одной, чтобы ошибка досталась только своему вызывающему.
+    """
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.max_batch = app.config['WRITE_QUEUE_MAX_BATCH']
+        self.max_delay = app.config['WRITE_QUEUE_MAX_DELAY']
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, write):
+        future = Future()
+        self.queue.put((write, future))
+        return future
+
+    def _collect(self):
+        """Пачка записей; записи, отмененные вызывающим до выборки, пропускаются"""
+        batch = []
+        while len(batch) < self.max_batch:
+            if not batch:
+                item = self.queue.get()
+                deadline = time.monotonic() + self.max_delay
+            else:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            # После этого вызова запись уже нельзя отменить
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch
+
+    def _commit(self, batch):
+        session = self.db.session
+        results = [write(session) for write, _ in batch]
+        session.commit()
+        return results
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self._collect()
+                try:
+                    results = self._commit(batch)
+                except Exception:
+                    self.db.session.rollback()
+                    for item in batch:
+                        self._run_single(item)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+                finally:
+                    self.db.session.close()
+
+    def _run_single(self, item):
+        write, future = item
+        try:
+            result = self._commit([item])[0]
+        except Exception as e:
+            self.db.session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """Поток группового коммита текущего процесса (создается при первом вызове)"""
+    global _writer, _writer_pid
+    from app import app, db
+
+    with _writer_lock:
+        if _writer_pid != os.getpid():
+            _writer = GroupCommitWriter(app, db)
+            _writer_pid = os.getpid()
+    return _writer
+
+def run_write(write):
+    """Выполнение записи через очередь группового коммита или сразу"""
+    from app import app, db
+
+    if app.config['WRITE_QUEUE']:
+        future = get_writer().submit(write)
+        try:
+            return future.result(app.config['WRITE_QUEUE_TIMEOUT'])
+        except FutureTimeout:
+            # Запись, не взятую в пачку, отменяем и сообщаем об ошибке. Взятая
+            # уже фиксируется: ошибка сейчас привела бы к повтору и дублю
+            if future.cancel():
+                raise
+            return future.result()
+    result = write(db.session)
+    db.session.commit()
+    return result
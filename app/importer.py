@@ -0,0 +1,201 @@
+"""
+Массовая загрузка визитов с рецептами из NDJSON или CSV
+
+Записи читаются потоком и обрабатываются пачками: пациенты, врачи и
+лекарства пачки проверяются тремя запросами IN, допустимые визиты и
+рецепты вставляются через executemany, каждая пачка - своя транзакция.
+Ошибочные строки не прерывают загрузку и попадают в отчет: хранятся
+только MAX_REPORTED_ERRORS ошибок с наименьшими номерами строк,
+остальные лишь считаются.
+
+CSV: колонки date, location, symptoms, diagnosis, prescriptions_text,
+patient_id, doctor_id, medicine_ids (id лекарств через ';').
+"""
+
+import csv
+import heapq
+import json
+from datetime import date
+from sqlalchemy import func, insert, select
+from app import db, Patient, Doctor, Medicine, Visit, Prescription
+from cache import invalidate
+from cardinality import track
+from utils import increment_visit_counters, log_changes, schedule_cache_name
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+# Ограничение числа параметров в одном IN для SQLite
+MAX_IN_PARAMS = 10000
+
+VISIT_FIELDS = ['date', 'location', 'symptoms', 'diagnosis', 'prescriptions_text',
+                'patient_id', 'doctor_id']
+
+def read_ndjson(lines):
+    """Записи NDJSON: (номер строки, запись, ошибка)"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, None, f'Некорректный JSON: {e}'
+            continue
+        if not isinstance(record, dict):
+            yield number, None, 'Ожидался JSON-объект'
+            continue
+        yield number, record, None
+
+def read_csv(lines):
+    """Записи CSV с заголовком: (номер строки, запись, ошибка)"""
+    reader = csv.DictReader(lines)
+    for record in reader:
+        medicine_ids = record.get('medicine_ids') or ''
+        record['medicine_ids'] = [m for m in medicine_ids.split(';') if m.strip()]
+        yield reader.line_num, record, None
+
+def parse_visit(record):
+    """Строка таблицы visit и список id лекарств; ValueError при ошибке"""
+    missing = [field for field in VISIT_FIELDS if record.get(field) in (None, '')]
+    if missing:
+        raise ValueError('Не заполнены поля: ' + ', '.join(missing))
+    row = {
+        'date': date.fromisoformat(str(record['date'])),
+        'location': str(record['location']),
+        'symptoms': str(record['symptoms']),
+        'diagnosis': str(record['diagnosis']),
+        'prescriptions_text': str(record['prescriptions_text']),
+        'patient_id': int(record['patient_id']),
+        'doctor_id': int(record['doctor_id'])
+    }
+    medicine_ids = record.get('medicine_ids') or []
+    if not isinstance(medicine_ids, list):
+        raise ValueError('medicine_ids должен быть списком')
+    return row, [int(m) for m in medicine_ids]
+
+def existing_ids(connection, column, ids):
+    """Какие из ids есть в таблице (запросы IN по частям)"""
+    ids = list(ids)
+    found = set()
+    for start in range(0, len(ids), MAX_IN_PARAMS):
+        chunk = ids[start:start + MAX_IN_PARAMS]
+        found.update(connection.execute(select(column).where(column.in_(chunk))).scalars())
+    return found
+
+def insert_visits(connection, rows):
+    """Вставка строк visit одним executemany, возвращает их id по порядку
+
+    В SQLite id назначаются заранее от MAX(id): RETURNING с сохранением
+    порядка там выполняется построчно. Вызывать только после первой
+    записи в транзакции, когда блокировка на запись уже получена.
+    """
+    visit_table = Visit.__table__
+    if connection.dialect.name != 'sqlite':
+        return connection.execute(
+            insert(visit_table).returning(visit_table.c.id, sort_by_parameter_order=True),
+            rows
+        ).scalars().all()
+
+    last_id = connection.execute(select(func.max(visit_table.c.id))).scalar() or 0
+    visit_ids = list(range(last_id + 1, last_id + 1 + len(rows)))
+    for visit_id, row in zip(visit_ids, rows):
+        row['id'] = visit_id
+    connection.execute(insert(visit_table), rows)
+    return visit_ids
+
+class ImportErrors:
+    """Ошибки загрузки с ограниченным хранением
+
+    append((номер строки, ошибка)) считает каждую ошибку, но хранит не
+    больше limit - с наименьшими номерами строк (куча по убыванию номера).
+    """
+
+    def __init__(self, limit=MAX_REPORTED_ERRORS):
+        self.limit = limit
+        self.count = 0
+        self._heap = []
+
+    def append(self, item):
+        number, error = item
+        self.count += 1
+        if len(self._heap) < self.limit:
+            heapq.heappush(self._heap, (-number, error))
+        elif number < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, (-number, error))
+
+    def report(self):
+        return [{'line': -number, 'error': error} for number, error in sorted(self._heap, reverse=True)]
+
+def insert_batch(batch, errors, touched):
+    """Проверка и вставка пачки [(строка, визит, лекарства)]; число вставленных
+
+    В touched добавляются имена затронутых недель расписания врачей.
+    """
+    connection = db.session.connection()
+    patients = existing_ids(connection, Patient.id, {row['patient_id'] for _, row, _ in batch})
+    doctors = existing_ids(connection, Doctor.id, {row['doctor_id'] for _, row, _ in batch})
+    medicines = existing_ids(connection, Medicine.id, {m for _, _, ids in batch for m in ids})
+
+    valid = []
+    for number, row, medicine_ids in batch:
+        if row['patient_id'] not in patients:
+            errors.append((number, f"Пациент {row['patient_id']} не найден"))
+        elif row['doctor_id'] not in doctors:
+            errors.append((number, f"Врач {row['doctor_id']} не найден"))
+        elif any(m not in medicines for m in medicine_ids):
+            missing = sorted(set(medicine_ids) - medicines)
+            errors.append((number, f"Лекарства не найдены: {missing}"))
+        else:
+            valid.append((row, medicine_ids))
+    if not valid:
+        return 0
+
+    # Счетчики обновляются первыми: в SQLite первая запись в транзакции
+    # берет блокировку на запись, после чего MAX(id) не может устареть
+    increment_visit_counters(connection, [row for row, _ in valid])
+    visit_ids = insert_visits(connection, [row for row, _ in valid])
+    log_changes(connection, 'visit', visit_ids)
+    prescriptions = [
+        {'visit_id': visit_id, 'medicine_id': medicine_id}
+        for visit_id, (_, medicine_ids) in zip(visit_ids, valid)
+        for medicine_id in medicine_ids
+    ]
+    if prescriptions:
+        connection.execute(insert(Prescription.__table__), prescriptions)
+    track(db.session, [row for row, _ in valid])
+    db.session.commit()
+    touched.update(schedule_cache_name(row['doctor_id'], row['date']) for row, _ in valid)
+    return len(valid)
+
+def import_visits(records, batch_size=BATCH_SIZE):
+    """Загрузка записей из read_ndjson/read_csv, возвращает отчет"""
+    inserted = 0
+    errors = ImportErrors()
+    batch = []
+    touched = set()
+    try:
+        for number, record, error in records:
+            if error is None:
+                try:
+                    row, medicine_ids = parse_visit(record)
+                    batch.append((number, row, medicine_ids))
+                except (TypeError, ValueError) as e:
+                    error = str(e)
+            if error is not None:
+                errors.append((number, error))
+            if len(batch) >= batch_size:
+                inserted += insert_batch(batch, errors, touched)
+                batch = []
+        if batch:
+            inserted += insert_batch(batch, errors, touched)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if inserted:
+            invalidate('visit', *touched)
+
+    return {
+        'inserted': inserted,
+        'failed': errors.count,
+        'errors': errors.report()
+    }
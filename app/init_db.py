@@ -3,9 +3,42 @@
 Скрипт для инициализации базы данных с тестовыми данными
 """
 
+import argparse
+import random
+import time
 from app import app, db, User, Patient, Doctor, Medicine, Visit, Prescription
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, insert, select
 from werkzeug.security import generate_password_hash
+from migrations import migrate, reset
+
+# Справочники для синтетических данных: (значение, относительная частота)
+MALE_SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев',
+                 'Соколов', 'Михайлов', 'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев',
+                 'Лебедев', 'Семенов', 'Егоров', 'Павлов', 'Козлов', 'Степанов']
+MALE_NAMES = ['Александр', 'Сергей', 'Дмитрий', 'Андрей', 'Алексей', 'Максим', 'Иван',
+              'Михаил', 'Николай', 'Петр', 'Владимир', 'Евгений']
+FEMALE_NAMES = ['Елена', 'Ольга', 'Наталья', 'Татьяна', 'Анна', 'Мария', 'Ирина',
+                'Светлана', 'Екатерина', 'Юлия', 'Анастасия', 'Марина']
+PATRONYMICS = ['Александров', 'Сергеев', 'Дмитриев', 'Андреев', 'Алексеев', 'Иванов',
+               'Михайлов', 'Николаев', 'Петров', 'Владимиров']
+STREETS = ['Ленина', 'Пушкина', 'Гагарина', 'Мира', 'Садовая', 'Лесная', 'Школьная',
+           'Советская', 'Молодежная', 'Центральная', 'Набережная', 'Полевая']
+LOCATIONS = [('Поликлиника №1, кабинет 205', 30), ('Поликлиника №1, кабинет 210', 25),
+             ('Поликлиника №2, кабинет 101', 20), ('Поликлиника №2, кабинет 115', 15),
+             ('Домашний визит', 10)]
+# Частота диагнозов в холодный (октябрь-март) и теплый сезоны
+DIAGNOSES = [('ОРВИ', 30, 12), ('Грипп', 10, 1), ('Ангина', 8, 4), ('Бронхит', 8, 3),
+             ('Пневмония', 2, 1), ('Отит', 4, 3), ('Аллергическая реакция', 3, 10),
+             ('Головная боль напряжения', 5, 6), ('Мигрень', 3, 4), ('Гипертония', 8, 9),
+             ('Гастрит', 5, 6), ('Остеохондроз', 6, 8), ('Дерматит', 2, 5),
+             ('Кишечная инфекция', 2, 6), ('Конъюнктивит', 3, 4)]
+MEDICINE_NAMES = ['Парацетамол', 'Ибупрофен', 'Амоксициллин', 'Лоратадин', 'Азитромицин',
+                  'Омепразол', 'Цетиризин', 'Амлодипин', 'Лизиноприл', 'Диклофенак',
+                  'Нимесулид', 'Амброксол', 'Ацетилцистеин', 'Метформин', 'Дротаверин']
+# Число назначенных лекарств на визит
+PRESCRIPTION_COUNTS = [(0, 25), (1, 40), (2, 20), (3, 10), (4, 5)]
+SYNTHETIC_BATCH = 50000
 
 def init_database():
     """Инициализация базы данных с тестовыми данными"""
@@ -14,6 +47,8 @@ def init_database():
         # Очистка существующих данных
         db.drop_all()
         db.create_all()
+        reset(db.engine)
+        migrate(db.engine)
         
         print("Создание тестовых данных...")
         
@@ -198,6 +233,7 @@ def init_database():
         
         db.session.commit()
         print("Визиты и рецепты созданы")
+        rebuild_patient_sets()
         
         print("\n=== ТЕСТОВЫЕ ДАННЫЕ СОЗДАНЫ ===")
         print(f"Пользователей: {len(users)}")
@@ -216,5 +252,218 @@ def init_database():
         print("  Права: Пациенты, визиты, лекарства")
         print("\nДля запуска приложения выполните: python app.py")
 
+def rebuild_patient_sets(log=print):
+    """Множества пациентов для подсчета по диагнозу, дате и врачу (нужен Redis)"""
+    import redis
+    import cardinality
+    try:
+        cardinality.rebuild()
+        log("Множества пациентов пересчитаны")
+    except redis.RedisError as e:
+        log(f"Redis недоступен ({e}), множества пациентов не пересчитаны: "
+            f"после запуска Redis выполните flask --app app rebuild-counters")
+
+def weighted(pairs):
+    """Значения и накопленные веса для random.choices"""
+    values, cum_weights, total = [], [], 0
+    for value, weight in pairs:
+        total += weight
+        values.append(value)
+        cum_weights.append(total)
+    return values, cum_weights
+
+def batches(total, size):
+    """Границы пачек [start, stop) для total записей"""
+    for start in range(0, total, size):
+        yield start, min(start + size, total)
+
+def synthetic_person(rnd, female):
+    """Случайные ФИО с согласованным полом"""
+    surname = rnd.choice(MALE_SURNAMES)
+    patronymic = rnd.choice(PATRONYMICS)
+    if female:
+        return f'{surname}а {rnd.choice(FEMALE_NAMES)} {patronymic}на'
+    return f'{surname} {rnd.choice(MALE_NAMES)} {patronymic}ич'
+
+def visit_days(end, days):
+    """Даты визитов и их веса: будни загружены сильнее выходных,
+    зимой визитов больше, чем летом, поток постепенно растет"""
+    start = end - timedelta(days=days - 1)
+    weekday_load = [1.0, 1.0, 1.0, 1.0, 0.9, 0.4, 0.15]
+    month_load = [1.3, 1.3, 1.2, 1.0, 0.9, 0.8, 0.7, 0.75, 0.95, 1.1, 1.2, 1.3]
+    return weighted(
+        (day, weekday_load[day.weekday()] * month_load[day.month - 1] * (1 + 0.3 * i / days))
+        for i, day in enumerate(start + timedelta(days=i) for i in range(days)))
+
+def generate_data(patients=0, doctors=0, medicines=0, visits=0, seed=42,
+                  end=None, days=3 * 365, batch_size=SYNTHETIC_BATCH, log=print):
+    """Массовое добавление синтетических данных поверх уже созданной базы.
+
+    Данные детерминированы при одинаковых seed и end. Запись идет пачками
+    Core INSERT (executemany), каждая пачка в своей транзакции; счетчики
+    визитов пересчитываются один раз в конце."""
+    import utils
+
+    if visits and days < 1:
+        raise ValueError('Период визитов должен быть не меньше дня')
+    rnd = random.Random(seed)
+    end = end or date.today()
+    started = time.time()
+
+    def last_id(connection, model):
+        return connection.execute(select(func.max(model.id))).scalar() or 0
+
+    def write(model, rows):
+        with db.engine.begin() as connection:
+            connection.execute(insert(model.__table__), rows)
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            first_patient = last_id(connection, Patient) + 1
+            first_doctor = last_id(connection, Doctor) + 1
+            first_medicine = last_id(connection, Medicine) + 1
+            first_visit = last_id(connection, Visit) + 1
+
+        for start, stop in batches(patients, batch_size):
+            rows = []
+            for i in range(start, stop):
+                female = rnd.random() < 0.54
+                rows.append({
+                    'id': first_patient + i,
+                    'name': synthetic_person(rnd, female),
+                    'gender': 'Женский' if female else 'Мужской',
+                    'birth_date': end - timedelta(days=int(365.25 * rnd.triangular(1, 95, 45))),
+                    'address': f'г. Москва, ул. {rnd.choice(STREETS)}, д. {rnd.randint(1, 200)}, '
+                               f'кв. {rnd.randint(1, 300)}'
+                })
+            write(Patient, rows)
+        if patients:
+            log(f"Пациентов добавлено: {patients}")
+
+        if doctors:
+            write(Doctor, [{'id': first_doctor + i, 'name': synthetic_person(rnd, rnd.random() < 0.6)}
+                           for i in range(doctors)])
+            log(f"Врачей добавлено: {doctors}")
+
+        if medicines:
+            write(Medicine, [{
+                'id': first_medicine + i,
+                'name': f'{MEDICINE_NAMES[i % len(MEDICINE_NAMES)]} {(i // len(MEDICINE_NAMES) + 1) * 50} мг',
+                'usage_method': f'По 1 таблетке {rnd.randint(1, 3)} раза в день',
+                'description': 'Синтетическое описание препарата',
+                'side_effects': 'Возможны аллергические реакции, тошнота'
+            } for i in range(medicines)])
+            log(f"Лекарств добавлено: {medicines}")
+
+        if visits:
+            with db.engine.connect() as connection:
+                patient_total = last_id(connection, Patient)
+                doctor_total = last_id(connection, Doctor)
+                medicine_total = last_id(connection, Medicine)
+            if not (patient_total and doctor_total):
+                raise ValueError('Для визитов нужны пациенты и врачи')
+
+            day_values, day_weights = visit_days(end, days)
+            location_values, location_weights = weighted(LOCATIONS)
+            cold = weighted((name, weight) for name, weight, _ in DIAGNOSES)
+            warm = weighted((name, weight) for name, _, weight in DIAGNOSES)
+            count_values, count_weights = weighted(PRESCRIPTION_COUNTS)
+            # Нагрузка врачей неравномерна, популярность лекарств убывает по Ципфу
+            _, doctor_weights = weighted((i, rnd.uniform(0.3, 1.5)) for i in range(doctor_total))
+            _, medicine_weights = weighted((i, 1 / (i + 1) ** 0.8) for i in range(medicine_total))
+            doctor_ids = range(1, doctor_total + 1)
+            medicine_ids = range(1, medicine_total + 1)
+
+            # При большой загрузке индексы дешевле построить заново, чем обновлять на каждой строке
+            indexes = list(Visit.__table__.indexes) + list(Prescription.__table__.indexes) \
+                if visits >= first_visit else []
+            with db.engine.begin() as connection:
+                for index in indexes:
+                    index.drop(connection, checkfirst=True)
+
+            try:
+                for start, stop in batches(visits, batch_size):
+                    size = stop - start
+                    dates = rnd.choices(day_values, cum_weights=day_weights, k=size)
+                    doctors_column = rnd.choices(doctor_ids, cum_weights=doctor_weights, k=size)
+                    locations = rnd.choices(location_values, cum_weights=location_weights, k=size)
+                    counts = rnd.choices(count_values, cum_weights=count_weights, k=size) \
+                        if medicine_total else [0] * size
+                    visit_rows, prescription_rows = [], []
+                    for i in range(size):
+                        visit_id = first_visit + start + i
+                        day = dates[i]
+                        diagnoses, weights = cold if day.month in (10, 11, 12, 1, 2, 3) else warm
+                        visit_rows.append({
+                            'id': visit_id,
+                            'date': day,
+                            'location': locations[i],
+                            'symptoms': 'Жалобы со слов пациента',
+                            'diagnosis': rnd.choices(diagnoses, cum_weights=weights)[0],
+                            'prescriptions_text': 'Лечение по назначению врача',
+                            # Часть пациентов обращается заметно чаще остальных
+                            'patient_id': 1 + int(patient_total * rnd.random() ** 2),
+                            'doctor_id': doctors_column[i]
+                        })
+                        if counts[i]:
+                            for medicine_id in set(rnd.choices(medicine_ids, cum_weights=medicine_weights,
+                                                               k=counts[i])):
+                                prescription_rows.append({'visit_id': visit_id, 'medicine_id': medicine_id})
+                    with db.engine.begin() as connection:
+                        connection.execute(insert(Visit.__table__), visit_rows)
+                        if prescription_rows:
+                            connection.execute(insert(Prescription.__table__), prescription_rows)
+                    log(f"Визитов добавлено: {stop} из {visits} ({time.time() - started:.0f} с)")
+
+            finally:
+                # Индексы восстанавливаются и когда загрузка прервалась ошибкой
+                if indexes:
+                    with db.engine.begin() as connection:
+                        for index in indexes:
+                            index.create(connection, checkfirst=True)
+                    log(f"Индексы перестроены ({time.time() - started:.0f} с)")
+
+            utils.rebuild_visit_counters()
+            log("Счетчики визитов пересчитаны")
+            rebuild_patient_sets(log)
+
+        # Клиенты со старым курсором изменений загрузят эти таблицы заново
+        generated = [entity for entity, count in (('patient', patients), ('doctor', doctors),
+                                                  ('medicine', medicines), ('visit', visits)) if count]
+        if generated:
+            with db.engine.begin() as connection:
+                for entity in generated:
+                    utils.log_changes(connection, entity, [None])
+
+        log(f"Синтетические данные созданы за {time.time() - started:.1f} с")
+
+def parse_count(value):
+    """Количество записей, допускается запись вида 1e6"""
+    count = int(float(value))
+    if count < 0:
+        raise argparse.ArgumentTypeError('количество не может быть отрицательным')
+    return count
+
+def parse_positive(value):
+    """Количество больше нуля"""
+    count = parse_count(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError('значение должно быть больше нуля')
+    return count
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Инициализация базы данных')
+    parser.add_argument('--patients', type=parse_count, default=0, help='добавить синтетических пациентов')
+    parser.add_argument('--doctors', type=parse_count, default=0, help='добавить синтетических врачей')
+    parser.add_argument('--medicines', type=parse_count, default=0, help='добавить синтетических лекарств')
+    parser.add_argument('--visits', type=parse_count, default=0, help='добавить синтетических визитов')
+    parser.add_argument('--seed', type=int, default=42, help='зерно генератора')
+    parser.add_argument('--end', type=date.fromisoformat, help='последний день визитов (по умолчанию сегодня)')
+    parser.add_argument('--days', type=parse_positive, default=3 * 365, help='за сколько дней генерировать визиты')
+    parser.add_argument('--batch-size', type=parse_positive, default=SYNTHETIC_BATCH)
+    args = parser.parse_args()
+
     init_database()
+    if args.patients or args.doctors or args.medicines or args.visits:
+        generate_data(args.patients, args.doctors, args.medicines, args.visits, seed=args.seed,
+                      end=args.end, days=args.days, batch_size=args.batch_size)
@@ -0,0 +1,380 @@
+"""
+Фоновые задачи с очередью в Redis
+
+POST /api/jobs кладет задачу в список jobs:queue, отдельный процесс
+worker.py забирает ее в jobs:processing (RPOPLPUSH вместе с отметкой
+heartbeat в одном Lua-скрипте), выполняет и
+сохраняет результат в список job:<id>:result на JOB_RESULT_TTL секунд.
+Результат пишется кусками (RPUSH по мере выполнения), поэтому выгрузка
+любого размера не собирается целиком ни в памяти воркера, ни в одной
+строке Redis, и отдается клиенту потоком.
+Состояние задачи (статус, прогресс, попытки, ошибка) - хэш job:<id>.
+
+Упавшая задача повторяется до JOB_MAX_ATTEMPTS раз с растущей паузой
+(через jobs:delayed). Задача, чей воркер перестал отмечаться дольше
+JOB_STALE_AFTER секунд, считается упавшей попыткой и тоже повторяется.
+
+Между задачами воркер раз в CHANGE_LOG_PRUNE_INTERVAL секунд чистит
+журнал изменений (utils.prune_changes).
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from datetime import date, datetime
+import redis
+
+QUEUE = 'jobs:queue'
+PROCESSING = 'jobs:processing'
+DELAYED = 'jobs:delayed'
+JOB_PREFIX = 'job:'
+HEARTBEAT_INTERVAL = 5
+PROGRESS_INTERVAL = 0.5
+# Кусков результата за одно чтение LRANGE при отдаче клиенту
+RESULT_READ_BATCH = 16
+
+# Перенос задачи из очереди в jobs:processing и отметка heartbeat атомарно:
+# requeue_stale другого воркера не застанет взятую задачу без отметки
+CLAIM = """
+local job_id = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if job_id then
+    redis.call('HSET', ARGV[2] .. job_id, 'heartbeat', ARGV[1])
+end
+return job_id
+"""
+
+# Типы задач: имя -> (проверка параметров, выполнение, только администратору)
+JOB_TYPES = {}
+
+def job_type(name, validate, admin_only=False):
+    """Регистрация типа задачи"""
+    def register(run):
+        JOB_TYPES[name] = (validate, run, admin_only)
+        return run
+    return register
+
+def _key(job_id):
+    return JOB_PREFIX + job_id
+
+def _period(params):
+    try:
+        start_date = date.fromisoformat(params['from'])
+        end_date = date.fromisoformat(params['to'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Укажите период: from и to в формате YYYY-MM-DD')
+    if start_date > end_date:
+        raise ValueError('Начало периода позже конца')
+    return start_date, end_date
+
+def validate_export(params):
+    start_date, end_date = _period(params)
+    return {'from': start_date.isoformat(), 'to': end_date.isoformat()}
+
+def validate_series(params):
+    from utils import ANALYTICS_GROUPS
+    start_date, end_date = _period(params)
+    granularity = params.get('granularity', 'day')
+    if granularity not in ('day', 'week', 'month'):
+        raise ValueError('granularity: day, week или month')
+    group_by = params.get('group_by') or []
+    if isinstance(group_by, str):
+        group_by = [g for g in group_by.split(',') if g]
+    if any(g not in ANALYTICS_GROUPS for g in group_by):
+        raise ValueError(f"group_by: {', '.join(ANALYTICS_GROUPS)}")
+    return {'from': start_date.isoformat(), 'to': end_date.isoformat(),
+            'granularity': granularity, 'group_by': group_by}
+
+@job_type('visits_export', validate_export)
+def run_export(params, progress):
+    """CSV визитов за период - кусками по мере выборки"""
+    from sqlalchemy import func
+    from app import db, Visit
+    from utils import STREAM_CHUNK_SIZE, iter_visits_csv
+
+    start_date, end_date = _period(params)
+    total = db.session.query(func.count(Visit.id)).filter(
+        Visit.date >= start_date, Visit.date <= end_date).scalar()
+
+    def chunks():
+        for number, chunk in enumerate(iter_visits_csv(start_date, end_date), 1):
+            progress(min(number * STREAM_CHUNK_SIZE, total), total)
+            yield chunk
+
+    filename = f"visits_{params['from']}_{params['to']}.csv"
+    return chunks(), 'text/csv', filename
+
+@job_type('visit_series', validate_series)
+def run_series(params, progress):
+    """Ряд числа визитов, как /api/analytics/visits"""
+    from utils import get_visit_series
+
+    start_date, end_date = _period(params)
+    series = get_visit_series(start_date, end_date, params['granularity'], params['group_by'])
+    return dict(params, series=series), 'application/json', None
+
+@job_type('rebuild_counters', lambda params: {}, admin_only=True)
+def run_rebuild(params, progress):
+    """Пересчет счетчиков, суточных сводок визитов и множеств пациентов"""
+    import cardinality
+    from cache import invalidate
+    from utils import rebuild_visit_counters
+
+    rebuild_visit_counters()
+    cardinality.rebuild()
+    invalidate('visit')
+    return {'message': 'Счетчики визитов пересчитаны'}, 'application/json', None
+
+def enqueue(name, params, user_id):
+    """Проверка параметров и постановка задачи в очередь; ValueError при ошибке"""
+    from app import app, redis_client
+
+    validate, _, _ = JOB_TYPES[name]
+    params = validate(params or {})
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'type': name,
+        'params': json.dumps(params),
+        'status': 'queued',
+        'progress': 0,
+        'attempts': 0,
+        'user_id': user_id,
+        'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    }
+    pipe = redis_client.pipeline()
+    pipe.hset(_key(job_id), mapping=job)
+    # Задачу, которую так и не взяли, тоже не храним вечно
+    pipe.expire(_key(job_id), app.config['JOB_RESULT_TTL'] * 7)
+    pipe.lpush(QUEUE, job_id)
+    pipe.execute()
+    return describe(job)
+
+def describe(job):
+    """Состояние задачи для API"""
+    info = {
+        'id': job['id'],
+        'type': job['type'],
+        'params': json.loads(job['params']),
+        'status': job['status'],
+        'progress': int(job.get('progress', 0)),
+        'attempts': int(job.get('attempts', 0)),
+        'created': job.get('created'),
+        'started': job.get('started'),
+        'finished': job.get('finished'),
+        'error': job.get('error')
+    }
+    if job['status'] == 'done':
+        info['result_url'] = f"/api/jobs/{job['id']}/result"
+    return info
+
+def get_job(job_id):
+    """Хэш задачи или None"""
+    from app import redis_client
+    return redis_client.hgetall(_key(job_id)) or None
+
+def _store_result(job_id, chunks):
+    """Запись кусков результата во временный список job:<id>:result:partial
+
+    Список живет JOB_RESULT_TTL и становится результатом (RENAME) только
+    после успешного завершения задачи; повторная попытка начинает заново.
+    """
+    from app import app, redis_client
+
+    partial = _key(job_id) + ':result:partial'
+    redis_client.delete(partial)
+    stored = False
+    for chunk in chunks:
+        if chunk:
+            pipe = redis_client.pipeline()
+            pipe.rpush(partial, chunk)
+            pipe.expire(partial, app.config['JOB_RESULT_TTL'])
+            pipe.execute()
+            stored = True
+    if not stored:
+        redis_client.rpush(partial, '')
+    return partial
+
+def get_result(job_id):
+    """Куски результата готовой задачи (генератор) или None, если его нет или он истек"""
+    from app import redis_client
+
+    key = _key(job_id) + ':result'
+    if not redis_client.exists(key):
+        return None
+
+    def chunks():
+        start = 0
+        while True:
+            batch = redis_client.lrange(key, start, start + RESULT_READ_BATCH - 1)
+            yield from batch
+            if len(batch) < RESULT_READ_BATCH:
+                return
+            start += RESULT_READ_BATCH
+    return chunks()
+
+def _fail(job_id, attempts, error):
+    """Неудачная попытка: повтор с паузой или окончательная ошибка"""
+    from app import app, redis_client
+
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.lrem(PROCESSING, 0, job_id)
+    if attempts < app.config['JOB_MAX_ATTEMPTS']:
+        pipe.hset(_key(job_id), mapping={'status': 'queued', 'error': error})
+        pipe.zadd(DELAYED, {job_id: now + app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1)})
+    else:
+        pipe.hset(_key(job_id), mapping={'status': 'failed', 'error': error,
+                                         'finished': datetime.utcnow().isoformat(timespec='seconds') + 'Z'})
+        pipe.expire(_key(job_id), app.config['JOB_RESULT_TTL'])
+    pipe.execute()
+
+def claim():
+    """Взять задачу из очереди в jobs:processing; None, если очередь пуста"""
+    from app import redis_client
+
+    script = redis_client.register_script(CLAIM)
+    return script(keys=[QUEUE, PROCESSING], args=[time.time(), JOB_PREFIX])
+
+def process(job_id):
+    """Выполнение одной задачи, уже перенесенной в jobs:processing"""
+    from app import app, db, redis_client
+
+    key = _key(job_id)
+    job = redis_client.hgetall(key)
+    if not job or job['type'] not in JOB_TYPES:
+        redis_client.lrem(PROCESSING, 0, job_id)
+        return
+    attempts = redis_client.hincrby(key, 'attempts', 1)
+    redis_client.hset(key, mapping={'status': 'running', 'heartbeat': time.time(),
+                                    'started': datetime.utcnow().isoformat(timespec='seconds') + 'Z'})
+    last_report = [0.0]
+
+    def progress(done, total):
+        now = time.time()
+        if total and now - last_report[0] >= PROGRESS_INTERVAL:
+            last_report[0] = now
+            redis_client.hset(key, mapping={'progress': min(99, int(done * 100 / total)), 'heartbeat': now})
+
+    _, run, _ = JOB_TYPES[job['type']]
+    try:
+        with app.app_context():
+            try:
+                # Результат - строка, объект JSON или итератор кусков текста
+                result, mimetype, filename = run(json.loads(job['params']), progress)
+                if mimetype == 'application/json':
+                    result = app.json.dumps(result)
+                partial = _store_result(job_id, [result] if isinstance(result, str) else result)
+            finally:
+                db.session.remove()
+    except Exception as e:
+        app.logger.error('Задача %s (%s) упала:\n%s', job_id, job['type'], traceback.format_exc())
+        _fail(job_id, attempts, str(e) or e.__class__.__name__)
+        return
+
+    ttl = app.config['JOB_RESULT_TTL']
+    pipe = redis_client.pipeline()
+    pipe.rename(partial, key + ':result')
+    pipe.expire(key + ':result', ttl)
+    pipe.hset(key, mapping={'status': 'done', 'progress': 100, 'error': '', 'result_type': mimetype,
+                            'filename': filename or '',
+                            'finished': datetime.utcnow().isoformat(timespec='seconds') + 'Z'})
+    pipe.expire(key, ttl)
+    pipe.lrem(PROCESSING, 0, job_id)
+    pipe.execute()
+
+def promote_delayed():
+    """Перенос задач, чья пауза перед повтором истекла, обратно в очередь"""
+    from app import redis_client
+
+    for job_id in redis_client.zrangebyscore(DELAYED, 0, time.time()):
+        # Задачу переносит тот воркер, который успел ее удалить
+        if redis_client.zrem(DELAYED, job_id):
+            redis_client.lpush(QUEUE, job_id)
+
+def requeue_stale():
+    """Задачи воркеров, которые перестали отмечаться, считаются упавшими"""
+    from app import app, redis_client
+
+    oldest = time.time() - app.config['JOB_STALE_AFTER']
+    for job_id in redis_client.lrange(PROCESSING, 0, -1):
+        job = redis_client.hgetall(_key(job_id))
+        if not job:
+            redis_client.lrem(PROCESSING, 0, job_id)
+        elif float(job.get('heartbeat') or 0) < oldest:
+            _fail(job_id, int(job.get('attempts', 0)), 'Воркер перестал отвечать')
+
+def _heartbeat(current, stop):
+    """Отметка о том, что выполняемая задача жива"""
+    from app import redis_client
+
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        job_id = current.get('id')
+        if job_id:
+            try:
+                redis_client.hset(_key(job_id), 'heartbeat', time.time())
+            except redis.RedisError:
+                pass
+
+def prune_change_log():
+    """Очистка журнала изменений; ошибка базы не останавливает воркер"""
+    from sqlalchemy.exc import SQLAlchemyError
+    from app import app, db
+    from utils import prune_changes
+
+    with app.app_context():
+        try:
+            deleted = prune_changes()
+        except SQLAlchemyError as e:
+            app.logger.warning('Журнал изменений не очищен: %s', e)
+            return
+        finally:
+            db.session.remove()
+    if deleted:
+        app.logger.info('Из журнала изменений удалено записей: %s', deleted)
+
+def run_worker(once=False):
+    """Цикл воркера; once=True - выполнить задачи из очереди и выйти"""
+    from app import app
+
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    app.logger.info('Воркер задач %s запущен', name)
+    current = {}
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(current, stop), daemon=True).start()
+    last_check = 0
+    last_prune = 0
+    try:
+        while True:
+            if time.time() - last_prune >= app.config['CHANGE_LOG_PRUNE_INTERVAL']:
+                prune_change_log()
+                last_prune = time.time()
+            try:
+                now = time.time()
+                if now - last_check >= app.config['JOB_STALE_AFTER'] / 2:
+                    requeue_stale()
+                    last_check = now
+                promote_delayed()
+                job_id = claim()
+            except redis.RedisError as e:
+                app.logger.warning('Очередь задач недоступна: %s', e)
+                time.sleep(app.config['JOB_POLL_INTERVAL'] * 10)
+                continue
+            if job_id is None:
+                if once:
+                    return
+                time.sleep(app.config['JOB_POLL_INTERVAL'])
+                continue
+            current['id'] = job_id
+            try:
+                process(job_id)
+            except redis.RedisError as e:
+                # Задача останется в jobs:processing и вернется в очередь через requeue_stale
+                app.logger.warning('Очередь задач недоступна: %s', e)
+            finally:
+                current['id'] = None
+    finally:
+        stop.set()
@@ -0,0 +1,199 @@
+"""
+Метрики запросов в формате Prometheus
+
+Для каждого маршрута считаются гистограмма задержек, число и суммарное
+время SQL-запросов, объем ответа и число обращений к Redis. Данные
+собираются в памяти процесса (у каждого воркера свои) и отдаются
+текстом на /metrics. Запросы дольше SLOW_REQUEST_MS пишутся в лог
+одной JSON-строкой.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+import redis
+from sqlalchemy import event
+
+# Границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = defaultdict(lambda: {
+    'buckets': [0] * len(LATENCY_BUCKETS),
+    'count': 0,
+    'seconds': 0.0,
+    'sql_statements': 0,
+    'sql_seconds': 0.0,
+    'response_bytes': 0,
+    'redis_calls': 0,
+    'statuses': defaultdict(int)
+})
+
+class RequestStats:
+    """Счетчики текущего запроса"""
+
+    __slots__ = ('started', 'sql_statements', 'sql_seconds', 'redis_calls', 'response_bytes', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.redis_calls = 0
+        self.response_bytes = 0
+        # Список для сохранения текстов SQL; включается профилированием
+        self.statements = None
+
+def current():
+    """Счетчики запроса, который обслуживает текущий поток, или None"""
+    return getattr(_local, 'stats', None)
+
+class CountingConnection(redis.Connection):
+    """Соединение Redis, считающее обращения к серверу в рамках запроса
+
+    Конвейер отправляется одним пакетом и считается одним обращением.
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        stats = current()
+        if stats is not None:
+            stats.redis_calls += 1
+        return super().send_packed_command(command, check_health)
+
+def instrument_engine(engine):
+    """Учет числа и времени SQL-запросов текущего запроса"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finish_statement(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        stats = current()
+        if stats is not None:
+            elapsed = time.perf_counter() - started
+            stats.sql_statements += 1
+            stats.sql_seconds += elapsed
+            if stats.statements is not None:
+                stats.statements.append((statement, parameters, executemany, elapsed))
+
+def _count_bytes(chunks, stats):
+    """Подсчет объема потокового ответа по мере отдачи"""
+    for chunk in chunks:
+        stats.response_bytes += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        yield chunk
+
+def init_app(app, engine):
+    """Подключение учета к приложению и движку базы"""
+    from flask import request, session
+
+    instrument_engine(engine)
+
+    @app.before_request
+    def start_request():
+        _local.stats = RequestStats()
+
+    @app.after_request
+    def finish_request(response):
+        stats = current()
+        if stats is None:
+            return response
+        method = request.method
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = response.status_code
+        user_id = session.get('user_id')
+        path = request.full_path.rstrip('?')
+
+        def record():
+            _local.stats = None
+            duration = time.perf_counter() - stats.started
+            observe(method, rule, status, duration, stats)
+            threshold = app.config['SLOW_REQUEST_MS']
+            if threshold and duration * 1000 >= threshold:
+                app.logger.warning(json.dumps({
+                    'event': 'slow_request',
+                    'method': method,
+                    'path': path,
+                    'endpoint': rule,
+                    'status': status,
+                    'duration_ms': round(duration * 1000, 1),
+                    'sql_statements': stats.sql_statements,
+                    'sql_ms': round(stats.sql_seconds * 1000, 1),
+                    'redis_calls': stats.redis_calls,
+                    'response_bytes': stats.response_bytes,
+                    'user_id': user_id
+                }, ensure_ascii=False))
+
+        # Потоковый ответ отдается после after_request, поэтому его итог
+        # фиксируется при закрытии ответа
+        if response.is_streamed:
+            response.response = _count_bytes(response.response, stats)
+            response.call_on_close(record)
+        else:
+            stats.response_bytes = response.calculate_content_length() or 0
+            record()
+        return response
+
+def observe(method, endpoint, status, duration, stats):
+    """Добавление завершенного запроса в метрики маршрута"""
+    with _lock:
+        metric = _endpoints[(method, endpoint)]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                metric['buckets'][i] += 1
+                break
+        metric['count'] += 1
+        metric['seconds'] += duration
+        metric['sql_statements'] += stats.sql_statements
+        metric['sql_seconds'] += stats.sql_seconds
+        metric['response_bytes'] += stats.response_bytes
+        metric['redis_calls'] += stats.redis_calls
+        metric['statuses'][status] += 1
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels.items())
+
+def render():
+    """Метрики в текстовом формате Prometheus"""
+    with _lock:
+        snapshot = {key: dict(metric, buckets=list(metric['buckets']), statuses=dict(metric['statuses']))
+                    for key, metric in _endpoints.items()}
+
+    lines = [
+        '# HELP http_request_duration_seconds Длительность обработки запроса',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    for (method, endpoint), metric in sorted(snapshot.items()):
+        labels = _labels(method=method, endpoint=endpoint)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, metric['buckets']):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metric["count"]}')
+        lines.append(f'http_request_duration_seconds_sum{{{labels}}} {metric["seconds"]:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{{labels}}} {metric["count"]}')
+
+    lines += [
+        '# HELP http_requests_total Число запросов по кодам ответа',
+        '# TYPE http_requests_total counter'
+    ]
+    for (method, endpoint), metric in sorted(snapshot.items()):
+        for status, count in sorted(metric['statuses'].items()):
+            lines.append(f'http_requests_total{{{_labels(method=method, endpoint=endpoint, status=status)}}} {count}')
+
+    totals = [
+        ('http_request_sql_statements_total', 'sql_statements', 'Число SQL-запросов'),
+        ('http_request_sql_seconds_total', 'sql_seconds', 'Суммарное время SQL-запросов'),
+        ('http_response_bytes_total', 'response_bytes', 'Суммарный объем ответов'),
+        ('http_request_redis_calls_total', 'redis_calls', 'Число обращений к Redis')
+    ]
+    for name, key, help_text in totals:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (method, endpoint), metric in sorted(snapshot.items()):
+            value = metric[key]
+            value = f'{value:.6f}' if isinstance(value, float) else value
+            lines.append(f'{name}{{{_labels(method=method, endpoint=endpoint)}}} {value}')
+    return '\n'.join(lines) + '\n'
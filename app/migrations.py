@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Версионные миграции схемы базы данных
+
+db.create_all() создает только отсутствующие таблицы и не трогает
+существующие, поэтому индексы и прочие изменения схемы для уже
+работающих баз применяются отсюда. Каждая миграция выполняется один раз,
+примененные версии записываются в таблицу schema_migrations. Миграции
+применяются под монопольной блокировкой схемы (schema_lock), поэтому
+одновременно стартующие процессы не мешают друг другу.
+
+Запуск вручную:
+    python migrations.py           - применить недостающие миграции
+    python migrations.py --check   - проверить планы запросов utils
+"""
+
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# Блокировка схемы на время миграций: ключ advisory-блокировки PostgreSQL
+# и предельное ожидание, пока миграции применяет другой процесс, секунд
+MIGRATION_LOCK_KEY = 7301
+MIGRATION_LOCK_TIMEOUT = 600
+# Пауза между попытками взять блокировку схемы SQLite, с
+MIGRATION_LOCK_RETRY = 0.1
+
+# Пересчет счетчиков визитов по дате и диагнозу (VisitCounter)
+REBUILD_VISIT_COUNTERS = [
+    'DELETE FROM visit_counter',
+    "INSERT INTO visit_counter (dimension, value, count) "
+    "SELECT 'date', CAST(date AS VARCHAR), COUNT(*) FROM visit GROUP BY date",
+    "INSERT INTO visit_counter (dimension, value, count) "
+    "SELECT 'diagnosis', diagnosis, COUNT(*) FROM visit GROUP BY diagnosis",
+]
+
+# Пересчет суточной сводки визитов (VisitDaily)
+REBUILD_VISIT_DAILY = [
+    'DELETE FROM visit_daily',
+    'INSERT INTO visit_daily (day, doctor_id, diagnosis, location, count) '
+    'SELECT date, doctor_id, diagnosis, location, COUNT(*) FROM visit '
+    'GROUP BY date, doctor_id, diagnosis, location',
+]
+
+# Триграммный полнотекстовый индекс пациентов, синхронизируется триггерами
+PATIENT_FTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS patient_fts USING fts5("
+    "name, address, content='patient', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ai AFTER INSERT ON patient BEGIN "
+    "INSERT INTO patient_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_ad AFTER DELETE ON patient BEGIN "
+    "INSERT INTO patient_fts (patient_fts, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); END",
+    "CREATE TRIGGER IF NOT EXISTS patient_fts_au AFTER UPDATE ON patient BEGIN "
+    "INSERT INTO patient_fts (patient_fts, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); "
+    "INSERT INTO patient_fts (rowid, name, address) VALUES (new.id, new.name, new.address); END",
+    "INSERT INTO patient_fts (patient_fts) VALUES ('rebuild')",
+]
+
+def create_patient_search_index(connection):
+    """Индекс поиска пациентов (FTS5 есть только в SQLite)"""
+    if connection.dialect.name != 'sqlite':
+        return
+    for statement in PATIENT_FTS:
+        connection.execute(text(statement))
+
+# (версия, описание, шаги) - шаг это SQL-строка или функция от соединения
+MIGRATIONS = [
+    (1, 'Индексы для выборок по визитам и рецептам', [
+        'CREATE INDEX IF NOT EXISTS ix_visit_date ON visit (date)',
+        'CREATE INDEX IF NOT EXISTS ix_visit_patient_date ON visit (patient_id, date)',
+        'CREATE INDEX IF NOT EXISTS ix_visit_doctor_date ON visit (doctor_id, date)',
+        'CREATE INDEX IF NOT EXISTS ix_visit_diagnosis_date ON visit (diagnosis, date)',
+        'CREATE INDEX IF NOT EXISTS ix_prescription_visit ON prescription (visit_id)',
+        'CREATE INDEX IF NOT EXISTS ix_prescription_medicine ON prescription (medicine_id)',
+    ]),
+    (2, 'Заполнение счетчиков визитов по дате и диагнозу', REBUILD_VISIT_COUNTERS),
+    (3, 'Триграммный поиск пациентов по имени и адресу', [create_patient_search_index]),
+    (4, 'Заполнение суточной сводки визитов', REBUILD_VISIT_DAILY),
+]
+
+def current_version(connection):
+    """Последняя примененная версия схемы"""
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TEXT NOT NULL)'
+    ))
+    version = connection.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar()
+    return version or 0
+
+def reset(engine):
+    """Забыть примененные миграции после пересоздания таблиц (init_db)
+
+    Все шаги идемпотентны, поэтому следующий migrate() заново создаст
+    индексы, триггеры и пересчитает производные данные.
+    """
+    with engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+
+@contextmanager
+def schema_lock(engine, timeout=MIGRATION_LOCK_TIMEOUT):
+    """Транзакция, которая монопольно держит схему до коммита
+
+    Процессы, стартующие одновременно (web и worker), иначе создают
+    таблицы и применяют миграции параллельно. SQLite - BEGIN IMMEDIATE
+    (ожидание повторяется до timeout секунд, пока другой процесс
+    применяет миграции), PostgreSQL - транзакционная advisory-блокировка.
+    """
+    with engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    connection.exec_driver_sql('BEGIN IMMEDIATE')
+                    break
+                except OperationalError as e:
+                    connection.rollback()
+                    if 'locked' not in str(e) or time.monotonic() > deadline:
+                        raise
+                    # busy_timeout уже подождал; короткая пауза, чтобы не крутить цикл
+                    time.sleep(MIGRATION_LOCK_RETRY)
+        elif connection.dialect.name == 'postgresql':
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        yield connection
+        connection.commit()
+
+def migrate(engine, metadata=None):
+    """Применение всех миграций новее текущей версии схемы
+
+    metadata - сначала создать недостающие таблицы моделей под той же
+    блокировкой.
+    """
+    applied = []
+    with schema_lock(engine) as connection:
+        if metadata is not None:
+            metadata.create_all(connection)
+        version = current_version(connection)
+        for number, description, steps in MIGRATIONS:
+            if number <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                {'version': number, 'description': description,
+                 'applied_at': datetime.utcnow().isoformat()}
+            )
+            applied.append(number)
+    return applied
+
+def explain(connection, statement, parameters):
+    """EXPLAIN QUERY PLAN для уже скомпилированного SQL"""
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+    return [row[-1] for row in rows]
+
+# Таблицы, полный просмотр которых check_query_plans считает ошибкой
+CHECKED_TABLES = ('visit', 'prescription', 'visit_counter', 'visit_daily', 'change_log')
+
+def full_scans(plan, allow_index_scan=False):
+    """Строки плана с полным просмотром таблиц CHECKED_TABLES
+
+    Агрегатам по всей таблице разрешен просмотр покрывающего индекса,
+    выборкам с условием нужен поиск (SEARCH) по индексу.
+    """
+    return [
+        line for line in plan
+        if line.startswith('SCAN ') and line.split()[1] in CHECKED_TABLES
+        and not (allow_index_scan and 'INDEX' in line)
+    ]
+
+def check_query_plans():
+    """Проверка, что выборки utils по визитам и рецептам идут по индексам
+
+    Запросы перехватываются на уровне движка во время реального вызова
+    функций utils, затем для каждого выполняется EXPLAIN QUERY PLAN.
+    Возвращает словарь {имя проверки: список строк плана с полным сканом}.
+    """
+    from datetime import date
+    from sqlalchemy import event
+    from app import app, db, VisitCounter
+    import cardinality
+    import utils
+
+    today = date.today()
+    year_start = date(today.year, 1, 1)
+    # имя: (вызов, допустим ли просмотр покрывающего индекса). Число
+    # пациентов проверяется в точном варианте: HyperLogLog в Redis SQL не выполняет
+    checks = {
+        'count_visits_by_date': (lambda: db.session.get(VisitCounter, ('date', today.isoformat())), False),
+        'count_patients_by_diagnosis': (
+            lambda: cardinality.exact_distinct_patients(year_start, today, diagnosis='ОРВИ'), False),
+        'distinct_patients_by_doctor': (lambda: cardinality.exact_distinct_patients(doctor_id=1), False),
+        'get_visit_series': (lambda: utils.get_visit_series(year_start, today), False),
+        'changes_since': (lambda: utils.changes_since('visit', 0), False),
+        'get_statistics': (utils.get_statistics, True),
+        'get_popular_diagnoses': (utils.get_popular_diagnoses, True),
+        'get_popular_medicines': (utils.get_popular_medicines, True),
+        'get_summary': (lambda: utils.get_summary(['statistics', 'popular-diagnoses', 'popular-medicines']), True),
+        'get_patient_history': (lambda: utils.get_patient_history(1), False),
+        'get_doctor_schedule': (lambda: utils.get_doctor_schedule(1, year_start, today), False),
+        'export_visits_to_csv': (lambda: utils.export_visits_to_csv(year_start, today), False),
+    }
+
+    report = {}
+    with app.app_context():
+        engine = db.engine
+        for name, (run, allow_index_scan) in checks.items():
+            captured = []
+
+            def capture(conn, cursor, statement, parameters, context, executemany):
+                captured.append((statement, parameters))
+
+            event.listen(engine, 'before_cursor_execute', capture)
+            try:
+                run()
+            finally:
+                event.remove(engine, 'before_cursor_execute', capture)
+
+            scans = []
+            with engine.connect() as connection:
+                for statement, parameters in captured:
+                    plan = explain(connection, statement, parameters)
+                    scans.extend(full_scans(plan, allow_index_scan))
+            report[name] = scans
+    return report
+
+if __name__ == '__main__':
+    import sys
+    from app import app, db
+
+    if '--check' in sys.argv:
+        failed = False
+        for name, scans in check_query_plans().items():
+            if scans:
+                failed = True
+                print(f"{name}: полный просмотр - {'; '.join(scans)}")
+            else:
+                print(f"{name}: OK")
+        sys.exit(1 if failed else 0)
+
+    with app.app_context():
+        applied = migrate(db.engine)
+    print(f"Применены миграции: {applied}" if applied else "Схема актуальна")
@@ -0,0 +1,166 @@
+"""
+Профилирование отдельного запроса по требованию администратора
+
+Запрос с параметром ?profile=1 или заголовком X-Profile: 1 от
+администратора выполняется под cProfile, его SQL-запросы сохраняются
+вместе с планами выполнения. Результат пишется в PROFILE_DIR: отчет
+<id>.json и дамп статистики <id>.prof (открывается pstats или snakeviz).
+Хранится не больше PROFILE_MAX_COUNT отчетов не старше
+PROFILE_RETENTION_HOURS часов. Обычные запросы проверяют только
+наличие флага.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+import metrics
+
+PROFILE_ID = re.compile(r'^\d{8}T\d{6}-[0-9a-f]{8}$')
+# Сколько SQL-запросов одного профиля сохранять с планами
+MAX_STATEMENTS = 200
+
+_local = threading.local()
+
+def requested(request):
+    """Есть ли в запросе флаг профилирования"""
+    return request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+
+def init_app(app, engine, is_admin):
+    """Подключение профилирования; is_admin проверяет права текущей сессии"""
+    from flask import request, session
+
+    @app.before_request
+    def start_profile():
+        stale = getattr(_local, 'profiler', None)
+        if stale is not None:
+            stale.disable()
+            _local.profiler = None
+        if not requested(request) or not is_admin():
+            return
+        stats = metrics.current()
+        stats.statements = []
+        profiler = cProfile.Profile()
+        _local.profiler = profiler
+        profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profiler = getattr(_local, 'profiler', None)
+        if profiler is None:
+            return response
+        stats = metrics.current()
+        profile_id = '{}-{}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+        meta = {
+            'id': profile_id,
+            'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.url_rule.rule if request.url_rule else None,
+            'status': response.status_code,
+            'user_id': session.get('user_id')
+        }
+
+        def save():
+            profiler.disable()
+            _local.profiler = None
+            meta['duration_ms'] = round((time.perf_counter() - stats.started) * 1000, 1)
+            statements, stats.statements = stats.statements, None
+            store(app, engine, profiler, meta, statements)
+
+        response.headers['X-Profile-Id'] = profile_id
+        # Потоковый ответ профилируется до конца отдачи
+        if response.is_streamed:
+            response.call_on_close(save)
+        else:
+            save()
+        return response
+
+def explain(engine, statement, parameters):
+    """План выполнения SELECT-запроса или None"""
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    try:
+        with engine.connect() as connection:
+            if engine.dialect.name == 'sqlite':
+                from migrations import explain as explain_sqlite
+                return explain_sqlite(connection, statement, parameters)
+            rows = connection.exec_driver_sql('EXPLAIN ' + statement, parameters)
+            return [row[0] for row in rows]
+    except Exception as e:
+        return [f'Ошибка EXPLAIN: {e}']
+
+def store(app, engine, profiler, meta, statements):
+    """Сохранение отчета и дампа статистики, удаление устаревших"""
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+
+    sql = []
+    for statement, parameters, executemany, elapsed in statements[:MAX_STATEMENTS]:
+        sql.append({
+            'statement': statement,
+            'parameters': repr(parameters),
+            'duration_ms': round(elapsed * 1000, 3),
+            'plan': None if executemany else explain(engine, statement, parameters)
+        })
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(40)
+    report = dict(meta, sql_statements=len(statements), sql=sql, profile=summary.getvalue())
+
+    profiler.dump_stats(os.path.join(directory, meta['id'] + '.prof'))
+    with open(os.path.join(directory, meta['id'] + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    prune(app)
+
+def prune(app):
+    """Удаление отчетов сверх PROFILE_MAX_COUNT и старше PROFILE_RETENTION_HOURS"""
+    directory = app.config['PROFILE_DIR']
+    oldest = time.time() - app.config['PROFILE_RETENTION_HOURS'] * 3600
+    for i, (created, profile_id) in enumerate(_saved(directory)):
+        if i >= app.config['PROFILE_MAX_COUNT'] or created < oldest:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(directory, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+def _saved(directory):
+    """Пары (время записи, идентификатор) сохраненных профилей, новые первыми"""
+    saved = []
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            try:
+                saved.append((os.path.getmtime(os.path.join(directory, name)), name[:-5]))
+            except FileNotFoundError:
+                pass
+    return sorted(saved, reverse=True)
+
+def profile_path(app, profile_id, suffix):
+    """Путь к файлу профиля или None, если идентификатор неверный"""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(app.config['PROFILE_DIR'], profile_id + suffix)
+    return path if os.path.exists(path) else None
+
+def list_profiles(app):
+    """Краткие сведения о сохраненных профилях, новые первыми"""
+    directory = app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for _, profile_id in _saved(directory):
+        try:
+            with open(os.path.join(directory, profile_id + '.json'), encoding='utf-8') as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiles.append({key: report.get(key) for key in
+                         ('id', 'created', 'method', 'path', 'status', 'duration_ms', 'sql_statements')})
+    return profiles
@@ -0,0 +1,105 @@
+"""
+Ограничение частоты попыток входа
+
+Неудачные попытки хранятся в Redis в отсортированных множествах с
+меткой времени - отдельно по паре имя пользователя + IP клиента и по
+IP - и учитываются в скользящем окне LOGIN_RATE_WINDOW секунд. Пока
+неудач меньше порога, вход не ограничен; после порога каждая следующая
+попытка возможна только через паузу, которая удваивается с каждой
+неудачей (LOGIN_BACKOFF_BASE ... LOGIN_BACKOFF_MAX секунд). Окно по
+имени привязано к IP: перебор пароля с одного адреса не блокирует вход
+этого пользователя с других адресов.
+
+Проверка выполняется до поиска пользователя и вычисления хэша пароля,
+отказ не зависит от того, существует ли пользователь. Попытка
+записывается сразу, до проверки пароля, и при успешном входе
+удаляется, так что неудачей остается только неверный пароль. Очистка
+окна, подсчет неудач, решение и запись попытки - один Lua-скрипт,
+который Redis выполняет атомарно: параллельные запросы не могут
+одновременно пройти проверку до записи друг друга.
+Если Redis недоступен, вход не ограничивается.
+"""
+
+import time
+import uuid
+import redis
+
+KEY_PREFIX = 'ratelimit:login:'
+
+# KEYS - окна неудач; ARGV - now, window, attempt, base, max, затем пороги
+# ключей. После порога каждая неудача удваивает паузу от base до max.
+# Возвращает паузу строкой (числа Lua Redis обрезает до целых) или '0', если попытка записана
+CHECK_AND_RECORD = """
+local now, window = tonumber(ARGV[1]), tonumber(ARGV[2])
+local base, max_delay = tonumber(ARGV[4]), tonumber(ARGV[5])
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+    local failures = redis.call('ZCARD', key)
+    local limit = tonumber(ARGV[5 + i])
+    if failures >= limit then
+        local last = redis.call('ZRANGE', key, -1, -1, 'WITHSCORES')
+        local delay = math.min(base * 2 ^ (failures - limit), max_delay)
+        retry_after = math.max(retry_after, tonumber(last[2]) + delay - now)
+    end
+end
+if retry_after > 0 then
+    return tostring(retry_after)
+end
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[3])
+    redis.call('EXPIRE', key, math.floor(window) + 1)
+end
+return '0'
+"""
+
+def _keys(username, ip):
+    """Ключи окон и пороги неудач для пары имя + IP и для IP"""
+    from app import app
+    ip = ip or 'unknown'
+    return [
+        (KEY_PREFIX + 'user:' + ip + ':' + username.strip().lower()[:100],
+         app.config['LOGIN_MAX_FAILURES_PER_USER']),
+        (KEY_PREFIX + 'ip:' + ip, app.config['LOGIN_MAX_FAILURES_PER_IP'])
+    ]
+
+def check_login(username, ip):
+    """Учет попытки входа.
+
+    Возвращает (retry_after, attempt): retry_after > 0 - попытка
+    отклонена и повторить можно через столько секунд; attempt - отметка
+    попытки, которую нужно передать в login_succeeded.
+    """
+    from app import app, redis_client
+
+    if not app.config['LOGIN_RATE_LIMIT']:
+        return 0, None
+    now = time.time()
+    keys = _keys(username, ip)
+    attempt = f'{now:.6f}:{uuid.uuid4().hex[:8]}'
+    try:
+        script = redis_client.register_script(CHECK_AND_RECORD)
+        retry_after = float(script(keys=[key for key, _ in keys], args=[
+            now, app.config['LOGIN_RATE_WINDOW'], attempt,
+            app.config['LOGIN_BACKOFF_BASE'], app.config['LOGIN_BACKOFF_MAX'],
+            *[limit for _, limit in keys]]))
+    except redis.RedisError:
+        return 0, None
+    if retry_after > 0:
+        return retry_after, None
+    return 0, attempt
+
+def login_succeeded(username, ip, attempt):
+    """Успешный вход: неудачи пользователя с этого IP сбрасываются, попытка снимается с IP"""
+    from app import redis_client
+
+    if attempt is None:
+        return
+    (user_key, _), (ip_key, _) = _keys(username, ip)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(user_key)
+        pipe.zrem(ip_key, attempt)
+        pipe.execute()
+    except redis.RedisError:
+        pass
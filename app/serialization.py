@@ -0,0 +1,37 @@
+"""
+Выбор JSON-сериализатора приложения
+
+JSON_SERIALIZER=orjson (по умолчанию, если пакет установлен) заменяет
+стандартный провайдер Flask на orjson: jsonify, request.get_json и
+потоковая выдача списков (current_app.json) работают через него.
+Даты и прочие нестандартные типы преобразуются так же, как у
+стандартного провайдера; ключи не сортируются, кириллица не
+экранируется. JSON_SERIALIZER=stdlib оставляет провайдер Flask.
+"""
+
+import json
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(JSONProvider):
+    """JSON через orjson с преобразованием типов как у DefaultJSONProvider"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        # object_hook и прочие параметры (их передает, например, сериализатор
+        # сессии Flask для кортежей и дат) orjson не поддерживает
+        if kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+def init_app(app):
+    """Установка провайдера по JSON_SERIALIZER"""
+    if app.config['JSON_SERIALIZER'] == 'orjson' and orjson is not None:
+        app.json = OrjsonProvider(app)
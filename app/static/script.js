@@ -6,6 +6,9 @@ let doctors = [];
 let medicines = [];
 let visits = [];
 
+// Курсоры журнала изменений по спискам: после добавления загружаются только новые строки
+const changeCursors = {};
+
 // Инициализация приложения
 document.addEventListener('DOMContentLoaded', function() {
     loadAllData();
@@ -35,18 +38,45 @@ function setupEventListeners() {
     document.getElementById('medicineSideEffectsForm').addEventListener('submit', handleMedicineSideEffects);
 }
 
-// Загрузка всех данных
+// Загрузка всех данных одним запросом сводки
 async function loadAllData() {
     try {
-        const promises = [loadPatients(), loadMedicines(), loadVisits()];
-        
-        // Загружаем врачей только для администраторов
-        const userRole = document.querySelector('.user-role');
-        if (userRole && userRole.textContent === 'Администратор') {
-            promises.push(loadDoctors());
+        const response = await fetch('/api/dashboard');
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
         }
-        
-        await Promise.all(promises);
+        const data = await response.json();
+
+        // Списки приходят первой страницей, остальное дочитывается ниже
+        patients = data.patients.items;
+        medicines = data.medicines.items;
+        visits = data.visits.items;
+        ['patients', 'doctors', 'medicines', 'visits'].forEach(name => {
+            if (data[name]) {
+                changeCursors[name] = data.cursor;
+            }
+        });
+        displayPatients();
+        displayMedicines();
+        displayVisits();
+
+        // Врачи приходят только администраторам
+        if (data.doctors) {
+            doctors = data.doctors.items;
+            displayDoctors();
+        }
+
+        displayStatistics(data.statistics);
+        displayPopularDiagnoses(data.popular_diagnoses);
+        displayPopularMedicines(data.popular_medicines);
+        updateSelectOptions();
+
+        await Promise.all([
+            loadRest('patients', data.patients, rows => { patients = rows; displayPatients(); }),
+            loadRest('medicines', data.medicines, rows => { medicines = rows; displayMedicines(); }),
+            loadRest('visits', data.visits, rows => { visits = rows; displayVisits(); }),
+            data.doctors && loadRest('doctors', data.doctors, rows => { doctors = rows; displayDoctors(); })
+        ]);
         updateSelectOptions();
     } catch (error) {
         console.error('Ошибка загрузки данных:', error);
@@ -61,14 +91,71 @@ async function loadAllData() {
     }
 }
 
+// Адреса списков; визитам нужны только поля таблицы, без симптомов и назначений
+const listUrls = {
+    patients: '/api/patients',
+    doctors: '/api/doctors',
+    medicines: '/api/medicines',
+    visits: '/api/visits?fields=id,date,patient_name,doctor_name,location,diagnosis,medicines'
+};
+
+// Дочитывание списка сводки после первой страницы одним потоковым запросом
+async function loadRest(name, firstPage, apply) {
+    if (!firstPage.next_cursor) {
+        return;
+    }
+    const url = listUrls[name];
+    const separator = url.includes('?') ? '&' : '?';
+    const response = await fetch(`${url}${separator}after=${encodeURIComponent(firstPage.next_cursor)}&stream=json`);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+    apply(firstPage.items.concat(await response.json()));
+}
+
+// Порядок строк списков
+const byId = (a, b) => a.id - b.id;
+const byDateAndId = (a, b) => a.date.localeCompare(b.date) || a.id - b.id;
+
+// Полная загрузка списка с запоминанием курсора изменений
+async function fetchList(name, url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+    const rows = await response.json();
+    changeCursors[name] = Number(response.headers.get('X-Change-Cursor'));
+    return rows;
+}
+
+// Обновление списка: загружаются только строки, изменившиеся после курсора,
+// и сливаются с уже загруженными; при сбросе список загружается целиком
+async function syncList(name, url, rows, compare) {
+    if (changeCursors[name] === undefined) {
+        return fetchList(name, url);
+    }
+    const separator = url.includes('?') ? '&' : '?';
+    const response = await fetch(`${url}${separator}since=${changeCursors[name]}`);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+    const delta = await response.json();
+    if (delta.reset) {
+        return fetchList(name, url);
+    }
+    changeCursors[name] = delta.cursor;
+    if (delta.items.length === 0) {
+        return rows;
+    }
+    const merged = new Map(rows.map(row => [row.id, row]));
+    delta.items.forEach(row => merged.set(row.id, row));
+    return Array.from(merged.values()).sort(compare);
+}
+
 // Загрузка пациентов
 async function loadPatients() {
     try {
-        const response = await fetch('/api/patients');
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
-        patients = await response.json();
+        patients = await syncList('patients', listUrls.patients, patients, byId);
         displayPatients();
     } catch (error) {
         console.error('Ошибка загрузки пациентов:', error);
@@ -79,11 +166,7 @@ async function loadPatients() {
 // Загрузка врачей
 async function loadDoctors() {
     try {
-        const response = await fetch('/api/doctors');
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
-        doctors = await response.json();
+        doctors = await syncList('doctors', listUrls.doctors, doctors, byId);
         displayDoctors();
     } catch (error) {
         console.error('Ошибка загрузки врачей:', error);
@@ -94,11 +177,7 @@ async function loadDoctors() {
 // Загрузка лекарств
 async function loadMedicines() {
     try {
-        const response = await fetch('/api/medicines');
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
-        medicines = await response.json();
+        medicines = await syncList('medicines', listUrls.medicines, medicines, byId);
         displayMedicines();
     } catch (error) {
         console.error('Ошибка загрузки лекарств:', error);
@@ -109,11 +188,7 @@ async function loadMedicines() {
 // Загрузка визитов
 async function loadVisits() {
     try {
-        const response = await fetch('/api/visits');
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
-        visits = await response.json();
+        visits = await syncList('visits', listUrls.visits, visits, byDateAndId);
         displayVisits();
     } catch (error) {
         console.error('Ошибка загрузки визитов:', error);
@@ -296,8 +371,7 @@ async function handlePatientSubmit(e) {
         if (response.ok) {
             showAlert('Пациент успешно добавлен!', 'success');
             document.getElementById('patientForm').reset();
-            loadPatients();
-            updateSelectOptions();
+            loadPatients().then(updateSelectOptions);
         } else {
             throw new Error('Ошибка добавления пациента');
         }
@@ -327,8 +401,7 @@ async function handleDoctorSubmit(e) {
         if (response.ok) {
             showAlert('Врач успешно добавлен!', 'success');
             document.getElementById('doctorForm').reset();
-            loadDoctors();
-            updateSelectOptions();
+            loadDoctors().then(updateSelectOptions);
         } else {
             throw new Error('Ошибка добавления врача');
         }
@@ -361,8 +434,7 @@ async function handleMedicineSubmit(e) {
         if (response.ok) {
             showAlert('Лекарство успешно добавлено!', 'success');
             document.getElementById('medicineForm').reset();
-            loadMedicines();
-            updateSelectOptions();
+            loadMedicines().then(updateSelectOptions);
         } else {
             throw new Error('Ошибка добавления лекарства');
         }
@@ -528,10 +600,7 @@ function showTab(tabName) {
     
     // Загрузить данные при переключении на аналитику
     if (tabName === 'analytics') {
-        loadMedicines(); // Обновить список лекарств для аналитики
-        loadStatistics();
-        loadPopularDiagnoses();
-        loadPopularMedicines();
+        loadAnalytics();
     }
 }
 
@@ -556,111 +625,116 @@ function formatDate(dateString) {
     return date.toLocaleDateString('ru-RU');
 }
 
-// Загрузка статистики
-async function loadStatistics() {
+// Загрузка аналитики (лекарства, статистика, популярные диагнозы и лекарства) одним запросом
+async function loadAnalytics() {
     try {
-        const response = await fetch('/api/statistics');
-        const stats = await response.json();
-        
-        const container = document.getElementById('statistics');
-        container.innerHTML = `
-            <div class="result-box">
-                <div class="result-number">${stats.total_patients}</div>
-                <div class="result-text">пациентов</div>
-            </div>
-            <div class="result-box">
-                <div class="result-number">${stats.total_doctors}</div>
-                <div class="result-text">врачей</div>
-            </div>
-            <div class="result-box">
-                <div class="result-number">${stats.total_medicines}</div>
-                <div class="result-text">лекарств</div>
-            </div>
-            <div class="result-box">
-                <div class="result-number">${stats.total_visits}</div>
-                <div class="result-text">визитов</div>
-            </div>
-            <div class="result-box">
-                <div class="result-number">${stats.visits_today}</div>
-                <div class="result-text">визитов сегодня</div>
-            </div>
-        `;
+        const response = await fetch('/api/dashboard?sections=medicines,statistics,popular_diagnoses,popular_medicines');
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        const data = await response.json();
+
+        medicines = data.medicines.items; // Обновить список лекарств для аналитики
+        changeCursors.medicines = data.cursor;
+        displayMedicines();
+        updateSelectOptions();
+        displayStatistics(data.statistics);
+        displayPopularDiagnoses(data.popular_diagnoses);
+        displayPopularMedicines(data.popular_medicines);
+        await loadRest('medicines', data.medicines, rows => {
+            medicines = rows;
+            displayMedicines();
+            updateSelectOptions();
+        });
     } catch (error) {
-        console.error('Ошибка загрузки статистики:', error);
+        console.error('Ошибка загрузки аналитики:', error);
         document.getElementById('statistics').innerHTML = '<p>Ошибка загрузки статистики</p>';
+        document.getElementById('popularDiagnoses').innerHTML = '<p>Ошибка загрузки данных</p>';
+        document.getElementById('popularMedicines').innerHTML = '<p>Ошибка загрузки данных</p>';
     }
 }
 
-// Загрузка популярных диагнозов
-async function loadPopularDiagnoses() {
-    try {
-        const response = await fetch('/api/popular-diagnoses');
-        const diagnoses = await response.json();
-        
-        const container = document.getElementById('popularDiagnoses');
-        if (diagnoses.length === 0) {
-            container.innerHTML = '<p>Данные не найдены</p>';
-            return;
-        }
+// Отображение статистики
+function displayStatistics(stats) {
+    const container = document.getElementById('statistics');
+    container.innerHTML = `
+        <div class="result-box">
+            <div class="result-number">${stats.total_patients}</div>
+            <div class="result-text">пациентов</div>
+        </div>
+        <div class="result-box">
+            <div class="result-number">${stats.total_doctors}</div>
+            <div class="result-text">врачей</div>
+        </div>
+        <div class="result-box">
+            <div class="result-number">${stats.total_medicines}</div>
+            <div class="result-text">лекарств</div>
+        </div>
+        <div class="result-box">
+            <div class="result-number">${stats.total_visits}</div>
+            <div class="result-text">визитов</div>
+        </div>
+        <div class="result-box">
+            <div class="result-number">${stats.visits_today}</div>
+            <div class="result-text">визитов сегодня</div>
+        </div>
+    `;
+}
+
+// Отображение популярных диагнозов
+function displayPopularDiagnoses(diagnoses) {
+    const container = document.getElementById('popularDiagnoses');
+    if (diagnoses.length === 0) {
+        container.innerHTML = '<p>Данные не найдены</p>';
+        return;
+    }
 
-        const html = `
-            <table class="table">
-                <thead>
+    const html = `
+        <table class="table">
+            <thead>
+                <tr>
+                    <th>Диагноз</th>
+                    <th>Количество</th>
+                </tr>
+            </thead>
+            <tbody>
+                ${diagnoses.map(d => `
                     <tr>
-                        <th>Диагноз</th>
-                        <th>Количество</th>
+                        <td>${d.diagnosis}</td>
+                        <td><strong>${d.count}</strong></td>
                     </tr>
-                </thead>
-                <tbody>
-                    ${diagnoses.map(d => `
-                        <tr>
-                            <td>${d.diagnosis}</td>
-                            <td><strong>${d.count}</strong></td>
-                        </tr>
-                    `).join('')}
-                </tbody>
-            </table>
-        `;
-        container.innerHTML = html;
-    } catch (error) {
-        console.error('Ошибка загрузки диагнозов:', error);
-        document.getElementById('popularDiagnoses').innerHTML = '<p>Ошибка загрузки данных</p>';
-    }
+                `).join('')}
+            </tbody>
+        </table>
+    `;
+    container.innerHTML = html;
 }
 
-// Загрузка популярных лекарств
-async function loadPopularMedicines() {
-    try {
-        const response = await fetch('/api/popular-medicines');
-        const medicines = await response.json();
-        
-        const container = document.getElementById('popularMedicines');
-        if (medicines.length === 0) {
-            container.innerHTML = '<p>Данные не найдены</p>';
-            return;
-        }
+// Отображение популярных лекарств
+function displayPopularMedicines(medicines) {
+    const container = document.getElementById('popularMedicines');
+    if (medicines.length === 0) {
+        container.innerHTML = '<p>Данные не найдены</p>';
+        return;
+    }
 
-        const html = `
-            <table class="table">
-                <thead>
+    const html = `
+        <table class="table">
+            <thead>
+                <tr>
+                    <th>Лекарство</th>
+                    <th>Назначений</th>
+                </tr>
+            </thead>
+            <tbody>
+                ${medicines.map(m => `
                     <tr>
-                        <th>Лекарство</th>
-                        <th>Назначений</th>
+                        <td>${m.medicine}</td>
+                        <td><strong>${m.count}</strong></td>
                     </tr>
-                </thead>
-                <tbody>
-                    ${medicines.map(m => `
-                        <tr>
-                            <td>${m.medicine}</td>
-                            <td><strong>${m.count}</strong></td>
-                        </tr>
-                    `).join('')}
-                </tbody>
-            </table>
-        `;
-        container.innerHTML = html;
-    } catch (error) {
-        console.error('Ошибка загрузки лекарств:', error);
-        document.getElementById('popularMedicines').innerHTML = '<p>Ошибка загрузки данных</p>';
-    }
+                `).join('')}
+            </tbody>
+        </table>
+    `;
+    container.innerHTML = html;
 }
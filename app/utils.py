@@ -2,77 +2,235 @@
 Утилиты для медицинского приложения
 """
 
-from datetime import date, datetime
-from app import db, Patient, Doctor, Medicine, Visit, Prescription
+from bisect import bisect_right
+from collections import Counter
+from operator import itemgetter
+from datetime import date, datetime, timedelta
+from flask import Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import delete, func, insert, literal, select, text, tuple_, union_all
+from sqlalchemy.orm import joinedload, selectinload
+from app import db, Patient, Doctor, Medicine, Visit, Prescription, VisitCounter, VisitDaily, ChangeLog
 
-def get_statistics():
-    """Получение общей статистики системы"""
-    stats = {
-        'total_patients': Patient.query.count(),
-        'total_doctors': Doctor.query.count(),
-        'total_medicines': Medicine.query.count(),
-        'total_visits': Visit.query.count(),
-        'visits_today': Visit.query.filter_by(date=date.today()).count(),
-        'visits_this_week': Visit.query.filter(
-            Visit.date >= date.today().replace(day=date.today().day-7)
-        ).count()
-    }
-    return stats
+# Параметры постраничной выдачи списков
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+STREAM_CHUNK_SIZE = 500
 
-def get_popular_diagnoses(limit=5):
-    """Получение самых частых диагнозов"""
-    from sqlalchemy import func
+# Больше изменений по ?since= не отдается: список дешевле загрузить заново
+MAX_CHANGES = 1000
+# Ключ advisory-блокировки PostgreSQL, упорядочивающей записи журнала изменений
+CHANGE_LOG_LOCK_KEY = 7302
+
+# Максимальный период расписания врача, дней
+SCHEDULE_MAX_DAYS = 366
+
+# Параметры поиска пациентов
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+def statistics_counts():
+    """Показатели общей статистики: имя -> скалярный подзапрос"""
+    def count(model, *conditions):
+        return select(func.count()).select_from(model).where(*conditions).scalar_subquery()
     
-    popular = db.session.query(
+    return {
+        'total_patients': count(Patient),
+        'total_doctors': count(Doctor),
+        'total_medicines': count(Medicine),
+        'total_visits': count(Visit),
+        'visits_today': count(Visit, Visit.date == date.today()),
+        'visits_this_week': count(Visit, Visit.date >= date.today() - timedelta(days=7))
+    }
+
+def get_statistics():
+    """Получение общей статистики системы (одним запросом)"""
+    row = db.session.execute(select(
+        *[column.label(name) for name, column in statistics_counts().items()]
+    )).one()
+    return dict(row._mapping)
+
+def popular_diagnoses_query(limit=5):
+    """SELECT самых частых диагнозов (diagnosis, count)"""
+    return select(
         Visit.diagnosis,
         func.count(Visit.diagnosis).label('count')
     ).group_by(Visit.diagnosis).order_by(
         func.count(Visit.diagnosis).desc()
-    ).limit(limit).all()
-    
-    return [{'diagnosis': d[0], 'count': d[1]} for d in popular]
+    ).limit(limit)
 
-def get_popular_medicines(limit=5):
-    """Получение самых назначаемых лекарств"""
-    from sqlalchemy import func
-    
-    popular = db.session.query(
+def popular_medicines_query(limit=5):
+    """SELECT самых назначаемых лекарств (name, count)"""
+    return select(
         Medicine.name,
         func.count(Prescription.medicine_id).label('count')
     ).join(Prescription).group_by(Medicine.name).order_by(
         func.count(Prescription.medicine_id).desc()
-    ).limit(limit).all()
-    
+    ).limit(limit)
+
+def get_popular_diagnoses(limit=5):
+    """Получение самых частых диагнозов"""
+    popular = db.session.execute(popular_diagnoses_query(limit)).all()
+    return [{'diagnosis': d[0], 'count': d[1]} for d in popular]
+
+def get_popular_medicines(limit=5):
+    """Получение самых назначаемых лекарств"""
+    popular = db.session.execute(popular_medicines_query(limit)).all()
     return [{'medicine': m[0], 'count': m[1]} for m in popular]
 
-def search_patients(query):
-    """Поиск пациентов по имени или адресу"""
-    return Patient.query.filter(
-        (Patient.name.contains(query)) |
-        (Patient.address.contains(query))
-    ).all()
+def get_summary(names):
+    """Статистика и популярные диагнозы и лекарства одним запросом
+
+    names - нужные выборки (statistics, popular-diagnoses,
+    popular-medicines - как ключи кэша); каждая добавляет в UNION ALL
+    строки (выборка, имя, число). Возвращает {выборка: значение}.
+    """
+    parts = []
+    if 'statistics' in names:
+        parts += [select(literal('statistics'), literal(name), column)
+                  for name, column in statistics_counts().items()]
+    for name, query in (('popular-diagnoses', popular_diagnoses_query()),
+                        ('popular-medicines', popular_medicines_query())):
+        if name in names:
+            popular = query.subquery()
+            parts.append(select(literal(name), *popular.c))
+    
+    summary = {name: {} if name == 'statistics' else [] for name in names}
+    for section, name, count in db.session.execute(union_all(*parts)):
+        if section == 'statistics':
+            summary[section][name] = count
+        else:
+            field = 'diagnosis' if section == 'popular-diagnoses' else 'medicine'
+            summary[section].append({field: name, 'count': count})
+    # Порядок строк подзапроса UNION ALL не сохраняет
+    for name in ('popular-diagnoses', 'popular-medicines'):
+        if name in summary:
+            summary[name].sort(key=itemgetter('count'), reverse=True)
+    return summary
+
+def escape_like(value):
+    """Экранирование спецсимволов LIKE (экранирующий символ - обратная косая)"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_patients(query, limit=SEARCH_LIMIT, prefix=False):
+    """Поиск пациентов по имени или адресу
+
+    В SQLite используется триграммный индекс patient_fts с ранжированием
+    bm25; prefix=True ищет только по имени и поднимает наверх имена,
+    начинающиеся с запроса (подсказки при вводе). Запросы короче трех
+    символов и другие СУБД обрабатываются через LIKE.
+    """
+    limit = min(max(limit, 1), MAX_SEARCH_LIMIT)
+    if db.engine.dialect.name != 'sqlite' or len(query) < 3:
+        return search_patients_like(query, limit, prefix)
+
+    phrase = '"' + query.replace('"', '""') + '"'
+    if prefix:
+        phrase = 'name : ' + phrase
+    statement = text(
+        "SELECT patient.* FROM patient_fts "
+        "JOIN patient ON patient.id = patient_fts.rowid "
+        "WHERE patient_fts MATCH :phrase "
+        "ORDER BY " + ("patient.name LIKE :starts ESCAPE '\\' DESC, " if prefix else "") +
+        "patient_fts.rank LIMIT :limit"
+    )
+    params = {'phrase': phrase, 'limit': limit}
+    if prefix:
+        params['starts'] = escape_like(query) + '%'
+    return Patient.query.from_statement(statement.bindparams(**params)).all()
+
+def search_patients_like(query, limit=SEARCH_LIMIT, prefix=False):
+    """Поиск пациентов через LIKE (без полнотекстового индекса)"""
+    pattern = escape_like(query)
+    if prefix:
+        condition = Patient.name.like(pattern + '%', escape='\\')
+    else:
+        condition = (Patient.name.like('%' + pattern + '%', escape='\\') |
+                     Patient.address.like('%' + pattern + '%', escape='\\'))
+    return Patient.query.filter(condition).order_by(Patient.name).limit(limit).all()
+
+def visits_with_names():
+    """Запрос визитов с подгрузкой пациента, врача и лекарств
+
+    Пациент и врач подтягиваются JOIN-ом, рецепты с лекарствами - одним
+    дополнительным SELECT ... IN на пачку визитов, поэтому число запросов
+    не зависит от количества строк.
+    """
+    return Visit.query.options(
+        joinedload(Visit.patient),
+        joinedload(Visit.doctor),
+        selectinload(Visit.prescriptions).joinedload(Prescription.medicine)
+    )
 
 def get_patient_history(patient_id):
     """Получение истории визитов пациента"""
-    return Visit.query.filter_by(patient_id=patient_id).order_by(Visit.date.desc()).all()
+    return visits_with_names().filter(
+        Visit.patient_id == patient_id
+    ).order_by(Visit.date.desc()).all()
 
 def get_doctor_schedule(doctor_id, start_date, end_date):
-    """Получение расписания врача за период"""
-    return Visit.query.filter(
+    """Получение расписания врача за период (компактные записи без ORM-объектов)"""
+    rows = db.session.query(
+        Visit.id, Visit.date, Visit.location, Visit.diagnosis, Visit.patient_id, Patient.name
+    ).join(Patient, Patient.id == Visit.patient_id).filter(
         Visit.doctor_id == doctor_id,
         Visit.date >= start_date,
         Visit.date <= end_date
-    ).order_by(Visit.date).all()
+    ).order_by(Visit.date, Visit.id).all()
+    
+    return [{
+        'id': r.id,
+        'date': r.date.isoformat(),
+        'location': r.location,
+        'diagnosis': r.diagnosis,
+        'patient_id': r.patient_id,
+        'patient_name': r.name
+    } for r in rows]
 
-def export_visits_to_csv(start_date, end_date):
-    """Экспорт визитов в CSV формат"""
+def schedule_cache_name(doctor_id, day):
+    """Имя кэшированной недели расписания врача, в которую попадает day"""
+    week = day - timedelta(days=day.weekday())
+    return f'schedule:{doctor_id}:{week.isoformat()}'
+
+def get_doctor_schedule_cached(doctor_id, start_date, end_date):
+    """Расписание врача через кэш понедельных страниц
+
+    Недостающие недели читаются одним запросом и кладутся в кэш; новая
+    запись визита сбрасывает только неделю своего врача.
+    """
+    weeks = {}
+    week = start_date - timedelta(days=start_date.weekday())
+    while week <= end_date:
+        weeks[schedule_cache_name(doctor_id, week)] = week
+        week += timedelta(days=7)
+    
+    def compute(missing):
+        missing_weeks = sorted(weeks[name] for name in missing)
+        pages = {name: [] for name in missing}
+        rows = get_doctor_schedule(doctor_id, missing_weeks[0], missing_weeks[-1] + timedelta(days=6))
+        for row in rows:
+            name = schedule_cache_name(doctor_id, date.fromisoformat(row['date']))
+            if name in pages:
+                pages[name].append(row)
+        return pages
+    
+    from cache import cached_many
+    pages = cached_many('schedule', list(weeks), compute)
+    start, end = start_date.isoformat(), end_date.isoformat()
+    return [row for name in weeks for row in pages[name] if start <= row['date'] <= end]
+
+def iter_visits_csv(start_date, end_date):
+    """Экспорт визитов в CSV по частям
+
+    Визиты читаются с сервера пачками (yield_per), строки отдаются
+    кусками, поэтому память не зависит от длины периода.
+    """
     import csv
     import io
     
-    visits = Visit.query.filter(
+    visits = visits_with_names().filter(
         Visit.date >= start_date,
         Visit.date <= end_date
-    ).all()
+    ).order_by(Visit.date, Visit.id).yield_per(STREAM_CHUNK_SIZE)
     
     output = io.StringIO()
     writer = csv.writer(output)
@@ -84,7 +242,7 @@ def export_visits_to_csv(start_date, end_date):
     ])
     
     # Данные
-    for visit in visits:
+    for number, visit in enumerate(visits, 1):
         medicines = ', '.join([p.medicine.name for p in visit.prescriptions])
         writer.writerow([
             visit.date.strftime('%Y-%m-%d'),
@@ -96,8 +254,492 @@ def export_visits_to_csv(start_date, end_date):
             visit.prescriptions_text,
             medicines
         ])
+        if number % STREAM_CHUNK_SIZE == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    
+    yield output.getvalue()
+
+def export_visits_to_csv(start_date, end_date):
+    """Экспорт визитов в CSV формат"""
+    return ''.join(iter_visits_csv(start_date, end_date))
+
+def gzip_stream(chunks, level=6):
+    """Сжатие потока строк в gzip на лету"""
+    import zlib
+    
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def serialize_patient(p):
+    """Представление пациента для API"""
+    return {
+        'id': p.id,
+        'name': p.name,
+        'gender': p.gender,
+        'birth_date': p.birth_date.isoformat(),
+        'address': p.address
+    }
+
+def serialize_doctor(d):
+    """Представление врача для API"""
+    return {
+        'id': d.id,
+        'name': d.name
+    }
+
+def serialize_medicine(m):
+    """Представление лекарства для API"""
+    return {
+        'id': m.id,
+        'name': m.name,
+        'usage_method': m.usage_method,
+        'description': m.description,
+        'side_effects': m.side_effects
+    }
+
+def serialize_visit(v):
+    """Представление визита для API"""
+    return {
+        'id': v.id,
+        'date': v.date.isoformat(),
+        'location': v.location,
+        'symptoms': v.symptoms,
+        'diagnosis': v.diagnosis,
+        'prescriptions_text': v.prescriptions_text,
+        'patient_name': v.patient.name,
+        'doctor_name': v.doctor.name,
+        'medicines': [p.medicine.name for p in v.prescriptions]
+    }
+
+# Поля списочных API для ?fields=: имя -> колонка SELECT; None - поле
+# догружается отдельным запросом на пачку строк
+PATIENT_FIELDS = {
+    'id': Patient.id,
+    'name': Patient.name,
+    'gender': Patient.gender,
+    'birth_date': Patient.birth_date,
+    'address': Patient.address
+}
+MEDICINE_FIELDS = ['id', 'name', 'usage_method', 'description', 'side_effects']
+VISIT_FIELDS = {
+    'id': Visit.id,
+    'date': Visit.date,
+    'location': Visit.location,
+    'symptoms': Visit.symptoms,
+    'diagnosis': Visit.diagnosis,
+    'prescriptions_text': Visit.prescriptions_text,
+    'patient_name': Patient.name,
+    'doctor_name': Doctor.name,
+    'medicines': None
+}
+
+def parse_fields(available):
+    """Поля из ?fields=a,b в порядке запроса; None, если параметр не задан"""
+    raw = request.args.get('fields')
+    if raw is None:
+        return None
+    fields = list(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in available]
+    if not fields or unknown:
+        raise ValueError('Неизвестные поля: {}. Доступны: {}'.format(
+            ', '.join(unknown) or '-', ', '.join(available)))
+    return fields
+
+def projected_query(model, columns, fields, keys):
+    """SELECT только запрошенных колонок и ключей пагинации
+
+    Колонки других таблиц (имя пациента, врача) присоединяются JOIN-ом
+    по внешнему ключу. Строки результата - кортежи с полями по именам.
+    """
+    selected = {name: columns[name] for name in fields if columns[name] is not None}
+    for key in keys:
+        selected.setdefault(key.key, key)
+    query = db.session.query(*[column.label(name) for name, column in selected.items()]).select_from(model)
+    for joined in dict.fromkeys(column.class_ for column in selected.values() if column.class_ is not model):
+        query = query.join(joined)
+    return query
+
+def serialize_fields(fields):
+    """Сериализатор строки projected_query: только запрошенные поля"""
+    plain = [name for name in fields if name != 'medicines']
+
+    def serialize(row):
+        item = {}
+        for name in plain:
+            value = getattr(row, name)
+            item[name] = value.isoformat() if isinstance(value, date) else value
+        return item
+    return serialize
+
+def attach_visit_medicines(rows, items):
+    """Названия лекарств для пачки визитов одним запросом"""
+    names = {row.id: [] for row in rows}
+    prescriptions = db.session.query(Prescription.visit_id, Medicine.name).join(Medicine).filter(
+        Prescription.visit_id.in_(list(names))).order_by(Prescription.id)
+    for visit_id, name in prescriptions:
+        names[visit_id].append(name)
+    for row, item in zip(rows, items):
+        item['medicines'] = names[row.id]
+
+# Разделы сводки для главной страницы
+DASHBOARD_SECTIONS = ['patients', 'doctors', 'medicines', 'visits',
+                      'statistics', 'popular_diagnoses', 'popular_medicines']
+# Поля визитов в сводке - колонки таблицы визитов на странице
+DASHBOARD_VISIT_FIELDS = ['id', 'date', 'patient_name', 'doctor_name', 'location', 'diagnosis', 'medicines']
+
+def get_dashboard(sections, limit=None):
+    """Сводка для главной страницы: выбранные разделы в одном ответе
+
+    Списки приходят первой страницей {'items', 'next_cursor'} не длиннее
+    limit строк; остальное клиент дочитывает из списочного API с
+    ?after=next_cursor. Агрегаты читаются из кэша, недостающие
+    вычисляются одним запросом.
+    """
+    from cache import cached_many, get_medicine_catalog
+    
+    # Курсор читается до списков: изменения после него придут в следующем ?since=
+    bundle = {'cursor': change_cursor()}
+    if 'patients' in sections:
+        bundle['patients'] = page(Patient.query.order_by(Patient.id), [Patient.id],
+                                  serialize_patient, limit=limit)
+    if 'doctors' in sections:
+        bundle['doctors'] = page(Doctor.query.order_by(Doctor.id), [Doctor.id],
+                                 serialize_doctor, limit=limit)
+    if 'medicines' in sections:
+        items, _, catalog_cursor = get_medicine_catalog()
+        bundle['medicines'] = items_page(items, limit=limit)
+        bundle['cursor'] = min(bundle['cursor'], catalog_cursor)
+    if 'visits' in sections:
+        keys = [Visit.date, Visit.id]
+        query = projected_query(Visit, VISIT_FIELDS, DASHBOARD_VISIT_FIELDS, keys).order_by(*keys)
+        bundle['visits'] = page(query, keys, serialize_fields(DASHBOARD_VISIT_FIELDS),
+                                attach_visit_medicines, limit)
+    
+    summary = {'statistics': 'statistics', 'popular_diagnoses': 'popular-diagnoses',
+               'popular_medicines': 'popular-medicines'}
+    names = [name for section, name in summary.items() if section in sections]
+    if names:
+        values = cached_many('dashboard', names, get_summary)
+        for section, name in summary.items():
+            if name in values:
+                bundle[section] = values[name]
+    return bundle
+
+def encode_cursor(obj, keys):
+    """Курсор keyset-пагинации: значения ключевых колонок через запятую"""
+    values = []
+    for column in keys:
+        value = getattr(obj, column.key)
+        values.append(value.isoformat() if isinstance(value, date) else str(value))
+    return ','.join(values)
+
+def decode_cursor(cursor, keys):
+    """Разбор курсора обратно в значения ключевых колонок"""
+    parts = cursor.split(',')
+    if len(parts) != len(keys):
+        raise ValueError('Неверный курсор')
+    values = []
+    for column, raw in zip(keys, parts):
+        python_type = column.type.python_type
+        try:
+            if python_type is date:
+                values.append(date.fromisoformat(raw))
+            else:
+                values.append(python_type(raw))
+        except ValueError:
+            raise ValueError('Неверный курсор')
+    return values
+
+def keyset_filter(query, keys, after):
+    """Ограничение запроса строками строго после курсора"""
+    values = decode_cursor(after, keys)
+    if len(keys) == 1:
+        return query.filter(keys[0] > values[0])
+    return query.filter(tuple_(*keys) > tuple_(*values))
+
+def stream_rows(rows, serialize, fmt='json'):
+    """Генератор JSON-массива или NDJSON, отдающий строки пачками"""
+    dumps = current_app.json.dumps
+    if fmt == 'ndjson':
+        chunk = []
+        for row in rows:
+            chunk.append(dumps(serialize(row)) + '\n')
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+        return
+
+    yield '['
+    chunk = []
+    separator = ''
+    for row in rows:
+        chunk.append(separator + dumps(serialize(row)))
+        separator = ','
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+def page(query, keys, serialize, attach=None, limit=None):
+    """Страница упорядоченного по keys запроса: {'items': [...], 'next_cursor': ...}"""
+    limit = min(max(limit or DEFAULT_PAGE_LIMIT, 1), MAX_PAGE_LIMIT)
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1], keys) if len(rows) > limit else None
+    items = [serialize(row) for row in rows[:limit]]
+    if attach and items:
+        attach(rows[:limit], items)
+    return {'items': items, 'next_cursor': next_cursor}
+
+def items_page(items, key='id', serialize=None, limit=None):
+    """То же, что page, для готового списка словарей, упорядоченного по key"""
+    limit = min(max(limit or DEFAULT_PAGE_LIMIT, 1), MAX_PAGE_LIMIT)
+    next_cursor = str(items[limit - 1][key]) if len(items) > limit else None
+    return {'items': [serialize(item) if serialize else item for item in items[:limit]],
+            'next_cursor': next_cursor}
+
+def serialize_chunks(rows, serialize, attach):
+    """Сериализация пачками, чтобы attach догружал данные одним запросом на пачку"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            items = [serialize(row) for row in chunk]
+            attach(chunk, items)
+            yield from items
+            chunk = []
+    if chunk:
+        items = [serialize(row) for row in chunk]
+        attach(chunk, items)
+        yield from items
+
+def log_changes(connection, entity, row_ids):
+    """Запись строк entity в журнал изменений; row_id None - таблица
+    изменена целиком и клиентам нужно загрузить ее заново
+
+    Курсор ?since= верен, только если id журнала растут в порядке коммитов.
+    В SQLite записи и так последовательны; в PostgreSQL id из
+    последовательности выдаются до коммита, поэтому пишущие транзакции
+    упорядочиваются блокировкой до своего коммита.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK_KEY})
+    connection.execute(insert(ChangeLog.__table__), [{'entity': entity, 'row_id': row_id} for row_id in row_ids])
+
+def change_cursor():
+    """Текущая позиция журнала изменений"""
+    return db.session.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+def changes_since(entity, since):
+    """id строк entity, измененных после курсора since, и новый курсор
+
+    Вместо id возвращается None, если клиенту нужно загрузить список
+    заново: изменений больше MAX_CHANGES, таблица менялась целиком или
+    курсор впереди журнала (база пересоздана).
+    """
+    cursor = change_cursor()
+    if since > cursor:
+        return None, cursor
+    row_ids = db.session.execute(
+        select(ChangeLog.row_id).where(ChangeLog.entity == entity, ChangeLog.id > since, ChangeLog.id <= cursor)
+        .limit(MAX_CHANGES + 1)
+    ).scalars().all()
+    if len(row_ids) > MAX_CHANGES or None in row_ids:
+        return None, cursor
+    return set(row_ids), cursor
+
+def prune_changes():
+    """Удаление записей журнала, которые уже не могут попасть в ответ ?since=
+
+    По каждой таблице остаются MAX_CHANGES + 1 последних записей: клиенту
+    с курсором старше них и до удаления вернулся бы reset. Возвращает
+    число удаленных записей.
+    """
+    deleted = 0
+    with db.engine.begin() as connection:
+        for model in (Patient, Doctor, Medicine, Visit):
+            entity = model.__tablename__
+            oldest_kept = connection.execute(
+                select(ChangeLog.id).where(ChangeLog.entity == entity)
+                .order_by(ChangeLog.id.desc()).offset(MAX_CHANGES).limit(1)
+            ).scalar()
+            if oldest_kept is not None:
+                deleted += connection.execute(delete(ChangeLog).where(
+                    ChangeLog.entity == entity, ChangeLog.id < oldest_kept)).rowcount
+    return deleted
+
+def changes_response(query, keys, serialize, attach, entity):
+    """Ответ ?since=: строки, добавленные или измененные после курсора"""
+    try:
+        since = int(request.args['since'])
+    except ValueError:
+        return jsonify({'error': 'since должен быть курсором изменений (целым числом)'}), 400
+    row_ids, cursor = changes_since(entity, since)
+    if row_ids is None:
+        return jsonify({'items': [], 'cursor': cursor, 'reset': True})
+    rows = query.filter(keys[-1].in_(row_ids)).order_by(*keys).all() if row_ids else []
+    items = [serialize(row) for row in rows]
+    if attach and items:
+        attach(rows, items)
+    return jsonify({'items': items, 'cursor': cursor, 'reset': False})
+
+def list_response(query, keys, serialize, attach=None, entity=None):
+    """Ответ списочного API: страница по курсору или потоковая выдача
+
+    ?limit=&after= - страница {'items': [...], 'next_cursor': ...};
+    ?stream=ndjson - NDJSON, без параметров - потоковый JSON-массив.
+    Порядок всегда задается ключевыми колонками keys. attach(строки,
+    словари) дополняет пачку сериализованных строк.
+
+    Для таблицы entity из журнала изменений ответ несет заголовок
+    X-Change-Cursor, а ?since=<курсор> возвращает только строки,
+    изменившиеся после него: {'items': [...], 'cursor': ..., 'reset': ...}.
+    """
+    if entity and 'since' in request.args:
+        return changes_response(query, keys, serialize, attach, entity)
+    headers = {'X-Change-Cursor': str(change_cursor())} if entity else {}
+    after = request.args.get('after')
+    fmt = request.args.get('stream')
+    limit = request.args.get('limit', type=int)
+    if after:
+        try:
+            query = keyset_filter(query, keys, after)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    query = query.order_by(*keys)
+
+    if fmt is None and (limit is not None or after):
+        return jsonify(page(query, keys, serialize, attach, limit)), 200, headers
+
+    if fmt not in (None, 'json', 'ndjson'):
+        return jsonify({'error': 'stream должен быть json или ndjson'}), 400
+    if limit is not None:
+        query = query.limit(min(max(limit, 1), MAX_PAGE_LIMIT))
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    rows = query.yield_per(STREAM_CHUNK_SIZE)
+    if attach:
+        rows, serialize = serialize_chunks(rows, serialize, attach), lambda item: item
+    return Response(stream_with_context(stream_rows(rows, serialize, fmt or 'json')),
+                    mimetype=mimetype, headers=headers)
+
+def list_items_response(items, key='id', fields=None, cursor=None):
+    """То же, что list_response, для готового списка словарей,
+    упорядоченного по целочисленному ключу key; fields - отбор полей,
+    cursor - позиция журнала изменений, на которую список актуален"""
+    headers = {'X-Change-Cursor': str(cursor)} if cursor is not None else {}
+    after = request.args.get('after')
+    fmt = request.args.get('stream')
+    limit = request.args.get('limit', type=int)
+    if after:
+        try:
+            items = items[bisect_right(items, int(after), key=itemgetter(key)):]
+        except ValueError:
+            return jsonify({'error': 'Неверный курсор'}), 400
+
+    serialize = (lambda item: {name: item[name] for name in fields}) if fields else (lambda item: item)
+
+    if fmt is None and (limit is not None or after):
+        return jsonify(items_page(items, key, serialize, limit)), 200, headers
+
+    if fmt not in (None, 'json', 'ndjson'):
+        return jsonify({'error': 'stream должен быть json или ndjson'}), 400
+    if limit is not None:
+        items = items[:min(max(limit, 1), MAX_PAGE_LIMIT)]
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(stream_rows(items, serialize, fmt or 'json')),
+                    mimetype=mimetype, headers=headers)
+
+def dialect_insert(connection):
+    """insert() с поддержкой ON CONFLICT для текущего диалекта"""
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def upsert_counts(connection, table, keys, deltas):
+    """Прибавление deltas {значения ключей: число} к колонке count таблицы"""
+    if not deltas:
+        return
+    stmt = dialect_insert(connection)(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c[key] for key in keys],
+        set_={'count': table.c.count + stmt.excluded.count}
+    )
+    connection.execute(stmt, [
+        dict(zip(keys, values), count=count) for values, count in deltas.items()
+    ])
+
+def increment_visit_counters(connection, rows):
+    """Учет новых визитов в счетчиках и суточной сводке
+
+    rows - словари с полями визита (date, diagnosis, doctor_id, location);
+    выполняется upsert-ами на соединении вызывающей транзакции.
+    """
+    counters = Counter()
+    daily = Counter()
+    for row in rows:
+        counters[('date', row['date'].isoformat())] += 1
+        counters[('diagnosis', row['diagnosis'])] += 1
+        daily[(row['date'], row['doctor_id'], row['diagnosis'], row['location'])] += 1
+
+    upsert_counts(connection, VisitCounter.__table__, ['dimension', 'value'], counters)
+    upsert_counts(connection, VisitDaily.__table__,
+                  ['day', 'doctor_id', 'diagnosis', 'location'], daily)
+
+def rebuild_visit_counters():
+    """Пересчет счетчиков и суточной сводки визитов с нуля по таблице visit"""
+    from migrations import REBUILD_VISIT_COUNTERS, REBUILD_VISIT_DAILY
+    with db.engine.begin() as connection:
+        for statement in REBUILD_VISIT_COUNTERS + REBUILD_VISIT_DAILY:
+            connection.execute(text(statement))
+
+# Разрезы динамики визитов: параметр group_by -> колонка сводки
+ANALYTICS_GROUPS = {
+    'doctor': 'doctor_id',
+    'diagnosis': 'diagnosis',
+    'location': 'location',
+}
+
+def period_start(day, granularity):
+    """Начало периода (дня, недели с понедельника, месяца), куда попадает day"""
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def get_visit_series(start_date, end_date, granularity='day', group_by=()):
+    """Число визитов по периодам из суточной сводки visit_daily"""
+    from sqlalchemy import func
+    
+    columns = [VisitDaily.__table__.c[ANALYTICS_GROUPS[g]] for g in group_by]
+    rows = db.session.query(
+        VisitDaily.day, *columns, func.sum(VisitDaily.count)
+    ).filter(
+        VisitDaily.day >= start_date,
+        VisitDaily.day <= end_date
+    ).group_by(VisitDaily.day, *columns).all()
+    
+    totals = Counter()
+    for row in rows:
+        totals[(period_start(row[0], granularity),) + tuple(row[1:-1])] += row[-1]
     
-    return output.getvalue()
+    series = []
+    for key in sorted(totals):
+        point = {'period': key[0].isoformat()}
+        point.update(zip(group_by, key[1:]))
+        point['count'] = totals[key]
+        series.append(point)
+    return series
 
 def validate_patient_data(data):
     """Валидация данных пациента"""
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+"""
+Воркер фоновых задач (экспорт, аналитика, пересчет счетчиков)
+
+Запуск: python worker.py; воркеров может быть несколько.
+"""
+
+import logging
+from jobs import run_worker
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    run_worker()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный прогон всех API-маршрутов медицинского приложения
+
+Приложение поднимается в процессе на временной базе SQLite с
+синтетическими данными заданного объема, вместо Redis используется
+fakeredis. Каждый маршрут прогоняется с заданной параллельностью,
+по нему считаются p50/p95/p99 задержки, пропускная способность и число
+SQL-запросов на запрос. Результат сохраняется в JSON и может быть
+сравнен с результатом другого коммита.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench.py --patients 20000 --visits 200000 -o baseline.json
+    python benchmarks/bench.py --patients 20000 --visits 200000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+START_DATE = date(2022, 1, 1)
+DAYS = 3 * 365
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--patients', type=int, default=5000)
+    parser.add_argument('--doctors', type=int, default=50)
+    parser.add_argument('--medicines', type=int, default=200)
+    parser.add_argument('--visits', type=int, default=50000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='запросов на маршрут')
+    parser.add_argument('--routes', default='', help='подстрока имени маршрута для отбора')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='файл базы (по умолчанию временный)')
+    parser.add_argument('-o', '--output', help='куда сохранить JSON с результатами')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    return parser.parse_args()
+
+def boot(db_path):
+    """Импорт приложения на временной базе и fakeredis вместо Redis"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+    sys.path.insert(0, os.path.abspath(APP_DIR))
+    import fakeredis
+    import app as app_module
+    app_module.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    # Маршруты входа меряются без лимита попыток, его проверяет login_flood.py
+    app_module.app.config['LOGIN_RATE_LIMIT'] = False
+    return app_module
+
+def seed(app_module, args):
+    """Синтетические данные: тестовые аккаунты и заданный объем записей"""
+    import contextlib
+    import io
+    from sqlalchemy import func, select
+    from init_db import generate_data, init_database
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_database()
+    generate_data(args.patients, args.doctors, args.medicines, args.visits, seed=args.seed,
+                  end=START_DATE + timedelta(days=DAYS - 1), days=DAYS, log=lambda message: None)
+    with app_module.app.app_context():
+        with app_module.db.engine.connect() as connection:
+            return {name: connection.execute(select(func.max(model.id))).scalar()
+                    for name, model in (('patients', app_module.Patient), ('doctors', app_module.Doctor),
+                                        ('medicines', app_module.Medicine), ('visits', app_module.Visit))}
+
+def routes(sizes, rnd):
+    """Маршруты: имя -> (роль, доля запросов, функция, возвращающая аргументы запроса)"""
+    from init_db import DIAGNOSES, LOCATIONS, MALE_NAMES as NAMES, MALE_SURNAMES as SURNAMES, STREETS
+    DIAGNOSES = [name for name, _, _ in DIAGNOSES]
+    LOCATIONS = [name for name, _ in LOCATIONS]
+
+    def day():
+        return (START_DATE + timedelta(days=rnd.randrange(DAYS))).isoformat()
+
+    def visit_body():
+        return {'date': day(), 'location': rnd.choice(LOCATIONS), 'symptoms': 'Кашель',
+                'diagnosis': rnd.choice(DIAGNOSES), 'prescriptions_text': 'Покой',
+                'patient_id': rnd.randint(1, sizes['patients']),
+                'doctor_id': rnd.randint(1, sizes['doctors']),
+                'medicine_ids': [rnd.randint(1, sizes['medicines'])]}
+
+    return {
+        'GET /': (None, 1, lambda: ('GET', '/', None)),
+        'POST /login ok': (None, 0.1, lambda: ('POST', '/login', {'form': {'username': 'doctor', 'password': 'doctor123'}})),
+        'POST /login fail': (None, 0.1, lambda: ('POST', '/login', {'form': {'username': 'doctor', 'password': 'wrong'}})),
+        'GET /api/patients?limit': ('admin', 1, lambda: ('GET', '/api/patients?limit=100', None)),
+        'GET /api/medicines?limit': ('admin', 1, lambda: ('GET', '/api/medicines?limit=100', None)),
+        'GET /api/doctors': ('admin', 1, lambda: ('GET', '/api/doctors', None)),
+        'GET /api/visits?limit': ('admin', 1, lambda: ('GET', f'/api/visits?limit=100&after={day()},0', None)),
+        'GET /api/statistics': ('admin', 1, lambda: ('GET', '/api/statistics', None)),
+        'GET /api/popular-diagnoses': ('admin', 1, lambda: ('GET', '/api/popular-diagnoses', None)),
+        'GET /api/popular-medicines': ('admin', 1, lambda: ('GET', '/api/popular-medicines', None)),
+        'GET /api/dashboard': ('admin', 1, lambda: ('GET', '/api/dashboard', None)),
+        'GET /api/dashboard?sections': ('admin', 1, lambda: ('GET', '/api/dashboard?sections=statistics,popular_diagnoses,popular_medicines', None)),
+        'GET /api/search-patients': ('admin', 1, lambda: ('GET', f'/api/search-patients?q={rnd.choice(SURNAMES)}', None)),
+        'GET /api/search-patients prefix': ('admin', 1, lambda: ('GET', f'/api/search-patients?mode=prefix&q={rnd.choice(SURNAMES)[:4]}', None)),
+        'GET /api/patient/<id>/history': ('admin', 1, lambda: ('GET', f"/api/patient/{rnd.randint(1, sizes['patients'])}/history", None)),
+        'GET /api/doctors/<id>/schedule': ('admin', 1, lambda: ('GET', f"/api/doctors/{rnd.randint(1, sizes['doctors'])}/schedule?from={day()}", None)),
+        'GET /api/analytics/visits': ('admin', 1, lambda: ('GET', '/api/analytics/visits?from=2022-01-01&to=2024-12-31&granularity=month&group_by=diagnosis', None)),
+        'GET /api/medicines/<id>/side-effects': ('admin', 1, lambda: ('GET', f"/api/medicines/{rnd.randint(1, sizes['medicines'])}/side-effects", None)),
+        'GET /api/visits/export': ('admin', 0.2, lambda: ('GET', f'/api/visits/export?from={day()}&to={day()}', None)),
+        'POST /api/visits/count-by-date': ('admin', 1, lambda: ('POST', '/api/visits/count-by-date', {'json': {'date': day()}})),
+        'POST /api/patients/count-by-diagnosis': ('admin', 1, lambda: ('POST', '/api/patients/count-by-diagnosis', {'json': {'diagnosis': rnd.choice(DIAGNOSES)}})),
+        'GET /api/analytics/patients': ('admin', 1, lambda: ('GET', f'/api/analytics/patients?from=2022-01-01&to={day()}&diagnosis={rnd.choice(DIAGNOSES)}', None)),
+        'GET /api/visit-stats': ('admin', 1, lambda: ('GET', '/api/visit-stats', None)),
+        'POST /api/visits': ('admin', 1, lambda: ('POST', '/api/visits', {'json': visit_body()})),
+        'POST /api/patients': ('admin', 1, lambda: ('POST', '/api/patients', {'json': {
+            'name': f'{rnd.choice(SURNAMES)} {rnd.choice(NAMES)}', 'gender': 'Мужской',
+            'birth_date': '1990-01-01', 'address': f'ул. {rnd.choice(STREETS)}, д. 1'}})),
+    }
+
+class SqlCounter:
+    """Число SQL-запросов, выполненных в текущем потоке"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def run_route(app_module, sql, role, make_request, count, concurrency):
+    """Прогон одного маршрута; задержки в мс, SQL на запрос, ошибки"""
+    credentials = {'admin': ('admin', 'admin123'), 'doctor': ('doctor', 'doctor123')}
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = app_module.app.test_client()
+            if role:
+                username, password = credentials[role]
+                local.client.post('/login', data={'username': username, 'password': password})
+        return local.client
+
+    def one(_):
+        http = client()
+        method, path, kwargs = make_request()
+        kwargs = kwargs or {}
+        sql.reset()
+        started = time.perf_counter()
+        if 'form' in kwargs:
+            response = http.open(path, method=method, data=kwargs['form'])
+        else:
+            response = http.open(path, method=method, json=kwargs.get('json'))
+        response.get_data()
+        elapsed = (time.perf_counter() - started) * 1000
+        return elapsed, sql.value(), response.status_code >= 400
+
+    # Разогрев: вход и первые промахи кэшей не учитываются
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(concurrency)))
+        started = time.perf_counter()
+        results = list(pool.map(one, range(count)))
+        wall = time.perf_counter() - started
+
+    latencies = [r[0] for r in results]
+    statements = [r[1] for r in results]
+    return {
+        'requests': count,
+        'errors': sum(r[2] for r in results),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'throughput_rps': round(count / wall, 1),
+        'sql_per_request': round(sum(statements) / count, 2),
+        'sql_max': max(statements)
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=APP_DIR, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, baseline):
+    """Таблица изменений относительно предыдущего прогона"""
+    print(f"\nСравнение с {baseline['meta'].get('commit')}:")
+    print(f"{'маршрут':45} {'p50':>9} {'p95':>9} {'rps':>9} {'sql':>7}")
+    for name, result in current['routes'].items():
+        old = baseline['routes'].get(name)
+        if not old:
+            continue
+
+        def delta(key):
+            return f"{(result[key] - old[key]) / old[key] * 100:+.0f}%" if old[key] else 'n/a'
+
+        print(f"{name:45} {delta('p50_ms'):>9} {delta('p95_ms'):>9} "
+              f"{delta('throughput_rps'):>9} {result['sql_per_request'] - old['sql_per_request']:>+7.2f}")
+
+def main():
+    args = parse_args()
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    app_module = boot(db_path)
+
+    print(f'Подготовка данных в {db_path}...')
+    started = time.perf_counter()
+    sizes = seed(app_module, args)
+    print(f'Данные готовы за {time.perf_counter() - started:.1f} с: {sizes}')
+
+    with app_module.app.app_context():
+        sql = SqlCounter(app_module.db.engine)
+
+    rnd = random.Random(args.seed)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'dataset': sizes,
+            'concurrency': args.concurrency,
+            'requests': args.requests
+        },
+        'routes': {}
+    }
+    print(f"{'маршрут':45} {'p50':>8} {'p95':>8} {'p99':>8} {'rps':>8} {'sql':>6} {'ошибок':>6}")
+    for name, (role, share, make_request) in routes(sizes, rnd).items():
+        if args.routes not in name:
+            continue
+        count = max(args.concurrency, int(args.requests * share))
+        result = run_route(app_module, sql, role, make_request, count, args.concurrency)
+        report['routes'][name] = result
+        print(f"{name:45} {result['p50_ms']:8.2f} {result['p95_ms']:8.2f} {result['p99_ms']:8.2f} "
+              f"{result['throughput_rps']:8.1f} {result['sql_per_request']:6.2f} {result['errors']:6}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'\nРезультаты сохранены в {args.output}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
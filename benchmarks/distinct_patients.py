@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Подсчет разных пациентов: HyperLogLog в Redis против SQL
+
+База SQLite заполняется синтетическими визитами, множества пациентов
+строятся в настоящем Redis: fakeredis хранит их точными множествами, и
+погрешность HyperLogLog на нем не измерить. Для наборов запросов (за все
+время, за день, месяц, квартал, год; в целом, по диагнозу и по врачу)
+PFCOUNT сравнивается с COUNT(DISTINCT patient_id): относительная
+ошибка, задержки и во сколько раз HyperLogLog быстрее. Используются
+только ключи hll:patients:*, остальные данные Redis не трогаются.
+
+    python benchmarks/distinct_patients.py --redis-url redis://localhost:6379/15 --visits 1000000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import DAYS, START_DATE, boot, percentile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='настоящий Redis, не fakeredis')
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--doctors', type=int, default=100)
+    parser.add_argument('--visits', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=30, help='запросов каждого вида')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='файл базы (по умолчанию временный)')
+    return parser.parse_args()
+
+def query_kinds(rnd, diagnoses, doctors):
+    """Виды запросов: имя -> функция, возвращающая аргументы distinct_patients"""
+    def period(days):
+        start = START_DATE + timedelta(days=rnd.randrange(DAYS - days + 1))
+        return {'start_date': start, 'end_date': start + timedelta(days=days - 1)}
+
+    return {
+        'все время, по диагнозу': lambda: {'diagnosis': rnd.choice(diagnoses)},
+        'все время, по врачу': lambda: {'doctor_id': rnd.randint(1, doctors)},
+        'день': lambda: period(1),
+        'день, по диагнозу': lambda: dict(period(1), diagnosis=rnd.choice(diagnoses)),
+        'месяц, по врачу': lambda: dict(period(30), doctor_id=rnd.randint(1, doctors)),
+        'квартал, по диагнозу': lambda: dict(period(90), diagnosis=rnd.choice(diagnoses)),
+        'год': lambda: period(365),
+    }
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
+def hll_memory(redis_client, prefix):
+    """Число ключей HyperLogLog и занимаемая ими память, байт"""
+    keys = list(redis_client.scan_iter(match=prefix + '*', count=1000))
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return len(keys), sum(size or 0 for size in pipe.execute())
+
+def main():
+    args = parse_args()
+    import redis
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='distinct-patients-'), 'bench.db')
+    app_module = boot(db_path)
+    app_module.redis_client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    import cardinality
+    from init_db import DIAGNOSES, generate_data, init_database
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_database()
+    generate_data(args.patients, args.doctors, 0, args.visits, seed=args.seed,
+                  end=START_DATE + timedelta(days=DAYS - 1), days=DAYS, log=lambda message: None)
+    print(f'Данные: {args.patients} пациентов, {args.visits} визитов за {time.perf_counter() - started:.0f} с')
+
+    with app_module.app.app_context():
+        _, rebuild_ms = timed(cardinality.rebuild)
+        keys, memory = hll_memory(app_module.redis_client, cardinality.KEY_PREFIX)
+        print(f'Пересчет множеств: {rebuild_ms / 1000:.1f} с, ключей {keys}, память {memory / 2 ** 20:.1f} МБ')
+
+        rnd = random.Random(args.seed)
+        kinds = query_kinds(rnd, [name for name, _, _ in DIAGNOSES], args.doctors)
+        print(f"{'запрос':24} {'ср. ошибка':>10} {'макс.':>7} {'HLL p50':>9} {'SQL p50':>9} {'быстрее':>8}")
+        for name, make_args in kinds.items():
+            errors, hll_times, sql_times = [], [], []
+            for _ in range(args.queries):
+                query = make_args()
+                (estimate, approximate), hll_ms = timed(cardinality.distinct_patients, **query)
+                exact, sql_ms = timed(cardinality.exact_distinct_patients, **query)
+                if not approximate:
+                    raise SystemExit('Множества пациентов не построены: проверьте --redis-url')
+                hll_times.append(hll_ms)
+                sql_times.append(sql_ms)
+                if exact:
+                    errors.append(abs(estimate - exact) / exact * 100)
+            hll_p50, sql_p50 = percentile(hll_times, 50), percentile(sql_times, 50)
+            mean_error = sum(errors) / len(errors) if errors else 0
+            print(f'{name:24} {mean_error:9.2f}% {max(errors, default=0):6.2f}% '
+                  f'{hll_p50:7.2f}мс {sql_p50:7.2f}мс {sql_p50 / hll_p50:7.1f}x')
+
+if __name__ == '__main__':
+    main()
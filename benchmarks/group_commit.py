@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Параллельная запись визитов с групповым коммитом и без него
+
+--writers потоков одновременно добавляют визиты через POST /api/visits
+(с рецептами, счетчиками и журналом изменений, как в работе). Прогон
+выполняется дважды на одной базе: каждый запрос коммитит сам
+(WRITE_QUEUE=0) и записи идут через поток группового коммита
+(WRITE_QUEUE=1). Выводятся пропускная способность, задержки, ошибки
+(в том числе database is locked) и число коммитов.
+
+    python benchmarks/group_commit.py --writers 16 --duration 10 --synchronous FULL
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import DAYS, START_DATE, boot, percentile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16, help='параллельных пишущих клиентов')
+    parser.add_argument('--duration', type=float, default=10, help='длительность фазы, с')
+    parser.add_argument('--synchronous', default='NORMAL', help='PRAGMA synchronous: OFF, NORMAL, FULL')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+def run_phase(app_module, args, queued):
+    """Одна фаза: writers клиентов пишут визиты args.duration секунд"""
+    from datetime import timedelta
+    from sqlalchemy import event
+    from init_db import DIAGNOSES, LOCATIONS
+
+    app = app_module.app
+    app.config['WRITE_QUEUE'] = queued
+    with app.app_context():
+        engine = app_module.db.engine
+        sizes = {name: model.query.count() for name, model in
+                 (('patients', app_module.Patient), ('doctors', app_module.Doctor),
+                  ('medicines', app_module.Medicine))}
+
+    commits = [0]
+    commits_lock = threading.Lock()
+
+    def count_commit(connection):
+        with commits_lock:
+            commits[0] += 1
+
+    event.listen(engine, 'commit', count_commit)
+    stop = time.perf_counter() + args.duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def writer(number):
+        rnd = random.Random(args.seed + number)
+        client = app.test_client()
+        client.post('/login', data={'username': 'doctor', 'password': 'doctor123'},
+                    environ_base={'REMOTE_ADDR': f'10.0.0.{number}'})
+        while time.perf_counter() < stop:
+            body = {'date': (START_DATE + timedelta(days=rnd.randrange(DAYS))).isoformat(),
+                    'location': rnd.choice(LOCATIONS)[0], 'symptoms': 'Кашель',
+                    'diagnosis': rnd.choice(DIAGNOSES)[0], 'prescriptions_text': 'Покой',
+                    'patient_id': rnd.randint(1, sizes['patients']),
+                    'doctor_id': rnd.randint(1, sizes['doctors']),
+                    'medicine_ids': [rnd.randint(1, sizes['medicines'])]}
+            started = time.perf_counter()
+            try:
+                response = client.post('/api/visits', json=body)
+                failed = response.status_code != 200
+                response.close()
+            except Exception:
+                failed = True
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    event.remove(engine, 'commit', count_commit)
+
+    return {
+        'rps': (len(latencies) - errors[0]) / args.duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'errors': errors[0],
+        'commits': commits[0],
+        'writes': len(latencies) - errors[0]
+    }
+
+def main():
+    args = parse_args()
+    os.environ['SQLITE_SYNCHRONOUS'] = args.synchronous
+    db_path = os.path.join(tempfile.mkdtemp(prefix='group-commit-'), 'bench.db')
+    app_module = boot(db_path)
+    import contextlib
+    import io
+    import logging
+    from init_db import init_database
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_database()
+    # Ошибки записи считаются в таблице, трассировки в выводе не нужны
+    app_module.app.logger.setLevel(logging.CRITICAL)
+
+    print(f'{args.writers} пишущих клиентов, synchronous={args.synchronous}, {args.duration:.0f} с на фазу')
+    print(f"{'режим':24} {'визитов/с':>10} {'p50':>9} {'p95':>9} {'ошибок':>7} {'коммитов':>9} {'записей/коммит':>15}")
+    results = {}
+    for name, queued in (('коммит на запрос', False), ('групповой коммит', True)):
+        result = results[name] = run_phase(app_module, args, queued)
+        per_commit = result['writes'] / result['commits'] if result['commits'] else 0
+        print(f"{name:24} {result['rps']:10.1f} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+              f"{result['errors']:7} {result['commits']:9} {per_commit:15.1f}")
+    direct, grouped = results['коммит на запрос'], results['групповой коммит']
+    if direct['rps']:
+        print(f"\nГрупповой коммит: пропускная способность x{grouped['rps'] / direct['rps']:.2f}")
+
+if __name__ == '__main__':
+    main()
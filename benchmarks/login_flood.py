@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Емкость воркеров под потоком подбора паролей
+
+Моделируется сервер с фиксированным числом воркеров (как у gunicorn):
+все запросы - и атакующие, и обычные - обслуживаются общим пулом из
+--workers потоков. Атакующие клиенты непрерывно отправляют POST /login
+с неверными паролями к существующим учетным записям с нескольких IP,
+обычные пользователи в это время читают /api/patients. Прогон
+выполняется трижды: без атаки, под атакой без лимита входа и под атакой
+с лимитом. Для обычных запросов выводятся пропускная способность и
+задержки, для атаки - сколько раз вычислялся хэш пароля.
+
+    python benchmarks/login_flood.py --workers 4 --attackers 16 --duration 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import boot, percentile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='размер пула воркеров')
+    parser.add_argument('--attackers', type=int, default=16, help='параллельных атакующих клиентов')
+    parser.add_argument('--users', type=int, default=2, help='параллельных обычных пользователей')
+    parser.add_argument('--ips', type=int, default=50, help='число IP атакующих')
+    parser.add_argument('--duration', type=float, default=10, help='длительность фазы, с')
+    return parser.parse_args()
+
+def run_phase(app_module, pool, args, attack, limit):
+    """Одна фаза: обычные пользователи и, при attack, атакующие клиенты"""
+    app = app_module.app
+    app.config['LOGIN_RATE_LIMIT'] = limit
+    app_module.redis_client.flushall()
+
+    hashes = [0]
+    hashes_lock = threading.Lock()
+    check_password_hash = app_module.check_password_hash
+
+    def counting_check(*hash_args):
+        with hashes_lock:
+            hashes[0] += 1
+        return check_password_hash(*hash_args)
+
+    app_module.check_password_hash = counting_check
+    stop = time.perf_counter() + args.duration
+    latencies = []
+    errors = [0]
+    attack_results = {'requests': 0, 'rejected': 0}
+    lock = threading.Lock()
+
+    def user_loop(client):
+        def read():
+            response = client.get('/api/patients?limit=50')
+            response.get_data()
+            response.close()
+            return response.status_code
+
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            status = pool.submit(read).result()
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                errors[0] += status != 200
+
+    def attacker_loop(number):
+        client = app.test_client()
+        counter = 0
+
+        def guess():
+            response = client.post('/login', data={'username': ('admin', 'doctor')[counter % 2],
+                                                   'password': f'guess{counter}'},
+                                   environ_base={'REMOTE_ADDR': f'192.0.2.{(number + counter) % args.ips}'})
+            response.close()
+            return response.status_code
+
+        while time.perf_counter() < stop:
+            counter += 1
+            status = pool.submit(guess).result()
+            with lock:
+                attack_results['requests'] += 1
+                attack_results['rejected'] += status == 429
+
+    # Обычные пользователи входят до начала атаки
+    clients = []
+    for _ in range(args.users):
+        client = app.test_client()
+        client.post('/login', data={'username': 'doctor', 'password': 'doctor123'},
+                    environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        clients.append(client)
+
+    threads = [threading.Thread(target=user_loop, args=(client,)) for client in clients]
+    if attack:
+        threads += [threading.Thread(target=attacker_loop, args=(i,)) for i in range(args.attackers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    app_module.check_password_hash = check_password_hash
+
+    latencies.sort()
+    return {
+        'user_rps': len(latencies) / args.duration,
+        'user_p50_ms': percentile(latencies, 50) * 1000,
+        'user_p95_ms': percentile(latencies, 95) * 1000,
+        'user_errors': errors[0],
+        'attack_requests': attack_results['requests'],
+        'attack_rejected': attack_results['rejected'],
+        'password_hashes': hashes[0]
+    }
+
+def main():
+    args = parse_args()
+    db_path = os.path.join(tempfile.mkdtemp(prefix='login-flood-'), 'bench.db')
+    app_module = boot(db_path)
+    import contextlib
+    import io
+    from init_db import init_database
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_database()
+
+    phases = [('без атаки', False, True), ('атака, лимит выключен', True, False), ('атака, лимит включен', True, True)]
+    print(f"{'фаза':28} {'rps':>8} {'p50':>9} {'p95':>9} {'ошибок':>7} {'атака':>8} {'отказов':>8} {'хэшей':>7}")
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for name, attack, limit in phases:
+            result = run_phase(app_module, pool, args, attack, limit)
+            print(f"{name:28} {result['user_rps']:8.1f} {result['user_p50_ms']:9.2f} {result['user_p95_ms']:9.2f} {result['user_errors']:7} "
+                  f"{result['attack_requests']:8} {result['attack_rejected']:8} {result['password_hashes']:7}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Общая настройка тестов
+
+Приложение работает на временной базе SQLite, Redis заменен на
+fakeredis в памяти. Начальные данные (init_database) создаются один раз
+на весь прогон; client - тестовый клиент, вошедший как admin.
+
+    pip install -r requirements.txt -r tests/requirements.txt
+    python -m pytest tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='medical-tests-'), 'test.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import fakeredis
+import app as app_module
+
+app_module.redis_client = fakeredis.FakeRedis(decode_responses=True)
+
+@pytest.fixture(scope='session')
+def app():
+    from init_db import init_database
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_database()
+    return app_module.app
+
+@pytest.fixture(scope='session')
+def client(app):
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    return client
+
+@pytest.fixture
+def redis_client():
+    return app_module.redis_client
@@ -0,0 +1,61 @@
+"""
+Кэш агрегатных выборок в Redis
+
+Выборка читается из кэша, пока POST-обработчик не сбросит зависящие от
+сущности ключи; без Redis значение вычисляется на каждый запрос.
+"""
+
+from datetime import date
+
+import fakeredis
+import pytest
+
+import app as app_module
+import cache
+from app import db, Patient
+
+PATIENT = {'name': 'Кэшев Кэш Кэшевич', 'gender': 'Мужской', 'birth_date': '1990-01-01',
+           'address': 'ул. Тестовая, д. 2'}
+
+@pytest.fixture(autouse=True)
+def empty_cache(app, redis_client):
+    for key in redis_client.scan_iter(match=cache.KEY_PREFIX + '*'):
+        redis_client.delete(key)
+
+def add_patient_directly(app):
+    """Пациент в обход API: кэш об этой записи не знает"""
+    with app.app_context():
+        db.session.add(Patient(name=PATIENT['name'], gender=PATIENT['gender'],
+                               birth_date=date(1990, 1, 1), address=PATIENT['address']))
+        db.session.commit()
+
+def test_statistics_cached_until_write(app, client, redis_client):
+    first = client.get('/api/statistics').get_json()
+    assert redis_client.exists(cache.KEY_PREFIX + 'statistics')
+
+    add_patient_directly(app)
+    assert client.get('/api/statistics').get_json() == first
+
+    assert client.post('/api/patients', json=PATIENT).status_code == 200
+    assert not redis_client.exists(cache.KEY_PREFIX + 'statistics')
+    assert client.get('/api/statistics').get_json()['total_patients'] == first['total_patients'] + 2
+
+def test_visit_invalidates_popular_lists(client, redis_client):
+    for url in ('/api/popular-diagnoses', '/api/popular-medicines'):
+        client.get(url)
+    response = client.post('/api/visits', json={
+        'date': date.today().isoformat(), 'location': 'Кабинет 1', 'symptoms': 'Кашель',
+        'diagnosis': 'ОРВИ', 'prescriptions_text': 'Покой', 'patient_id': 1, 'doctor_id': 1,
+        'medicine_ids': [1]})
+    assert response.status_code == 200
+    for name in cache.INVALIDATES['visit']:
+        assert not redis_client.exists(cache.KEY_PREFIX + name)
+
+def test_computed_without_redis(app, client, monkeypatch):
+    first = client.get('/api/statistics').get_json()
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(app_module, 'redis_client', fakeredis.FakeRedis(server=server, decode_responses=True))
+
+    add_patient_directly(app)
+    assert client.get('/api/statistics').get_json()['total_patients'] == first['total_patients'] + 1
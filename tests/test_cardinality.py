@@ -0,0 +1,64 @@
+"""
+Число разных пациентов через HyperLogLog
+
+fakeredis считает PFCOUNT точно, поэтому ответ по множествам Redis
+должен совпадать с COUNT(DISTINCT) в SQL. Пока множества не построены
+(нет READY_KEY) или Redis недоступен, счет идет по SQL.
+"""
+
+from datetime import date
+
+import fakeredis
+import pytest
+
+import app as app_module
+import cardinality
+from app import db
+
+QUERIES = {
+    'all': {},
+    'period': {'start_date': date(2023, 11, 15), 'end_date': date(2025, 2, 10)},
+    'diagnosis': {'diagnosis': 'ОРВИ'},
+    'doctor': {'start_date': date(2024, 1, 1), 'end_date': date(2024, 12, 31), 'doctor_id': 1},
+}
+
+@pytest.fixture(autouse=True)
+def patient_sets(app):
+    # Другие тесты добавляют визиты в обход учета: множества строятся заново
+    with app.app_context():
+        cardinality.rebuild()
+        yield
+        db.session.remove()
+
+@pytest.mark.parametrize('name', list(QUERIES))
+def test_hll_matches_exact(name):
+    count, approximate = cardinality.distinct_patients(**QUERIES[name])
+    assert approximate
+    assert count == cardinality.exact_distinct_patients(**QUERIES[name])
+
+def test_new_visit_is_counted(client):
+    today = date.today()
+    response = client.post('/api/visits', json={
+        'date': today.isoformat(), 'location': 'Кабинет 1', 'symptoms': 'Кашель', 'diagnosis': 'ОРВИ',
+        'prescriptions_text': 'Покой', 'patient_id': 1, 'doctor_id': 1, 'medicine_ids': []})
+    assert response.status_code == 200
+    count, approximate = cardinality.distinct_patients(today, today, doctor_id=1)
+    assert approximate
+    assert count == cardinality.exact_distinct_patients(today, today, doctor_id=1) >= 1
+
+def test_exact_until_sets_are_ready(redis_client):
+    redis_client.delete(cardinality.READY_KEY)
+    for query in QUERIES.values():
+        assert cardinality.distinct_patients(**query) == (cardinality.exact_distinct_patients(**query), False)
+
+def test_exact_when_redis_is_down(monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(app_module, 'redis_client', fakeredis.FakeRedis(server=server, decode_responses=True))
+    query = QUERIES['diagnosis']
+    assert cardinality.distinct_patients(**query) == (cardinality.exact_distinct_patients(**query), False)
+
+def test_diagnosis_and_doctor_are_exact():
+    count, approximate = cardinality.distinct_patients(diagnosis='ОРВИ', doctor_id=1)
+    assert not approximate
+    assert count == cardinality.exact_distinct_patients(diagnosis='ОРВИ', doctor_id=1)
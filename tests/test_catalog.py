@@ -0,0 +1,63 @@
+"""
+Справочник лекарств в памяти процесса
+
+Справочник загружается один раз и сбрасывается при добавлении лекарства
+и по сообщению invalidate:medicines, пришедшему от другого воркера.
+"""
+
+import time
+
+import pytest
+from sqlalchemy import event
+
+import cache
+from app import app, db, Medicine
+
+MEDICINE = {'name': 'Тестомицин', 'usage_method': 'По 1 таблетке', 'description': 'Для тестов',
+            'side_effects': 'Нет'}
+
+def count_queries(run):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        run()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return len(statements)
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+@pytest.fixture
+def catalog(app):
+    with app.app_context():
+        cache.get_medicine_catalog()
+    assert cache._medicines is not None
+
+def test_catalog_is_loaded_once(client, catalog):
+    response = client.get('/api/medicines/1/side-effects')
+    assert response.status_code == 200
+    assert count_queries(lambda: client.get('/api/medicines/1/side-effects')) == 0
+
+def test_new_medicine_is_visible(client, catalog):
+    assert client.post('/api/medicines', json=MEDICINE).status_code == 200
+    with app.app_context():
+        medicine_id = Medicine.query.filter_by(name=MEDICINE['name']).one().id
+    response = client.get(f'/api/medicines/{medicine_id}/side-effects')
+    assert response.status_code == 200
+    assert response.get_json()['side_effects'] == MEDICINE['side_effects']
+
+def test_invalidation_from_other_worker(catalog, redis_client):
+    wait_for(lambda: redis_client.pubsub_numpat() > 0)
+    # Сообщение, опубликованное другим процессом, а не publish_invalidation
+    redis_client.publish(cache.CHANNEL_PREFIX + 'medicines', '')
+    wait_for(lambda: cache._medicines is None)
@@ -0,0 +1,70 @@
+"""
+Дельта-синхронизация списков через ?since=
+
+Клиент получает курсор в X-Change-Cursor и затем только строки,
+добавленные после него; когда дельты не восстановить, приходит reset.
+"""
+
+import pytest
+
+import utils
+from app import app
+
+def patient(number):
+    return {'name': f'Дельтов Пациент {number}', 'gender': 'Женский', 'birth_date': '1985-05-05',
+            'address': 'ул. Тестовая, д. 3'}
+
+def cursor(client, url='/api/patients?limit=1'):
+    response = client.get(url)
+    response.get_data()
+    return int(response.headers['X-Change-Cursor'])
+
+def since(client, url, cursor):
+    response = client.get(f'{url}?since={cursor}')
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_only_new_rows(client):
+    start = cursor(client)
+    assert client.post('/api/patients', json=patient(1)).status_code == 200
+
+    delta = since(client, '/api/patients', start)
+    assert not delta['reset'] and delta['cursor'] > start
+    assert [item['name'] for item in delta['items']] == [patient(1)['name']]
+    assert since(client, '/api/patients', delta['cursor'])['items'] == []
+
+def test_new_visit_with_medicines(client):
+    start = cursor(client, '/api/visits?limit=1')
+    response = client.post('/api/visits', json={
+        'date': '2030-01-01', 'location': 'Кабинет 1', 'symptoms': 'Кашель', 'diagnosis': 'ОРВИ',
+        'prescriptions_text': 'Покой', 'patient_id': 1, 'doctor_id': 1, 'medicine_ids': [1, 2]})
+    assert response.status_code == 200
+
+    delta = since(client, '/api/visits', start)
+    assert [item['date'] for item in delta['items']] == ['2030-01-01']
+    assert len(delta['items'][0]['medicines']) == 2
+
+def test_reset_when_delta_is_lost(client, monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_CHANGES', 2)
+    start = cursor(client)
+    for number in range(3):
+        client.post('/api/patients', json=patient(10 + number))
+    assert since(client, '/api/patients', start)['reset']
+    # Курсор впереди журнала - база пересоздана
+    assert since(client, '/api/patients', start + 10 ** 6)['reset']
+
+def test_prune_keeps_recent_cursor(client, monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_CHANGES', 2)
+    for number in range(3):
+        client.post('/api/patients', json=patient(20 + number))
+    recent = cursor(client)
+    client.post('/api/patients', json=patient(30))
+    with app.app_context():
+        assert utils.prune_changes() > 0
+    delta = since(client, '/api/patients', recent)
+    assert not delta['reset']
+    assert [item['name'] for item in delta['items']] == [patient(30)['name']]
+
+@pytest.mark.parametrize('value', ['abc', '1.5'])
+def test_invalid_since(client, value):
+    assert client.get(f'/api/patients?since={value}').status_code == 400
@@ -0,0 +1,43 @@
+"""
+Счетчики визитов по дате и по диагнозу
+
+Счетчики обновляются в транзакции визита и совпадают с пересчетом по
+таблице visit.
+"""
+
+from app import app, db, VisitCounter
+from utils import rebuild_visit_counters
+
+DAY = '2031-03-03'
+DIAGNOSIS = 'Тестовый диагноз'
+
+def counter(dimension, value):
+    with app.app_context():
+        row = db.session.get(VisitCounter, (dimension, value))
+        return row.count if row else 0
+
+def add_visit(client):
+    response = client.post('/api/visits', json={
+        'date': DAY, 'location': 'Кабинет 1', 'symptoms': 'Кашель', 'diagnosis': DIAGNOSIS,
+        'prescriptions_text': 'Покой', 'patient_id': 1, 'doctor_id': 1, 'medicine_ids': []})
+    assert response.status_code == 200
+
+def count_by_date(client):
+    response = client.post('/api/visits/count-by-date', json={'date': DAY})
+    assert response.status_code == 200
+    return response.get_json()['count']
+
+def test_counters_follow_new_visits(client):
+    assert count_by_date(client) == 0
+    add_visit(client)
+    add_visit(client)
+    assert count_by_date(client) == 2
+    assert counter('diagnosis', DIAGNOSIS) == 2
+
+def test_rebuild_matches_incremental(client):
+    add_visit(client)
+    before = counter('date', DAY), counter('diagnosis', DIAGNOSIS)
+    with app.app_context():
+        rebuild_visit_counters()
+    assert (counter('date', DAY), counter('diagnosis', DIAGNOSIS)) == before
+    assert count_by_date(client) == before[0]
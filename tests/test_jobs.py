@@ -0,0 +1,83 @@
+"""
+Очередь фоновых задач
+
+Постановка и выполнение выгрузки с результатом кусками, повтор упавшей
+задачи с паузой и возврат в очередь задачи, чей воркер перестал
+отмечаться.
+"""
+
+import time
+
+import pytest
+
+import jobs
+import utils
+
+PERIOD = {'from': '2000-01-01', 'to': '2099-12-31'}
+
+@pytest.fixture(autouse=True)
+def clean_queue(app, redis_client):
+    redis_client.delete(jobs.QUEUE, jobs.PROCESSING, jobs.DELAYED)
+
+@pytest.fixture
+def flaky_job(monkeypatch):
+    """Тип задачи, падающий на первой попытке"""
+    calls = []
+
+    def run(params, progress):
+        calls.append(params)
+        if len(calls) == 1:
+            raise RuntimeError('Сбой первой попытки')
+        return {'calls': len(calls)}, 'application/json', None
+
+    monkeypatch.setitem(jobs.JOB_TYPES, 'flaky', (lambda params: {}, run, False))
+    return calls
+
+def test_export_job_result_is_chunked(client, redis_client, monkeypatch):
+    monkeypatch.setattr(utils, 'STREAM_CHUNK_SIZE', 1)
+    monkeypatch.setattr(jobs, 'RESULT_READ_BATCH', 2)
+    response = client.post('/api/jobs', json={'type': 'visits_export', 'params': PERIOD})
+    assert response.status_code == 202
+    job_id = response.get_json()['id']
+    assert redis_client.lrange(jobs.QUEUE, 0, -1) == [job_id]
+
+    jobs.run_worker(once=True)
+    status = client.get(f'/api/jobs/{job_id}').get_json()
+    assert status['status'] == 'done' and status['progress'] == 100
+    assert redis_client.llen(jobs.JOB_PREFIX + job_id + ':result') > jobs.RESULT_READ_BATCH
+    assert not redis_client.lrange(jobs.PROCESSING, 0, -1)
+
+    result = client.get(status['result_url'])
+    assert result.status_code == 200
+    csv = result.get_data(as_text=True)
+    export = client.get(f"/api/visits/export?from={PERIOD['from']}&to={PERIOD['to']}")
+    assert csv == export.get_data(as_text=True)
+
+def test_failed_job_is_retried(app, redis_client, flaky_job, monkeypatch):
+    monkeypatch.setitem(app.config, 'JOB_RETRY_DELAY', 0.1)
+    job_id = jobs.enqueue('flaky', {}, 1)['id']
+
+    jobs.run_worker(once=True)
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued' and job['error'] == 'Сбой первой попытки'
+    assert redis_client.zscore(jobs.DELAYED, job_id) is not None
+
+    time.sleep(0.15)
+    jobs.run_worker(once=True)
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'done' and job['attempts'] == '2'
+    assert ''.join(jobs.get_result(job_id)) == '{"calls":2}'
+
+def test_stale_job_is_requeued(app, redis_client, flaky_job):
+    job_id = jobs.enqueue('flaky', {}, 1)['id']
+    assert jobs.claim() == job_id
+    # Только что взятая задача уже отмечена и не считается зависшей
+    jobs.requeue_stale()
+    assert redis_client.lrange(jobs.PROCESSING, 0, -1) == [job_id]
+
+    redis_client.hset(jobs.JOB_PREFIX + job_id, 'heartbeat', time.time() - app.config['JOB_STALE_AFTER'] - 1)
+    jobs.requeue_stale()
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued' and job['error'] == 'Воркер перестал отвечать'
+    assert not redis_client.lrange(jobs.PROCESSING, 0, -1)
+    assert redis_client.zscore(jobs.DELAYED, job_id) is not None
@@ -0,0 +1,44 @@
+"""
+Миграции схемы и планы запросов
+
+Миграции применяются один раз, в том числе когда несколько процессов
+стартуют одновременно; выборки utils по визитам и рецептам идут по
+индексам (migrations.py --check).
+"""
+
+import os
+import tempfile
+import threading
+
+from sqlalchemy import create_engine, text
+
+from app import app, db
+from migrations import MIGRATIONS, check_query_plans, migrate
+
+def test_query_plans_use_indexes(client):
+    report = check_query_plans()
+    assert {name: scans for name, scans in report.items() if scans} == {}
+
+def test_migrations_applied_once(client):
+    with app.app_context():
+        assert migrate(db.engine, db.metadata) == []
+
+def test_concurrent_migrate():
+    engine = create_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='migrations-'), 'test.db'))
+    applied, errors = [], []
+
+    def run():
+        try:
+            applied.extend(migrate(engine, db.metadata))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(applied) == [number for number, _, _ in MIGRATIONS]
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT COUNT(*) FROM schema_migrations')).scalar() == len(MIGRATIONS)
@@ -0,0 +1,72 @@
+"""
+Ограничение частоты попыток входа
+
+Порог неудач для пары имя + IP, рост паузы после порога, сброс при
+успешном входе и вход без ограничений, когда Redis недоступен.
+"""
+
+import time
+
+import fakeredis
+import pytest
+
+import app as app_module
+import ratelimit
+
+@pytest.fixture(autouse=True)
+def clean_limits(app, redis_client):
+    for key in redis_client.scan_iter(match=ratelimit.KEY_PREFIX + '*'):
+        redis_client.delete(key)
+
+def login(app, username, password, ip):
+    return app.test_client().post('/login', data={'username': username, 'password': password},
+                                  environ_base={'REMOTE_ADDR': ip})
+
+def test_threshold_blocks_pair_not_user(app):
+    limit = app.config['LOGIN_MAX_FAILURES_PER_USER']
+    for _ in range(limit):
+        assert login(app, 'doctor', 'wrong', '198.51.100.1').status_code == 200
+
+    response = login(app, 'doctor', 'doctor123', '198.51.100.1')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    # С другого адреса пользователь входит как обычно
+    assert login(app, 'doctor', 'doctor123', '198.51.100.2').status_code == 302
+
+def test_backoff_doubles_after_threshold(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOGIN_BACKOFF_BASE', 0.2)
+    limit = app.config['LOGIN_MAX_FAILURES_PER_USER']
+    for _ in range(limit):
+        retry_after, attempt = ratelimit.check_login('admin', '198.51.100.3')
+        assert retry_after == 0 and attempt
+
+    retry_after, _ = ratelimit.check_login('admin', '198.51.100.3')
+    assert 0 < retry_after <= 0.2
+    time.sleep(retry_after + 0.05)
+    retry_after, attempt = ratelimit.check_login('admin', '198.51.100.3')
+    assert retry_after == 0 and attempt
+
+    retry_after, _ = ratelimit.check_login('admin', '198.51.100.3')
+    assert 0.2 < retry_after <= 0.4
+
+def test_success_clears_failures(app, redis_client):
+    limit = app.config['LOGIN_MAX_FAILURES_PER_USER']
+    (pair_key, _), (ip_key, _) = ratelimit._keys('doctor', '198.51.100.4')
+    for _ in range(limit - 1):
+        login(app, 'doctor', 'wrong', '198.51.100.4')
+    assert redis_client.zcard(pair_key) == limit - 1
+
+    assert login(app, 'doctor', 'doctor123', '198.51.100.4').status_code == 302
+    assert not redis_client.exists(pair_key)
+    # Успешная попытка не считается неудачей адреса
+    assert redis_client.zcard(ip_key) == limit - 1
+    for _ in range(limit - 1):
+        assert login(app, 'doctor', 'wrong', '198.51.100.4').status_code == 200
+
+def test_redis_down_does_not_block_login(app, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(app_module, 'redis_client', fakeredis.FakeRedis(server=server, decode_responses=True))
+    for _ in range(app.config['LOGIN_MAX_FAILURES_PER_USER'] + 1):
+        assert login(app, 'doctor', 'wrong', '198.51.100.5').status_code == 200
+    assert login(app, 'doctor', 'doctor123', '198.51.100.5').status_code == 302
@@ -0,0 +1,82 @@
+"""
+Число SQL-запросов списков визитов не зависит от числа строк
+
+Список визитов, история пациента и выгрузка CSV загружают пациента,
+врача и лекарства визитов постоянным числом запросов (visits_with_names
+и пачечная догрузка). Тест считает запросы движка на запрос при малом
+и большом числе визитов: при ленивой загрузке связей их стало бы
+примерно 3N+1.
+
+    python -m pytest tests
+"""
+
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app import app, db, Doctor, Medicine, Patient, Prescription, Visit
+
+FIRST_DAY = date(2024, 1, 1)
+
+URLS = {
+    'visits': lambda patient_id: '/api/visits',
+    'visits?fields': lambda patient_id: '/api/visits?fields=id,date,patient_name,doctor_name,medicines',
+    'visits?limit': lambda patient_id: '/api/visits?limit=500',
+    'history': lambda patient_id: f'/api/patient/{patient_id}/history',
+    'export': lambda patient_id: f'/api/visits/export?from={FIRST_DAY}&to={FIRST_DAY + timedelta(days=400)}',
+}
+
+@pytest.fixture
+def patient_id(client):
+    with app.app_context():
+        patient = Patient(name='Тестов Тест Тестович', gender='Мужской',
+                          birth_date=date(1980, 1, 1), address='ул. Тестовая, д. 1')
+        db.session.add(patient)
+        db.session.commit()
+        return patient.id
+
+def add_visits(patient_id, count):
+    """count визитов пациента у разных врачей, по два лекарства в каждом"""
+    with app.app_context():
+        doctors = [doctor.id for doctor in Doctor.query.all()]
+        medicines = [medicine.id for medicine in Medicine.query.all()]
+        for i in range(count):
+            visit = Visit(date=FIRST_DAY + timedelta(days=i), location='Кабинет 1', symptoms='Кашель',
+                          diagnosis='ОРВИ', prescriptions_text='Покой', patient_id=patient_id,
+                          doctor_id=doctors[i % len(doctors)])
+            db.session.add(visit)
+            db.session.flush()
+            for medicine_id in (medicines[i % len(medicines)], medicines[(i + 1) % len(medicines)]):
+                db.session.add(Prescription(visit_id=visit.id, medicine_id=medicine_id))
+        db.session.commit()
+
+def count_queries(client, url):
+    """Число SQL-запросов, выполненных за запрос (включая потоковую выдачу)"""
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.get(url)
+        response.get_data()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return len(statements)
+
+@pytest.mark.parametrize('name', list(URLS))
+def test_query_count_does_not_grow_with_rows(client, patient_id, name):
+    url = URLS[name](patient_id)
+    add_visits(patient_id, 5)
+    # Первый запрос прогревает кэши процесса (пользователь, справочники)
+    count_queries(client, url)
+    few = count_queries(client, url)
+
+    add_visits(patient_id, 45)
+    many = count_queries(client, url)
+    assert many == few